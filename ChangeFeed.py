@@ -0,0 +1,90 @@
+"""
+This class represents the change feed of a database, which hands out the row images of every committed
+INSERT, UPDATE and DELETE in commit order so consumers can process just what changed
+"""
+import threading
+from collections import deque
+from Errors import TransactionError
+
+
+class ChangeFeed:
+    def __init__(self, retain):
+        """
+        Creates a feed with nothing in it
+        :param retain: How many of the latest changes are kept for consumers pulling them
+        """
+        self.lock = threading.Lock()
+        self.seq = 0  # The sequence number of the latest change
+        self.history = deque(maxlen=retain)
+        self.subscribers = []  # Each a tuple of the table name, or None for every table, and the callback
+        self.pending = deque()  # The changes numbered but not handed to the subscribers yet, in order
+        self.delivery = threading.RLock()  # Held by the one thread handing out the pending changes
+        self.delivering = False  # If that thread is in the middle of it, so a callback's own commit just queues
+        self.failures = 0  # How many callbacks have raised
+        self.error = None  # The exception of the last one that did
+
+    def subscribe(self, table, callback):
+        """
+        Calls a function with every change to a table committed from now on, on whichever committing thread
+        is handing out changes.  If it raises, the exception is kept in error instead
+        :param table: The name of the table, or None for every table
+        :param callback: The function, taking the change
+        """
+        with self.lock:
+            self.subscribers.append((table, callback))
+
+    def unsubscribe(self, table, callback):
+        with self.lock:
+            self.subscribers.remove((table, callback))
+
+    def emit(self, changes):
+        """
+        Numbers the changes of a committed transaction and hands them out.  The callbacks run without the lock,
+        so they can pull changes, unsubscribe or commit themselves, and one that raises can't fail the commit
+        :param changes: The list of changes, each a tuple of the operation, table name, old row and new row
+        """
+        with self.lock:
+            for op, table, old, new in changes:
+                self.seq += 1
+                change = (self.seq, op, table, old, new)
+                self.history.append(change)
+                self.pending.append(change)
+        self.deliver()
+
+    def deliver(self):
+        """
+        Hands the pending changes to the subscribers in order.  Only one thread does at a time, and it keeps
+        going until none are left, so the changes other commits queued meanwhile are sent after the earlier ones
+        """
+        with self.delivery:
+            if self.delivering:  # A callback committed, the loop below sends its changes once it gets to them
+                return
+            self.delivering = True
+            try:
+                while True:
+                    with self.lock:
+                        if len(self.pending) == 0:
+                            return
+                        change = self.pending.popleft()
+                        subscribers = list(self.subscribers)
+                    for name, callback in subscribers:
+                        if name is None or name == change[2]:
+                            try:
+                                callback(change)
+                            except Exception as e:  # The change is committed already, so it's only recorded
+                                self.failures += 1
+                                self.error = e
+            finally:
+                self.delivering = False
+
+    def since(self, seq, table=None):
+        """
+        Gets the changes committed after a sequence number
+        :param seq: The sequence number of the last change the consumer has seen
+        :param table: The name of the table, or None for every table
+        :return: The list of changes
+        """
+        with self.lock:
+            if len(self.history) > 0 and self.history[0][0] > seq + 1:
+                raise TransactionError("Changes after {} are no longer kept".format(seq))
+            return [change for change in self.history if change[0] > seq and (table is None or change[2] == table)]
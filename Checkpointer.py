@@ -0,0 +1,84 @@
+"""
+This class represents the background thread that folds the write-ahead log of a database into its main
+file, so the log and the time it takes to replay it stay bounded
+"""
+import os
+import pickle
+import threading
+
+
+class Checkpointer:
+    def __init__(self, path, wal, snapshot, threshold, interval, checkpointed=0):
+        """
+        Starts the checkpointer thread
+        :param path: The path of the main database file
+        :param wal: The WriteAheadLog of the database
+        :param snapshot: The function that gets the latest committed Database
+        :param threshold: The size of the log in bytes that triggers a checkpoint
+        :param interval: The most seconds between checkpoints, or None to only go by size
+        :param checkpointed: The sequence number the main file is already up to
+        """
+        self.path = path
+        self.wal = wal
+        self.snapshot = snapshot
+        self.threshold = threshold
+        self.interval = interval
+        self.checkpointed = checkpointed  # The sequence number the main file is up to
+        self.failures = 0  # How many checkpoints the thread has had fail
+        self.error = None  # The exception of the last one that failed
+        self.running = threading.Lock()  # Only one checkpoint at a time
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="checkpointer " + path, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def load(path):
+        """
+        Loads the database from its main file
+        :param path: The path of the main database file
+        :return: The Database, or None if there is no main file
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+    def poke(self):
+        """
+        Wakes the thread up if the log has grown past the threshold
+        """
+        if self.wal.size() >= self.threshold:
+            self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.checkpoint()
+            except Exception as e:  # The thread has to outlive it, or the log would grow without bound
+                self.failures += 1
+                self.error = e
+
+    def checkpoint(self):
+        """
+        Writes the latest committed database to the main file and drops the log records it covers.
+        Committed snapshots are never changed once they're published, so readers and writers keep going
+        while it's written
+        :return: A tuple of 0, the records in the log before and the records folded into the main file
+        """
+        with self.running:
+            database = self.snapshot()
+            seq = database.log_seq
+            before = len(self.wal.ends)
+            if seq <= self.checkpointed:
+                return 0, before, 0
+
+            with open(self.path + "-checkpoint", "wb") as file:
+                pickle.dump(database, file, pickle.HIGHEST_PROTOCOL)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(self.path + "-checkpoint", self.path)
+
+            self.checkpointed = seq
+            return 0, before, self.wal.truncate(seq)
@@ -1,38 +1,124 @@
 """
 This class represents a single connection to a database
 """
-from copy import deepcopy
+import functools
+import threading
+import time
+import metrics
 from Database import Database
-from tokenizer import tokenize
-from Errors import CommandError, QueryError, TransactionError
+from WriteAheadLog import WriteAheadLog
+from Checkpointer import Checkpointer
+from Replica import Replica
+from ResultCache import ResultCache
+from ChangeFeed import ChangeFeed
+from tokenizer import tokenize, split_statements
+from Errors import CommandError, QueryError, TransactionError, MemoryLimitError
 
 """Global Variables"""
 _ALL_DATABASES = {}
 _LOCKS = {}
+_TABLE_LOCKS = {}  # The shared and reserved locks on each table of each database
+_PUBLISHING = threading.Lock()  # Commits are logged and swapped in one at a time, so the log is in commit order
+_LOGS = {}  # The write-ahead log of each database that has one
+_CHECKPOINTERS = {}  # The checkpointer of each database that has a log
+_REPLICAS = {}  # The replica publisher of each database that has one
+_FEEDS = {}  # The change feed of each database someone is listening to
+_FEED_HISTORY = 65536  # How many changes a feed keeps for consumers pulling them
+_MEMORY_CHECKS = {}  # The rows and estimated bytes of each database with a memory limit when it was last estimated
+_MEMORY_REGROWTH = 0.1  # The fraction the rows can grow by before the memory is estimated again
+_OPTIMISTIC = {}  # The generation each running optimistic transaction of each database began at, by connection
+_HISTORY = {}  # The commits of each database since its oldest running optimistic transaction began
+_TRANSACTION_CONTROL = ["BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE"]
+_COLLATION_CACHE_SIZE = 65536
+_LOGGED = ["INSERT", "UPDATE", "DELETE", "CREATE", "DROP", "SAVEPOINT", "RELEASE", "ROLLBACK"]
 
 
 class Connection(object):
-    def __init__(self, filename, timeout, isolation_level):
+    def __init__(self, filename, timeout, isolation_level, memory_budget=None, journal_mode=None,
+                 synchronous="FULL", checkpoint_threshold=4194304, checkpoint_interval=None,
+                 result_cache=None, memory_limit=None, replica=None):
         """
-        Takes a filename, but doesn't do anything with it.
+        Takes a filename, which is only used for the main database file and write-ahead log if there is one
+        :param memory_budget: The bytes a sort may hold in memory before spilling to disk, None for no limit
+        :param journal_mode: "WAL" to log every committed transaction to filename-wal, checkpoint the log
+        into filename in the background and recover from both when the database is first connected to,
+        None to keep the database in memory only
+        :param synchronous: The sync mode of the log, "OFF", "NORMAL" or "FULL"
+        :param checkpoint_threshold: The size of the log in bytes that triggers a checkpoint
+        :param checkpoint_interval: The most seconds between checkpoints, or None to only go by size
+        :param result_cache: The bytes of SELECT results to cache until the tables they read change, None
+        to not cache
+        :param memory_limit: The estimated bytes the database, the connections' copies of it and their result
+        caches may take up, checked as transactions commit.  Going over it clears the caches, and if that
+        isn't enough the commit fails with a MemoryLimitError.  None for no limit
+        :param replica: The path of a file to publish the committed database to after every commit, for
+        ReplicaConnections in other processes to read, or None.  One database publishes to one file
         """
         self.filename = filename  # The filename of the database
         self.timeout = timeout
         self.isolation_level = isolation_level
+        self.memory_budget = memory_budget
         self.database = None
-
-        # Creates or connects to a database
-        if filename not in _ALL_DATABASES:  # Create a database
-            _ALL_DATABASES[filename] = Database(filename)
-            _LOCKS[filename] = {"S": 0, "R": 0, "E": 0}
+        self.wal = None
+        self.checkpointer = None
+        self.replica = None
+        self.cache = None if result_cache is None else ResultCache(result_cache)
+        self.memory_limit = memory_limit
+        self.statements = []  # The statements of the current transaction, for the log
 
         # The data for transaction
         self.auto_commit = True
+        self.savepoint_transaction = False  # Was the transaction started by a SAVEPOINT
         self.modified = False
         self.mode = "D"
         self.shared = False
         self.reserved = False
         self.exclusive = False
+        self.table_locks = {}  # The lock held on each table, "S" or "R", when not holding one on the database
+        self.written = set()  # The tables and views the transaction changed, created or dropped
+        self.start = None  # The generation of the database an optimistic transaction began at
+        self.lock_times = {}  # When each lock held was taken, for the metrics
+        self.lock_waits = {}  # When each lock was first refused, for the metrics
+        metrics.register(self)
+
+        # Creates or connects to a database
+        if filename not in _ALL_DATABASES:  # Create a database
+            database = Checkpointer.load(filename) if journal_mode == "WAL" else None
+            _ALL_DATABASES[filename] = Database(filename) if database is None else database
+            _LOCKS[filename] = {"S": 0, "R": 0, "E": 0}
+            _TABLE_LOCKS[filename] = {}
+            if journal_mode == "WAL":
+                self.recover()
+
+        if journal_mode == "WAL":
+            if filename not in _LOGS:
+                checkpointed = _ALL_DATABASES[filename].log_seq
+                _LOGS[filename] = WriteAheadLog(filename + "-wal", synchronous, checkpointed)
+                _ALL_DATABASES[filename].log_seq = _LOGS[filename].written
+                _CHECKPOINTERS[filename] = Checkpointer(filename, _LOGS[filename], functools.partial(
+                    _ALL_DATABASES.get, filename), checkpoint_threshold, checkpoint_interval, checkpointed)
+            self.wal = _LOGS[filename]
+            self.checkpointer = _CHECKPOINTERS[filename]
+
+        if replica is not None:
+            if filename not in _REPLICAS:
+                _REPLICAS[filename] = Replica(replica, functools.partial(_ALL_DATABASES.get, filename))
+                _REPLICAS[filename].poke()  # Readers can attach before the first commit
+            self.replica = _REPLICAS[filename]
+
+    def recover(self):
+        """
+        Rebuilds the database by replaying the transactions in its write-ahead log that came after the last
+        checkpoint
+        """
+        for record in WriteAheadLog.read(self.filename + "-wal", _ALL_DATABASES[self.filename].log_seq):
+            if len(record) == 1:  # A single statement is replayed on its own, like it was committed
+                self.execute(record[0])
+                continue
+            self.execute("BEGIN TRANSACTION;")
+            for statement in record:
+                self.execute(statement)
+            self.execute("COMMIT TRANSACTION;")
 
     def close(self):
         """
@@ -40,75 +126,152 @@ class Connection(object):
         """
         pass
 
-    def lockable(self, command):
+    def lockable(self, command, tables=()):
         """
         Sees if the element can be locked
         :param command: The type of the query we want to perform
+        :param tables: The tables the query reads or writes.  Outside of IMMEDIATE and EXCLUSIVE transactions
+        reads and writes only lock those tables, so writers to different tables don't get in each other's way,
+        while CREATE and DROP lock the whole database
         :return:
         """
 
+        # Optimistic transactions don't lock anything until they commit
+        if self.start is not None:
+            if command == "CREATE" or command == "DROP":
+                raise TransactionError("CREATE and DROP cannot run in an OPTIMISTIC transaction")
+            elif command == "UPDATE" or command == "INSERT" or command == "DELETE":
+                self.modified = True
+                self.written.update(tables)
+
         # Aight so what locks do we need to read
-        if command == "SELECT":
+        elif command == "SELECT":
             if not self.exclusive and _LOCKS[self.filename]["E"] > 0:
-                self.unlock()
+                self.refuse("S")
                 raise TransactionError("Exclusive lock cannot be granted for {}".format(self.filename))
-            if not self.shared and not self.reserved:
-                _LOCKS[self.filename]["S"] += 1
-                self.shared = True
+            if not self.shared and not self.reserved and not self.exclusive:
+                for table in tables:
+                    self.lock_table(table, "S")
 
         # Aight so what locks do we need to write
         elif command == "UPDATE" or command == "INSERT" or command == "DELETE":
             self.modified = True
 
             if not self.exclusive and _LOCKS[self.filename]["E"] > 0:
-                self.unlock()
+                self.refuse("R")
                 raise TransactionError("Exclusive lock cannot be granted for {}".format(self.filename))
 
-            # Is there another reserved lock or exclusive lock on the database?
-            if not self.reserved:
-                if _LOCKS[self.filename]["R"] == 0:  # We can get the shared lock
-                    if self.shared:  # Get rid of the current shared lock
-                        self.shared = False
-                        _LOCKS[self.filename]["S"] -= 1
-                    self.reserved = True
-                    _LOCKS[self.filename]["R"] += 1
-                else:  # Someone else has the shared lock
-                    self.unlock()
+            # Is there a reserved lock on the whole database, or on the table from another writer?
+            if not self.reserved and not self.exclusive:
+                if _LOCKS[self.filename]["R"] > 0:
+                    self.refuse("R")
                     raise TransactionError("Reserved lock cannot be granted for {}".format(self.filename))
+                for table in tables:
+                    self.lock_table(table, "R")
+            self.written.update(tables)
+
+        # Changing what tables there are needs the whole database
+        elif command == "CREATE" or command == "DROP":
+            self.modified = True
 
-    def can_be_reserved(self):
+            if not self.exclusive and _LOCKS[self.filename]["E"] > 0:
+                self.refuse("R")
+                raise TransactionError("Exclusive lock cannot be granted for {}".format(self.filename))
+            if not self.reserved and not self.exclusive:
+                if _LOCKS[self.filename]["R"] > 0 or self.others("R") > 0:
+                    self.refuse("R")
+                    raise TransactionError("Reserved lock cannot be granted for {}".format(self.filename))
+                self.unlock_tables()  # The database lock covers them
+                self.reserved = True
+                _LOCKS[self.filename]["R"] += 1
+                if metrics.ENABLED:
+                    metrics.acquired(self, "R")
+            self.written.update(tables)
+
+    def lock_table(self, table, level):
+        """
+        Takes the shared or reserved lock on a single table, trading in a shared lock for a reserved one
+        :param table: The name of the table
+        :param level: "S" or "R"
+        """
+        locks = _TABLE_LOCKS[self.filename].setdefault(table, {"S": 0, "R": 0})
+        held = self.table_locks.get(table)
+        if held == "R" or held == level:
+            return
+        if level == "R" and locks["R"] > 0:  # Someone else is writing the table
+            self.refuse("R")
+            raise TransactionError("Reserved lock on {} cannot be granted for {}".format(table, self.filename))
+
+        if held == "S":
+            locks["S"] -= 1
+            if metrics.ENABLED:
+                metrics.released(self, "S", table)
+        locks[level] += 1
+        self.table_locks[table] = level
+        if metrics.ENABLED:
+            metrics.acquired(self, level, table)
+        if level == "R" and self.start is None:  # No one else can commit the table now, so catch up with them
+            self.database.refresh(table, _ALL_DATABASES[self.filename])
+
+    def others(self, level):
+        """
+        Counts the locks of a level other connections hold on the tables of the database
+        :param level: "S" or "R"
+        """
+        total = sum(locks[level] for locks in _TABLE_LOCKS[self.filename].values())
+        return total - sum(1 for held in self.table_locks.values() if held == level)
+
+    def can_be_reserved(self, level="R"):
         """
         Returns if a reserved lock can be grabbed for the connection
+        :param level: The lock being asked for, to record a refusal against
         """
         # If there is an exclusive lock on this element, GTFO
-        locking = _LOCKS[self.filename]["E"]
         if _LOCKS[self.filename]["E"] > 0 and not self.exclusive:
-            self.unlock()
+            self.refuse(level)
             raise TransactionError("Exclusive lock already exists on this element")
 
-        # Is there a reserved lock
-        if _LOCKS[self.filename]["R"] > 0:
-            if not self.reserved:
-                self.unlock()
-                raise TransactionError("Exclusive lock cannot be granted for {}".format(self.filename))
+        # Is there a reserved lock, on the database or any of its tables
+        if (_LOCKS[self.filename]["R"] > 0 and not self.reserved) or self.others("R") > 0:
+            self.refuse(level)
+            raise TransactionError("Exclusive lock cannot be granted for {}".format(self.filename))
 
     def can_be_exclusive(self):
         """
         Checks if an exclusive lock can be grabbed for the connection
         :return:
         """
-        self.can_be_reserved()
+        self.can_be_reserved("E")
 
         if _LOCKS[self.filename]["S"] > 0:   # Are there any shared locks
             if _LOCKS[self.filename]["S"] > 1 or not self.shared:
-                self.unlock()
+                self.refuse("E")
                 raise TransactionError("Exclusive lock cannot be granted for {}".format(self.filename))
+        if self.others("S") > 0:
+            self.refuse("E")
+            raise TransactionError("Exclusive lock cannot be granted for {}".format(self.filename))
+
+    def can_be_published(self):
+        """
+        Checks if the tables a transaction holding only table locks wrote can be swapped in.  It needs the
+        reserved lock on each of them, taking it again if a refused lock dropped it, and no one else reading them
+        """
+        for table in self.written:
+            self.lock_table(table, "R")
+        for table in self.written:
+            if _TABLE_LOCKS[self.filename][table]["S"] > 0:
+                self.refuse("E")
+                raise TransactionError("Exclusive lock on {} cannot be granted for {}".format(table, self.filename))
 
     def unlock(self):
         """
         UNlocks the elements of the database
         :return:
         """
+        if metrics.ENABLED:
+            for level, held in [("S", self.shared), ("R", self.reserved), ("E", self.exclusive)]:
+                if held:
+                    metrics.released(self, level)
         if self.shared:
             _LOCKS[self.filename]["S"] -= 1
             self.shared = False
@@ -118,65 +281,425 @@ class Connection(object):
         if self.exclusive:
             _LOCKS[self.filename]["E"] -= 1
             self.exclusive = False
+        self.unlock_tables()
+
+    def unlock_tables(self):
+        """
+        Releases the locks held on single tables
+        """
+        for table, level in self.table_locks.items():
+            _TABLE_LOCKS[self.filename][table][level] -= 1
+            if metrics.ENABLED:
+                metrics.released(self, level, table)
+        self.table_locks = {}
+
+    def refuse(self, level):
+        """
+        Drops every lock held after a lock couldn't be granted, so the transaction error can be raised
+        :param level: The lock that was refused
+        """
+        if metrics.ENABLED:
+            metrics.failed(self, level)
+        self.unlock()
+
+    def copy(self):
+        """
+        Gives the transaction its own copy of the database, recording its changes if anyone is listening.
+        The copy shares the tables until the transaction changes them
+        """
+        self.database = None  # The copy of the last transaction isn't needed anymore
+        self.statements = []  # Nor is anything left of it if its commit was refused
+        self.written = set()
+        self.modified = False
+        start = time.perf_counter() if metrics.ENABLED else None
+        self.database = _ALL_DATABASES[self.filename].snapshot()
+        if start is not None:
+            metrics.copied(self.filename, time.perf_counter() - start)
+        if self.filename in _FEEDS or len(_OPTIMISTIC.get(self.filename, ())) > 0:
+            self.database.capture([])
 
     def begin_deferred(self):
         """
         Begins a transaction and handles setting it up
         """
-        self.database = deepcopy(_ALL_DATABASES[self.filename])
+        self.copy()
 
     def begin_exclusive(self):
         """
         Begins a transaction and handles setting it up FOR ONLY EXCLUSIVE TRANSACTIONS
         """
-        self.database = deepcopy(_ALL_DATABASES[self.filename])
+        self.copy()
         self.can_be_exclusive()
         _LOCKS[self.filename]["E"] += 1
         self.exclusive = True
+        if metrics.ENABLED:
+            metrics.acquired(self, "E")
+
+    def begin_optimistic(self):
+        """
+        Begins a transaction that takes no locks while it runs.  What it read and wrote is checked against
+        the transactions that committed in the meantime once it commits
+        """
+        with _PUBLISHING:  # So every commit after the copy is taken makes it into the history
+            self.copy()
+            self.start = self.database.generation
+            _OPTIMISTIC.setdefault(self.filename, {})[self] = self.start
+        if self.database.changes is None:  # The other optimistic transactions check against our changes
+            self.database.capture([])
+        self.database.predicates = []
+        self.database.writes = []
+
+    def end_optimistic(self):
+        """
+        Stops counting an optimistic transaction as running, forgetting the commits no one needs to check
+        against anymore
+        """
+        if self.start is None:
+            return
+        with _PUBLISHING:
+            running = _OPTIMISTIC[self.filename]
+            del running[self]
+            if len(running) == 0:
+                _HISTORY.pop(self.filename, None)
+            elif self.filename in _HISTORY:
+                oldest = min(running.values())
+                _HISTORY[self.filename] = [entry for entry in _HISTORY[self.filename] if entry[0] > oldest]
+        self.start = None
 
     def begin_immediate(self):
         """
         Begins a transaction and handles setting it up FOR ONLY IMMEDIATE TRANSACTIONS
         """
-        self.database = deepcopy(_ALL_DATABASES[self.filename])
+        self.copy()
         self.can_be_reserved()
         _LOCKS[self.filename]["R"] += 1
         self.reserved = True
+        if metrics.ENABLED:
+            metrics.acquired(self, "R")
 
-    def commit(self, command):
+    def commit(self):
         """
         Commits a transaction and releases all of the locks it currently holds
         """
-        # Only required to handle DML inside transactions for locking for this project
-        if command == "CREATE" or command == "DROP":
-            _ALL_DATABASES[self.filename] = deepcopy(self.database)
-            return
+        start = time.perf_counter() if metrics.ENABLED else None
+        if self.database is not None:
+            self.database.clear_savepoints()
+        self.savepoint_transaction = False
 
-        # This transaction did not modify the database so we should just remove its shared lock if it has one
+        # This transaction did not modify the database so we should just remove its shared locks if it has any
         if not self.modified:
-            if self.shared:
-                _LOCKS[self.filename]["S"] -= 1
-                self.shared = False
-            if self.reserved:
-                _LOCKS[self.filename]["R"] -= 1
-                self.reserved = False
-            if self.exclusive:
-                _LOCKS[self.filename]["E"] -= 1
-                self.exclusive = False
+            self.statements = []
+            self.written = set()
+            self.unlock()
+            self.end_optimistic()
+            if start is not None and self.database is not None:  # Not what's left of a rollback
+                metrics.committed(self.filename, "read", time.perf_counter() - start)
             return
 
-        # This transaction did modify the database so let's try to commit it
-        self.can_be_exclusive()
-        _ALL_DATABASES[self.filename] = deepcopy(self.database)
+        if self.start is not None:
+            self.commit_optimistic(start)
+            return
 
-        # Clear up the locks for other transactions to use
+        # This transaction did modify the database so let's try to commit it.  Passing the check is getting the
+        # exclusive lock, on the whole database or just the tables it wrote, for as long as publishing takes
+        if self.reserved or self.exclusive:
+            self.can_be_exclusive()
+        else:
+            self.can_be_published()
+        self.check_memory()
+        upgraded = start is not None and not self.exclusive
+        if upgraded:
+            metrics.acquired(self, "E")
+        statements = self.statements
+        self.statements = []
+        with _PUBLISHING:
+            seq = self.log(statements)
+            changes = self.publish(seq)
+        self.written = set()
+        if upgraded:
+            metrics.released(self, "E")
+
+        # Clear up the locks for other transactions to use, then wait for the log to reach the disk
         self.unlock()
+        self.sync(seq)
+        self.emit(changes)
+        if self.replica is not None:
+            self.replica.poke()
+        if start is not None:
+            metrics.committed(self.filename, "write", time.perf_counter() - start)
+
+    def commit_optimistic(self, start):
+        """
+        Commits an optimistic transaction.  It only needs the locks a deferred transaction needs to publish
+        the tables it wrote, and none of the transactions that committed since it began to have
+        changed a row it read.  Its writes to tables they changed are run again on top of their changes, so
+        writes to different rows of the same table don't conflict.  If there is a conflict the transaction
+        is rolled back
+        :param start: When the commit started, for the metrics, or None
+        """
+        if _LOCKS[self.filename]["R"] > 0 or _LOCKS[self.filename]["E"] > 0:
+            self.refuse("E")
+            raise TransactionError("Exclusive lock cannot be granted for {}".format(self.filename))
+        self.can_be_published()
+        self.check_memory()
+
+        statements = self.statements
+        try:
+            with _PUBLISHING:
+                stale = self.validate()
+                if len(stale) > 0:
+                    self.replay(stale)
+                seq = self.log(statements)
+                changes = self.publish(seq)
+        except TransactionError:
+            self.unlock()
+            self.rollback()
+            self.auto_commit = True
+            self.modified = False
+            raise
+        self.statements = []
+        self.written = set()
+        self.unlock()
+        self.end_optimistic()
+        self.sync(seq)
+        self.emit(changes)
+        if self.replica is not None:
+            self.replica.poke()
+        if start is not None:
+            metrics.committed(self.filename, "write", time.perf_counter() - start)
+
+    def validate(self):
+        """
+        Checks an optimistic transaction's reads against the changes committed since it began
+        :return: The set of tables it wrote that others committed to in the meantime
+        """
+        database = _ALL_DATABASES[self.filename]
+        stale = set()
+        for generation, images in _HISTORY.get(self.filename, []):
+            if generation <= self.start:
+                continue
+            stale.update(name for name in images if name in self.written)
+            for name, where in self.database.predicates:
+                if name not in images:
+                    continue
+                table = database.tables.get(name)
+                if images[name] is None or where is None or not hasattr(table, "touches") or \
+                        table.touches(where, images[name]):
+                    raise TransactionError("Optimistic transaction read {} after another transaction changed "
+                                           "it".format(name))
+        return stale
+
+    def replay(self, stale):
+        """
+        Runs an optimistic transaction's writes to some tables again on their committed versions
+        :param stale: The names of the tables
+        """
+        database = self.database
+        database.predicates = None
+        for name in stale:
+            if name not in _ALL_DATABASES[self.filename].tables:
+                raise TransactionError("Optimistic transaction wrote {} after another transaction dropped "
+                                       "it".format(name))
+            database.owned.discard(name)
+            database.refresh(name, _ALL_DATABASES[self.filename])
+        if database.changes is not None:
+            database.changes[:] = [change for change in database.changes if change[1] not in stale]
+
+        for statement in database.writes:
+            tokens = tokenize(statement)
+            if Connection.targets(tokens)[0] not in stale:
+                continue
+            try:
+                if tokens[0] == "INSERT":
+                    database.insert_prep(tokens)
+                elif tokens[0] == "UPDATE":
+                    database.update_prep(tokens)
+                else:
+                    database.delete_prep(tokens)
+            except Exception as e:
+                raise TransactionError("Optimistic transaction conflicts with another transaction: {}".format(e))
+
+    def publish(self, seq):
+        """
+        Swaps the tables the transaction changed, created or dropped into the committed database.  The rest
+        are left as they are, so transactions writing different tables keep each other's commits
+        :param seq: The sequence number of its log record, or None if nothing was logged
+        :return: The row images of the transaction's changes, or None if they weren't recorded
+        """
+        changes = self.database.changes
+        start = time.perf_counter() if metrics.ENABLED else None
+        database = _ALL_DATABASES[self.filename].merge(self.database, self.written)
+        if start is not None:
+            metrics.copied(self.filename, time.perf_counter() - start)
+        if seq is not None:  # So a checkpoint knows which records the copy holds
+            database.log_seq = seq
+        _ALL_DATABASES[self.filename] = database
+        if len(_OPTIMISTIC.get(self.filename, ())) > 0:  # Running optimistic transactions check against it
+            _HISTORY.setdefault(self.filename, []).append((database.generation, Connection.images(
+                self.written, changes)))
+        return changes
+
+    @staticmethod
+    def images(written, changes):
+        """
+        Groups the row images of a commit by table
+        :param written: The tables and views the commit changed, created or dropped
+        :param changes: The row images of its changes, or None if they weren't recorded
+        :return: The dict of the list of old and new rows of each table, None for the tables whose rows
+        aren't known
+        """
+        images = {name: None if changes is None else [] for name in written}
+        if changes is not None:
+            for op, table, old, new in changes:
+                if images.get(table) is not None:
+                    images[table] += [row for row in (old, new) if row is not None]
+        return images
+
+    def emit(self, changes):
+        """
+        Hands the changes of a committed transaction to the change feed
+        :param changes: The row images from publish
+        """
+        if changes is not None and len(changes) > 0 and self.filename in _FEEDS:
+            _FEEDS[self.filename].emit(changes)
+
+    def log(self, statements):
+        """
+        Writes the statements of a transaction that is committing to the write-ahead log
+        :param statements: The statements of the transaction
+        :return: The sequence number of its record, or None if nothing was logged
+        """
+        if self.wal is None or len(statements) == 0:
+            return None
+        return self.wal.write(statements)
+
+    def sync(self, seq):
+        """
+        Waits for a logged transaction to be durable, sharing the fsync with any other commits waiting
+        :param seq: The sequence number from log
+        """
+        if seq is not None:
+            self.wal.sync(seq)
+            self.checkpointer.poke()
+
+    def feed(self):
+        """
+        Gets the change feed of the database, starting one if no one was listening yet.  Only transactions
+        that start after that are recorded
+        """
+        if self.filename not in _FEEDS:
+            _FEEDS[self.filename] = ChangeFeed(_FEED_HISTORY)
+        return _FEEDS[self.filename]
+
+    def subscribe(self, table, callback):
+        """
+        Calls a function with each row change to a table once it's committed.  Changes are tuples of the
+        sequence number, "INSERT", "UPDATE" or "DELETE", the table name, the old row and the new row, with
+        None for the row that doesn't exist.  Rolled back changes are never sent
+        :param table: The name of the table, or None for every table
+        :param callback: The function taking the change, called on a committing thread once the commit is done
+        """
+        self.feed().subscribe(table, callback)
+
+    def unsubscribe(self, table, callback):
+        self.feed().unsubscribe(table, callback)
+
+    def changes(self, since=0, table=None):
+        """
+        Pulls the row changes committed after a sequence number, in the same form subscribe sends them
+        :param since: The sequence number of the last change already processed
+        :param table: The name of the table, or None for every table
+        :return: An iterator over the changes
+        """
+        return iter(self.feed().since(since, table))
+
+    def memory_stats(self):
+        """
+        Estimates the memory the database takes up, along with the tables every connection's transaction
+        has copied and their result caches.  A connection keeps the copy of its last transaction until its
+        next one
+        :return: The dict of the committed database's usage from Database.memory_usage, the bytes of each
+        copy by the id of its connection, the bytes of the result caches and the total
+        """
+        database = _ALL_DATABASES[self.filename].memory_usage()
+        connections = metrics.connections(self.filename)
+        snapshots = {id(conn): conn.database.memory_usage(False, conn.database.owned)["bytes"]
+                     for conn in connections if conn.database is not None}
+        caches = sum(conn.cache.size for conn in connections if conn.cache is not None)
+        return {"database": database, "snapshots": snapshots, "result_caches": caches,
+                "bytes": database["bytes"] + sum(snapshots.values()) + caches}
+
+    def check_memory(self):
+        """
+        Makes sure the database and the transactions' copies of its tables are under the memory limit before
+        a commit, clearing the caches first if they aren't.  Estimating walks every table, so it's only done
+        again once the rows have grown by a tenth since the last estimate or that one was near the limit
+        """
+        if self.memory_limit is None:
+            return
+        owned = [] if self.database is None else [self.database.tables[name] for name in self.database.owned
+                                                  if hasattr(self.database.tables.get(name), "table")]
+        rows = sum(len(table.table) for table in _ALL_DATABASES[self.filename].tables.values()
+                   if hasattr(table, "table")) + sum(len(table.table) for table in owned)
+        last = _MEMORY_CHECKS.get(self.filename)
+        if last is not None and rows <= last[0] * (1 + _MEMORY_REGROWTH) and \
+                last[1] <= self.memory_limit * (1 - _MEMORY_REGROWTH):
+            return
+
+        stats = self.memory_stats()
+        _MEMORY_CHECKS[self.filename] = (rows, stats["bytes"])
+        if stats["bytes"] <= self.memory_limit:
+            return
+
+        for conn in metrics.connections(self.filename):
+            if conn.cache is not None:
+                conn.cache.clear()
+        for table in owned:  # The NumPy arrays and zone maps of the tables we copied are built again if needed
+            table.vectors.clear()
+            table.zones.clear()
+        stats = self.memory_stats()
+        _MEMORY_CHECKS[self.filename] = (rows, stats["bytes"])
+        if stats["bytes"] > self.memory_limit:
+            self.unlock()
+            raise MemoryLimitError("{} takes up about {} bytes, over its memory limit of {}".format(
+                self.filename, stats["bytes"], self.memory_limit))
+
+    def metrics(self):
+        """
+        Gets the lock and transaction metrics of the database, once they're turned on with metrics.enable()
+        :return: The dict from metrics.snapshot for this database
+        """
+        return metrics.snapshot(self.filename)[self.filename]
 
     def rollback(self):
         """
         If the user wants to rollback a table
         """
+        if metrics.ENABLED:
+            metrics.rolled_back(self.filename)
         self.database = None
+        self.savepoint_transaction = False
+        self.statements = []
+        self.written = set()
+        self.end_optimistic()
+
+    @staticmethod
+    def targets(tokens):
+        """
+        Gets the table or view a statement writes, creates or drops
+        :param tokens: The list of tokens of the statement
+        :return: The list holding its name, or an empty list if the statement doesn't write
+        """
+        if tokens[0] == "INSERT" and "INTO" in tokens:
+            return [tokens[tokens.index("INTO") + 1]]
+        elif tokens[0] == "UPDATE":
+            return [tokens[1]]
+        elif tokens[0] == "DELETE" or tokens[0] == "CREATE" or tokens[0] == "DROP":
+            i = 2
+            while i < len(tokens) - 1 and tokens[i] in ("IF", "NOT", "EXISTS"):
+                i += 1
+            return [tokens[i]]
+        return []
 
     def execute(self, statement):
         """
@@ -189,9 +712,21 @@ class Connection(object):
         if tokens[-1] != ";":
             raise QueryError("Query missing ';' at the end")
 
+        # A cached SELECT only needs the versions of the tables, so it skips copying the database
+        if self.cache is not None and tokens[0] == "SELECT" and self.start is None and ResultCache.cacheable(tokens):
+            tables = (_ALL_DATABASES[self.filename] if self.auto_commit else self.database).tables
+            result = self.cache.get(tokens, tables)
+            if result is not None:
+                if not self.auto_commit:
+                    self.lockable(tokens[0], self.cache.reads(tokens))
+                elif _LOCKS[self.filename]["E"] > 0:
+                    raise TransactionError("Exclusive lock cannot be granted for {}".format(self.filename))
+                return result
+
         if self.auto_commit:  # If we are in autocommit mode, write to the database
             self.begin_deferred()
-        self.lockable(tokens[0])
+        self.database.sort_budget = self.memory_budget
+        self.lockable(tokens[0], Connection.targets(tokens))
 
         # Handles transaction processing #
 
@@ -211,15 +746,28 @@ class Connection(object):
                 self.mode = "E"
                 self.auto_commit = False
                 self.begin_exclusive()
+            elif tokens[1] + " " + tokens[2] == "OPTIMISTIC TRANSACTION":
+                self.mode = "O"
+                self.auto_commit = False
+                self.begin_optimistic()
 
         elif tokens[0] + " " + tokens[1] == "COMMIT TRANSACTION":
             if self.auto_commit:  # Were we currently in a transaction??
                 self.unlock()
                 raise TransactionError("Tried to commit a non-existent transaction")
-            self.commit(tokens[0])
+            self.commit()
             self.modified = False
             self.auto_commit = True
 
+        elif tokens[0] == "ROLLBACK" and "TO" in tokens[1:3]:
+            name = tokens[tokens.index("TO") + 1]
+            if name == "SAVEPOINT":
+                name = tokens[tokens.index("TO") + 2]
+            if self.auto_commit:  # Were we currently in a transaction??
+                self.unlock()
+                raise TransactionError("No such savepoint: {}".format(name))
+            self.database.rollback_to(name)
+
         elif tokens[0] + " " + tokens[1] == "ROLLBACK TRANSACTION":
             if self.auto_commit:  # Were we currently in a transaction??
                 self.unlock()
@@ -228,6 +776,48 @@ class Connection(object):
             self.modified = False
             self.auto_commit = True
 
+        # Handles savepoint processing #
+
+        elif tokens[0] == "SAVEPOINT":
+            if self.auto_commit:  # A savepoint outside of a transaction starts a deferred one
+                self.mode = "D"
+                self.auto_commit = False
+                self.savepoint_transaction = True
+            self.database.savepoint(tokens[1])
+
+        elif tokens[0] == "RELEASE":
+            name = tokens[2] if tokens[1] == "SAVEPOINT" else tokens[1]
+            if self.auto_commit:  # Were we currently in a transaction??
+                self.unlock()
+                raise TransactionError("No such savepoint: {}".format(name))
+            self.database.release(name)
+
+            # Releasing the outermost savepoint commits the transaction it started
+            if self.savepoint_transaction and len(self.database.savepoints) == 0:
+                self.auto_commit = True
+
+        elif tokens[0] + " " + tokens[1] == "PRAGMA checkpoint":
+            if self.checkpointer is None:
+                raise CommandError("PRAGMA checkpoint needs journal_mode WAL")
+            result = [self.checkpointer.checkpoint()]
+
+        elif tokens[0] + " " + tokens[1] == "PRAGMA replica":  # Publishes now instead of in the background
+            if self.replica is None:
+                raise CommandError("PRAGMA replica needs a replica file")
+            result = [(self.replica.publish(),)]
+
+        elif tokens[0] + " " + tokens[1] == "PRAGMA memory_stats":
+            stats = self.memory_stats()
+            result = []
+            for name, usage in stats["database"]["tables"].items():
+                result.append(("table", name, None, usage["bytes"]))
+                result.extend(("column", name, col, size) for col, size in usage["columns"].items())
+                result.extend(("index", name, col, size) for col, size in usage["indexes"].items())
+                result.append(("cache", name, None, usage["caches"]))
+            result.extend(("snapshot", None, None, size) for size in stats["snapshots"].values())
+            result.append(("result_cache", None, None, stats["result_caches"]))
+            result.append(("total", None, None, stats["bytes"]))
+
         # Handles DDL processing #
 
         elif tokens[0] + " " + tokens[1] == "CREATE TABLE":
@@ -249,11 +839,20 @@ class Connection(object):
 
         # Handles DML processing #
 
-        elif tokens[0] + " " + tokens[1] == "INSERT INTO":
+        elif tokens[0] + " " + tokens[1] == "INSERT INTO" or tokens[0] + " " + tokens[1] == "INSERT OR":
             self.database.insert_prep(tokens)
 
-        elif tokens[0] == "SELECT":
-            result = self.database.select_prep(tokens)
+        elif tokens[0] == "SELECT":  # The tables it reads are locked once it's run and they're known
+            self.database.reads = {}
+            try:
+                result = self.database.select_prep(tokens)
+                if self.cache is not None and ResultCache.cacheable(tokens):
+                    result = list(result)
+                    self.cache.put(tokens, self.database.reads, result)
+                reads = list(self.database.reads)
+            finally:
+                self.database.reads = None
+            self.lockable(tokens[0], reads)
 
         elif tokens[0] == "UPDATE" and tokens[2] == "SET":
             result = self.database.update_prep(tokens)
@@ -264,9 +863,15 @@ class Connection(object):
         else:  # Command not recognized
             raise CommandError("Command not recognized")
 
+        # Remembers the statements that change the database, for the log
+        if self.wal is not None and tokens[0] in _LOGGED and (tokens[0] != "ROLLBACK" or "TO" in tokens[1:3]):
+            self.statements.append(statement)
+        if self.start is not None and tokens[0] in ("INSERT", "UPDATE", "DELETE"):
+            self.database.writes.append(statement)
+
         # If we are in autocommit mode, write to the database
         if self.auto_commit:
-            self.commit(tokens[0])
+            self.commit()
             self.modified = False
 
         return result
@@ -307,11 +912,51 @@ class Connection(object):
         start_statement = start_statement[:-2] + ";"
         self.execute(start_statement)
 
-    def create_collation(self, name, function):
+    def executescript(self, script):
+        """
+        Runs every statement of a script.  Unless the script begins and ends its own transactions, it's
+        run as one transaction, so the database is only copied, locked and committed once.  If a statement
+        or the commit fails the whole script is rolled back
+        :param script: The statements, each ending in ';'
+        """
+        statements = split_statements(script)
+        if not self.auto_commit or any(statement.split(None, 1)[0] in _TRANSACTION_CONTROL
+                                       for statement in statements):
+            for statement in statements:
+                self.execute(statement)
+            return
+
+        self.execute("BEGIN TRANSACTION;")
+        try:
+            for statement in statements:
+                self.execute(statement)
+            self.execute("COMMIT TRANSACTION;")
+        except Exception:
+            if not self.auto_commit:  # A refused commit leaves the transaction open too
+                self.execute("ROLLBACK TRANSACTION;")
+            raise
+
+    def create_collation(self, name, function, key=False, cache_size=_COLLATION_CACHE_SIZE):
         """
         Creates a sorting collation for the database
         :param name: the name of the collation
-        :param function: The function itself
+        :param function: The function itself, either a cmp-style function of two values or, with key, a
+        function of one value returning its sort key
+        :param key: Is the function a key function instead of a cmp-style one
+        :param cache_size: How many distinct sort keys a key function memoizes
         """
-        self.database.collations[name] = function
-        _ALL_DATABASES[self.filename] = deepcopy(self.database)
+        if key:  # Each distinct value only has its key computed once
+            collation = functools.lru_cache(maxsize=cache_size)(function)
+        else:
+            cmp_key = functools.cmp_to_key(function)
+
+            def collation(value):
+                return cmp_key(value)
+
+        # Registering a function doesn't change any data, so there's nothing to copy, but cached results
+        # might have sorted with a collation of the same name
+        if self.cache is not None:
+            self.cache.clear()
+        _ALL_DATABASES[self.filename].collations[name] = collation
+        if self.database is not None:
+            self.database.collations[name] = collation
@@ -1,9 +1,16 @@
 """
 This class represents the entire database, holding 0 or more tables, all with relations to one another
 """
-from Table import Table
+from Table import Table, VERSIONS
 from View import View
-from Errors import SQLTypeError, QueryError, TableError
+from Subquery import Subquery, Reference
+from Errors import SQLTypeError, QueryError, TableError, TransactionError
+from operators import union, is_sorted, hash_join, merge_join
+from operator import itemgetter
+from expressions import parse_expression, unparse
+from tokenizer import keyword_positions
+from copy import copy, deepcopy
+import memory
 _TYPES = ["INTEGER", "REAL", "TEXT"]
 
 
@@ -16,6 +23,135 @@ class Database:
         self.name = name  # The name of the database
         self.collations = {}
         self.tables = dict()  # All of the tables in the database
+        self.savepoints = []  # The open savepoints, each a tuple of its name and its spots in the undo log,
+        # changes and writes
+        self.undo_log = None  # The changes made since the first open savepoint
+        self.changes = None  # The row images of the changes made by the transaction, for the change feed
+        self.sort_budget = None  # The memory budget in bytes of the connection using the database, for sorting
+        self.log_seq = 0  # The sequence number of the last logged transaction this database holds
+        self.reads = None  # The version of each table and view the current query read, when it's being cached
+        self.owned = set()  # The tables a transaction's copy has copied or created, the rest are shared
+        self.generation = 0  # How many commits the database has been through
+        self.predicates = None  # The table and WHERE conditions of every read of an optimistic transaction
+        self.writes = None  # The INSERT, UPDATE and DELETE statements of an optimistic transaction, in order
+
+    def __getstate__(self):
+        """
+        Gets what is written to the main database file on a checkpoint.  Collations are functions that
+        might not pickle, and they're registered again by each connection anyway
+        """
+        state = dict(self.__dict__)
+        state["collations"] = {}
+        return state
+
+    def __setstate__(self, state):
+        """
+        Loads the database from the main database file.  The versions in it are from another run, so the
+        tables get new ones
+        """
+        self.__dict__.update(state)
+        self.owned = set()
+        self.__dict__.setdefault("generation", 0)
+        self.__dict__.setdefault("predicates", None)
+        self.__dict__.setdefault("writes", None)
+        for table in self.tables.values():
+            table.version = next(VERSIONS)
+
+    def snapshot(self):
+        """
+        Starts a transaction's copy of the committed database.  The tables are shared until the transaction
+        first changes them, so starting a transaction doesn't get slower with every table in the database
+        :return: The new Database
+        """
+        snapshot = Database.__new__(Database)
+        snapshot.__dict__.update(self.__dict__)
+        snapshot.collations = dict(self.collations)
+        snapshot.tables = dict(self.tables)
+        snapshot.savepoints = []
+        snapshot.owned = set()
+        snapshot.adopt_views()
+        return snapshot
+
+    def writable(self, name):
+        """
+        Gets a table to change, copying it first if it's still shared with the committed database
+        :param name: The name of the table
+        """
+        table = self.tables[name]
+        if name not in self.owned and isinstance(table, Table):
+            table = deepcopy(table)
+            table.undo_log = self.undo_log
+            table.changes = self.changes
+            self.tables[name] = table
+            self.owned.add(name)
+        return table
+
+    def adopt_views(self):
+        """
+        Gives the database its own copies of the views it shares with another, so they look at its tables
+        """
+        for name, table in list(self.tables.items()):
+            if isinstance(table, View) and table.database is not self:
+                table = copy(table)
+                table.database = self
+                self.tables[name] = table
+
+    def merge(self, database, names):
+        """
+        Makes a new committed database that is this one with some tables swapped for their versions in a
+        transaction's copy.  The other tables are shared, since a committed database is never changed
+        :param database: The transaction's copy of the database, which is done with once it's merged
+        :param names: The names of the tables and views the transaction changed, created or dropped
+        :return: The new Database
+        """
+        merged = Database.__new__(Database)
+        merged.__dict__.update(self.__dict__)
+        merged.collations = dict(self.collations)
+        merged.tables = dict(self.tables)
+        merged.generation = self.generation + 1
+        for name in names:
+            table = database.tables.get(name)
+            if table is None:
+                merged.tables.pop(name, None)
+            elif name in database.owned:  # Handed over as is, without the transaction's changes
+                table.undo_log = None
+                table.changes = None
+                merged.tables[name] = table
+            elif isinstance(table, View):
+                merged.tables[name] = table
+        merged.adopt_views()
+        return merged
+
+    def memory_usage(self, values=True, names=None):
+        """
+        Estimates the bytes each table, column and index of the database takes up
+        :param values: Count the values in the rows, which a transaction's copy shares with the original
+        :param names: The names of the tables to count, or None for all of them
+        :return: The dict from memory.database_usage
+        """
+        return memory.database_usage(self, values, names)
+
+    def read(self, name, where=None):
+        """
+        Remembers that the current query read a table or view, if the query is being cached or the
+        transaction is optimistic
+        :param name: The name of the table or view
+        :param where: The WHERE conditions the rows were read with, or None if it read all of them
+        """
+        if self.reads is not None:
+            self.reads[name] = self.tables[name].version
+        if self.predicates is not None:
+            self.predicates.append((name, where))
+
+    def refresh(self, name, database):
+        """
+        Swaps a table the transaction hasn't changed yet for its committed version, so its writes go on top
+        of whatever was committed since the copy was taken
+        :param name: The name of the table
+        :param database: The committed Database
+        """
+        if name not in self.owned and isinstance(database.tables.get(name), Table):
+            self.tables[name] = database.tables[name]
 
     def create_prep(self, tokens, exists):
         """
@@ -25,28 +161,53 @@ class Database:
         name = tokens[2]
         columns = list()
         default = {}
+        unique = []
+        primary_key = None
 
         # Gets the column names and their types
         i = 4
-        while tokens[i] != ";" and i < len(tokens):
+        while i < len(tokens) and tokens[i] != ";" and tokens[i - 1] != ")":
             if tokens[i + 1] not in _TYPES:  # Typing Error
                 raise SQLTypeError("Type '{}' not recognized by SQL".format(tokens[i + 1]))
             columns.append((tokens[i], tokens[i + 1]))
 
-            # Checks for default values
-            if tokens[i + 2] == "DEFAULT":
-                if tokens[i + 1] == "INTEGER":
-                    default[len(columns) - 1] = int(tokens[i + 3])
-                elif tokens[i + 1] == "TEXT":
-                    default[len(columns) - 1] = str(tokens[i + 4])
+            # Checks for default values and key constraints, in any order
+            i += 2
+            while i < len(tokens) and tokens[i] != "," and tokens[i] != ")":
+                if tokens[i] == "DEFAULT":
+                    if columns[-1][1] == "INTEGER":
+                        default[len(columns) - 1] = int(tokens[i + 1])
+                    elif columns[-1][1] == "TEXT":
+                        default[len(columns) - 1] = str(tokens[i + 2])
+                        i += 2
+                    elif columns[-1][1] == "REAL":
+                        default[len(columns) - 1] = float(tokens[i + 1])
                     i += 2
-                elif tokens[i + 1] == "REAL":
-                    default[len(columns) - 1] = float(tokens[i + 3])
-                i += 2
+                elif tokens[i] == "PRIMARY" and tokens[i + 1] == "KEY":
+                    if primary_key is not None:
+                        raise QueryError("Table {} has more than one primary key".format(name))
+                    primary_key = len(columns) - 1
+                    unique.append(primary_key)
+                    i += 2
+                elif tokens[i] == "UNIQUE":
+                    if len(columns) - 1 not in unique:
+                        unique.append(len(columns) - 1)
+                    i += 1
+                else:
+                    raise QueryError("Invalid column constraint. Stuck at token {}".format(tokens[i]))
+            i += 1
 
-            i += 3
+        # CLUSTERED BY (column) keeps the rows sorted on the column
+        cluster = None
+        if i + 1 < len(tokens) and tokens[i] + " " + tokens[i + 1] == "CLUSTERED BY":
+            if tokens[i + 2] != "(" or tokens[i + 4] != ")":
+                raise QueryError("CLUSTERED BY needs a single column in parentheses")
+            names = [col[0] for col in columns]
+            if tokens[i + 3] not in names:
+                raise QueryError("Can't cluster by non-existent column {}".format(tokens[i + 3]))
+            cluster = names.index(tokens[i + 3])
 
-        self.create(name, columns, exists, default)
+        self.create(name, columns, exists, default, unique, primary_key, cluster)
 
     def drop(self, tokens, exists):
         """
@@ -65,6 +226,13 @@ class Database:
         elif name not in self.tables.keys() and exists:
             return
         else:
+            owned = name in self.owned and isinstance(self.tables[name], Table)
+            if self.undo_log is not None:
+                self.undo_log.append(("DROP", name, self.tables[name]))
+                if owned:
+                    self.tables[name].undo_log = None
+            if owned:
+                self.tables[name].changes = None
             del self.tables[name]
 
     def insert_prep(self, tokens):
@@ -72,6 +240,14 @@ class Database:
         Prepares the tokens to be processed as an insert command
         :param tokens: The list of tokens to be processed
         """
+        # INSERT OR ABORT/IGNORE/REPLACE
+        action = "ABORT"
+        if tokens[1] == "OR":
+            if tokens[2] not in ("ABORT", "IGNORE", "REPLACE"):
+                raise QueryError("Invalid conflict resolution {}".format(tokens[2]))
+            action = tokens[2]
+            del tokens[1:3]
+
         name = tokens[2]
         values = list()
         columns_to_insert = list()
@@ -79,7 +255,7 @@ class Database:
 
         # Are we just inserting default values
         if tokens[3] + " " + tokens[4] == "DEFAULT VALUES":
-            self.insert(name, values, columns_to_insert, True)
+            self.insert(name, values, columns_to_insert, True, (action, None, []))
             return
 
         # Gets the columns to insert into
@@ -120,43 +296,53 @@ class Database:
             values.append(row)
             if i >= len(tokens):
                 raise QueryError("Can't find ')' to end INSERT statement")
+            on_conflict = (action, None, [])
+            if tokens[i] == "ON" and tokens[i + 1] == "CONFLICT":
+                i, on_conflict = self.process_on_conflict(tokens, i + 2)
             if tokens[i] != ";":
                 raise QueryError("Missing ',' separator in value list")
 
         else:
             raise QueryError("Can't perform INSERT statement")
 
-        self.insert(name, values, columns_to_insert, False)
+        self.insert(name, values, columns_to_insert, False, on_conflict)
+
+    def process_on_conflict(self, tokens, i):
+        """
+        Parses an upsert clause, ON CONFLICT [(column)] DO NOTHING or DO UPDATE SET ..., where the SET
+        expressions can use excluded.column for the row that couldn't be inserted
+        :param tokens: The list of tokens of the query
+        :param i: The index just past ON CONFLICT
+        :return: The index just past the clause and what to do on a conflict, as Table.insert takes it
+        """
+        target = None
+        if tokens[i] == "(":
+            if tokens[i + 2] != ")":
+                raise QueryError("ON CONFLICT target must be a single column")
+            target = tokens[i + 1]
+            i += 3
+        if tokens[i] != "DO":
+            raise QueryError("Missing DO in ON CONFLICT clause")
+        if tokens[i + 1] == "NOTHING":
+            return i + 2, ("IGNORE", target, [])
+        if tokens[i + 1] + " " + tokens[i + 2] != "UPDATE SET":
+            raise QueryError("ON CONFLICT must DO NOTHING or DO UPDATE SET")
+
+        columns_to_set = []
+        i = self.process_set(tokens, i + 3, columns_to_set)
+        return i, ("UPDATE", target, columns_to_set)
 
     def update_prep(self, tokens):
         """
         Updates a table with new values based ona where clause
         :param tokens: The list of tokens of the query
         """
-        i = 3
         colums_to_set = []
         where = []
-        name = tokens[i-2]
+        name = tokens[1]
 
         # Gets the columns to set
-        while i + 3 < len(tokens):
-            if tokens[i + 1] != "=":
-                raise QueryError("Invalid SET command.  Need '=' operator")
-            if tokens[i + 2] == "'":  # It's a string to set to
-                colums_to_set.append([tokens[i], tokens[i+3]])
-                i += 2
-            else:
-                colums_to_set.append([tokens[i], tokens[i+2]])
-            i += 3
-
-            if tokens[i] == ",":
-                i += 1
-            elif tokens[i] == ";" or tokens[i] == "WHERE":
-                break
-            else:
-                raise QueryError("Missing comma separator")
-        else:
-            raise QueryError("Missing ';' or 'WHERE' clause")
+        i = self.process_set(tokens, 3, colums_to_set)
 
         # Dealing with a WHERE clause
         if tokens[i] == "WHERE":
@@ -169,6 +355,33 @@ class Database:
 
         self.update(name, where, colums_to_set)
 
+    def process_set(self, tokens, i, columns_to_set):
+        """
+        Parses the assignments of a SET clause
+        :param tokens: The list of tokens of the query
+        :param i: The index of the first assignment
+        :param columns_to_set: The list each column and its expression tree are appended to
+        :return: The index of the ';' or WHERE ending the clause
+        """
+        while i + 3 < len(tokens):
+            if tokens[i + 1] != "=":
+                raise QueryError("Invalid SET command.  Need '=' operator")
+            value, j = parse_expression(tokens, i + 2)
+            columns_to_set.append([tokens[i], value])
+            i = j
+
+            if i >= len(tokens):
+                break
+            elif tokens[i] == ",":
+                i += 1
+            elif tokens[i] == ";" or tokens[i] == "WHERE":
+                break
+            else:
+                raise QueryError("Missing comma separator")
+        else:
+            raise QueryError("Missing ';' or 'WHERE' clause")
+        return i
+
     def delete_prep(self, tokens):
         """
         Deletes rows based on a where clause
@@ -197,6 +410,16 @@ class Database:
         Prepares the tokens to be processed as an select command
         :param tokens: The list of tokens to be processed
         """
+        if len(keyword_positions(tokens, "UNION")) > 0:
+            return self.compound_select_prep(tokens)
+        return self.run_select(self.parse_select(tokens))
+
+    def parse_select(self, tokens):
+        """
+        Parses the tokens of a single SELECT into its plan
+        :param tokens: The list of tokens to be processed
+        :return: A dict holding each clause of the query
+        """
         columns_to_get = list()
         order_by = list()
         collations = list()
@@ -213,30 +436,45 @@ class Database:
             if tokens[i] == ",":
                 i += 1
                 continue
-            if (tokens[i] == "max" or tokens[i] == "min") and tokens[i+1] == "(" and tokens[i+3] == ")":
+            if tokens[i] in ("max", "min", "sum", "approx_count_distinct") and tokens[i+1] == "(" and \
+                    tokens[i+3] == ")":
                 columns_to_get.append(tokens[i+2])
                 aggregates.append(tokens[i])
-                i += 3
-            elif tokens[i+1] == "," or tokens[i+1] == "FROM":  # preceded by a comma or FROM is next
+                i += 4
+            elif tokens[i] == "approx_quantile" and tokens[i+1] == "(" and tokens[i+3] == "," and \
+                    tokens[i+5] == ")":  # approx_quantile(col, q)
+                if not isinstance(tokens[i+4], (int, float)) or not 0 <= tokens[i+4] <= 1:
+                    raise QueryError("The quantile of approx_quantile must be a number from 0 to 1")
+                columns_to_get.append(tokens[i+2])
+                aggregates.append(("approx_quantile", tokens[i+4]))
+                i += 6
+            elif tokens[i] == "*" or (isinstance(tokens[i], str) and tokens[i].endswith(".*")):
                 columns_to_get.append(tokens[i])
                 aggregates.append(None)
-            else:
-                raise QueryError("Missing comma separator")
-            i += 1
+                i += 1
+            else:  # A column or an expression
+                node, i = parse_expression(tokens, i)
+                columns_to_get.append(node[1] if node[0] == "COLUMN" else node)
+                aggregates.append(None)
             if i >= len(tokens):  # Never found a FROM
                 raise QueryError("'FROM' clause not found")
+            if tokens[i] != "," and tokens[i] != "FROM":  # followed by a comma or FROM is next
+                raise QueryError("Missing comma separator")
         i += 2
         name = tokens[i-1]
 
+        # TABLESAMPLE
+        sample = None
+        if i < len(tokens) and tokens[i] == "TABLESAMPLE":
+            sample, i = self.process_tablesample(tokens, i + 1)
+
         # Checks the next clause
-        jname = None
+        joins = []
         where = []
         while i < len(tokens):
-            # LEFT OUTER JOIN
-            if i + 2 < len(tokens) and tokens[i] + " " + tokens[i + 1] + " " + tokens[i + 2] == "LEFT OUTER JOIN":
-                i += 3
-                i, jname = self.process_left_outer_join(tokens, i, name)
-                name = jname
+            # [LEFT [OUTER] | INNER] JOIN
+            if tokens[i] in ("JOIN", "INNER", "LEFT"):
+                i = self.process_join(tokens, i, joins)
 
             # WHERE
             elif tokens[i] == "WHERE":
@@ -254,39 +492,249 @@ class Database:
             else:
                 raise QueryError("Invalid Query. Stuck at token {}".format(tokens[i]))
 
-        # Handles column from different table
-        ret_table = self.select(columns_to_get, name, order_by, distinct, where, collations, aggregates)
+        if sample is not None and len(joins) > 0:
+            raise QueryError("TABLESAMPLE can't be used with JOIN")
 
-        if jname is not None:
-            del self.tables[jname]
+        return {"columns": columns_to_get, "aggregates": aggregates, "distinct": distinct, "name": name,
+                "joins": joins, "where": where, "order_by": order_by, "collations": collations, "sample": sample}
 
-        return ret_table
+    def process_tablesample(self, tokens, i):
+        """
+        Parses BERNOULLI (percent) or SYSTEM (percent), optionally followed by REPEATABLE (seed)
+        :param tokens: The list of tokens to be processed
+        :param i: The index of the token after TABLESAMPLE
+        :return: The tuple of the method, percent and seed, and the index of the token after it
+        """
+        if tokens[i] not in ("BERNOULLI", "SYSTEM") or tokens[i+1] != "(" or tokens[i+3] != ")":
+            raise QueryError("TABLESAMPLE must be BERNOULLI (percent) or SYSTEM (percent)")
+        percent = tokens[i+2]
+        if not isinstance(percent, (int, float)) or not 0 <= percent <= 100:
+            raise QueryError("The percent of TABLESAMPLE must be a number from 0 to 100")
+        method = tokens[i]
+        i += 4
+
+        seed = None
+        if tokens[i] == "REPEATABLE":
+            if tokens[i+1] != "(" or not isinstance(tokens[i+2], int) or tokens[i+3] != ")":
+                raise QueryError("REPEATABLE must be given an integer seed")
+            seed = tokens[i+2]
+            i += 4
+        return (method, percent, seed), i
+
+    def run_select(self, plan):
+        """
+        Runs a parsed SELECT.  Selecting edits the lists it's given, so the plan gets copied first
+        :param plan: The plan from parse_select
+        :return: The selected rows
+        """
+        columns_to_get = list(plan["columns"])
+        order_by = list(plan["order_by"])
+        where = list(plan["where"])
+        collations = list(plan["collations"])
+        aggregates = list(plan["aggregates"])
+
+        # Handles columns from different tables
+        if len(plan["joins"]) > 0:
+            relation = self.join(plan["name"], plan["joins"])
+            where = self.bind(where)
+            return relation.select(columns_to_get, order_by, plan["distinct"], where, collations, aggregates,
+                                   self.sort_budget)
+
+        return self.select(columns_to_get, plan["name"], order_by, plan["distinct"], where, collations, aggregates,
+                           plan["sample"])
+
+    def compound_select_prep(self, tokens):
+        """
+        Handles SELECTs combined with UNION and UNION ALL, evaluated from left to right.  An ORDER BY after
+        the last SELECT sorts the combined rows, by the names of the first SELECT's columns
+        :param tokens: The list of tokens to be processed
+        """
+        # Splits the query into each of its SELECTs
+        selects = []
+        operators = []
+        start = 0
+        for i in keyword_positions(tokens, "UNION"):
+            selects.append(tokens[start:i] + [";"])
+            keep_duplicates = i + 1 < len(tokens) and tokens[i + 1] == "ALL"
+            operators.append(keep_duplicates)
+            start = i + 2 if keep_duplicates else i + 1
+        selects.append(tokens[start:])
+
+        # Takes the ORDER BY off the last SELECT, it belongs to the whole query
+        order_by = []
+        collations = []
+        ends = [i for i in keyword_positions(selects[-1], "ORDER") if selects[-1][i + 1:i + 2] == ["BY"]]
+        if len(ends) > 0:
+            self.process_order_by(selects[-1][ends[0]:] + [";"], 2, order_by, collations)
+            selects[-1] = selects[-1][:ends[0]] + [";"]
+
+        plans = []
+        for select in selects:
+            if len(select) < 2 or select[0] != "SELECT":
+                raise QueryError("UNION must combine SELECT statements")
+            plans.append(self.parse_select(select))
+            if len(plans[-1]["order_by"]) > 0:
+                raise QueryError("ORDER BY can only come after the last SELECT of a UNION")
+        names = self.result_columns(plans[0])
+        for plan in plans[1:]:
+            if len(self.result_columns(plan)) != len(names):
+                raise QueryError("SELECTs to the left and right of UNION do not have the same number of columns")
+
+        # Finds the columns to sort by before running anything
+        order_by_ind = []
+        for order in order_by:
+            name = order[1:]
+            matches = [j for j, col in enumerate(names) if col == name or col[col.find(".") + 1:] == name]
+            if len(matches) == 0:
+                raise QueryError("Cannot Order records with non-existent column")
+            order_by_ind.append(matches[0])
+
+        # Streams the rows of each SELECT into the next
+        rows = list(self.run_select(plans[0]))
+        for keep_duplicates, plan in zip(operators, plans[1:]):
+            rows = union(rows, list(self.run_select(plan)), keep_duplicates)
+        rows = list(rows)
+
+        if len(order_by_ind) > 0:
+            rows = Table.sort_rows(rows, order_by_ind, [order[0] for order in order_by], collations)
+        return rows
+
+    def result_columns(self, plan):
+        """
+        Gets the names of the columns a parsed SELECT gives, replacing '*'
+        :param plan: The plan from parse_select
+        :return: The list of column names, with expressions named by their text
+        """
+        names = []
+        for col in plan["columns"]:
+            if col == "*":
+                for name in [plan["name"]] + [join[1] for join in plan["joins"]]:
+                    names += self.column_names(name)
+            elif isinstance(col, str) and col.endswith(".*"):
+                names += self.column_names(col[:-2])
+            elif isinstance(col, str):
+                names.append(col)
+            else:
+                names.append(unparse(col))
+        return names
 
     """Handles the special SELECT clauses"""
 
     def process_where(self, tokens, i, where):
         """
-        Gets the operators for the WHERE clause
+        Gets the conditions for the WHERE clause, which are joined by AND
         :param tokens: The list of current tokens for the query
         :param i: the current index into hte tokens
-        :param where: The list of where tokens, specifically
+        :param where: The list of where conditions, each a list of the column, operator and value
         :return: the new index into the list of tokens
         """
-        # Grabs the operator statement values
-        left_key = tokens[i]
-        op = tokens[i + 1]
+        while True:
+            # [NOT] EXISTS (SELECT ...) tests the whole row, so it has no column
+            if tokens[i] == "EXISTS" or (tokens[i] == "NOT" and tokens[i + 1] == "EXISTS"):
+                op = "EXISTS" if tokens[i] == "EXISTS" else "NOT EXISTS"
+                i += 1 if op == "EXISTS" else 2
+                subquery, i = self.process_subquery(tokens, i, "EXISTS")
+                where.append([None, op, subquery])
+
+            # col [NOT] IN (values) or col [NOT] IN (SELECT ...)
+            elif tokens[i + 1] == "IN" or (tokens[i + 1] == "NOT" and tokens[i + 2] == "IN"):
+                left_key = tokens[i]
+                op = "IN" if tokens[i + 1] == "IN" else "NOT IN"
+                i += 2 if op == "IN" else 3
+                if i + 1 < len(tokens) and tokens[i] == "(" and tokens[i + 1] == "SELECT":
+                    values, i = self.process_subquery(tokens, i, "IN")
+                else:
+                    values, i = self.process_in_list(tokens, i)
+                where.append([left_key, op, values])
 
-        if tokens[i+2] == "'":  # It's a string
-            right_key = tokens[i + 3]
-            i += 2
-        else:
-            right_key = tokens[i + 2]
+            else:
+                # Grabs the operator statement values
+                left_key = tokens[i]
+                op = tokens[i + 1]
+
+                if tokens[i+2] == "'":  # It's a string
+                    right_key = tokens[i + 3]
+                    i += 2
+                elif isinstance(tokens[i + 2], str):  # A name, which a subquery can use for an outer column
+                    right_key = Reference(tokens[i + 2])
+                else:
+                    right_key = tokens[i + 2]
+
+                where.append([left_key, op, right_key])
+                i += 3
+
+            if tokens[i] != "AND":
+                return i
+            i += 1
 
-        where.append(left_key)
-        where.append(op)
-        where.append(right_key)
+    def process_in_list(self, tokens, i):
+        """
+        Gets the values of an IN list, which are tested against as a hash set
+        :param tokens: The list of current tokens for the query
+        :param i: The index of the '(' starting the list
+        :return: The frozenset of the values and the index just past the ')'
+        """
+        if tokens[i] != "(":
+            raise QueryError("IN must be followed by a list of values or a subquery")
+        values = set()
+        i += 1
+        while tokens[i] != ")":
+            if tokens[i] == "'":  # A string
+                values.add(tokens[i + 1])
+                i += 3
+            elif tokens[i] is None or isinstance(tokens[i], int) or isinstance(tokens[i], float):
+                values.add(tokens[i])
+                i += 1
+            else:
+                raise SQLTypeError("{} is not a valid SQL type".format(tokens[i]))
+            if tokens[i] == ",":
+                i += 1
+            elif tokens[i] != ")":
+                raise QueryError("Missing comma separator in IN list")
+        return frozenset(values), i + 1
+
+    def process_subquery(self, tokens, i, kind):
+        """
+        Parses a parenthesized SELECT in a WHERE condition
+        :param tokens: The list of current tokens for the query
+        :param i: The index of the '(' starting the subquery
+        :param kind: "IN" or "EXISTS", see Subquery
+        :return: The Subquery and the index just past its ')'
+        """
+        if tokens[i] != "(" or tokens[i + 1] != "SELECT":
+            raise QueryError("{} must be followed by a subquery".format(kind))
+        depth = 0
+        end = i
+        while end < len(tokens):
+            if tokens[end] == "'":  # Parentheses in strings don't count
+                end += 3
+                continue
+            if tokens[end] == "(":
+                depth += 1
+            elif tokens[end] == ")":
+                depth -= 1
+                if depth == 0:
+                    break
+            end += 1
+        if end >= len(tokens):
+            raise QueryError("Missing ')' at the end of subquery")
 
-        return i + 3
+        select = tokens[i + 1:end] + [";"]
+        if len(keyword_positions(select, "UNION")) > 0:
+            raise QueryError("UNION is not supported in a subquery")
+        return Subquery(self.parse_select(select), kind), end + 1
+
+    def bind(self, where):
+        """
+        Runs the subqueries of the where conditions that are run once per statement, and ties the correlated
+        ones to this database
+        :param where: The list of where conditions
+        :return: The where conditions with each subquery swapped for what it's tested against
+        """
+        if not any(isinstance(condition[2], Subquery) for condition in where):
+            return where
+        return [[col, op, val.bind(self)] if isinstance(val, Subquery) else [col, op, val]
+                for col, op, val in where]
 
     def process_order_by(self, tokens, i, order_by, collations):
         """
@@ -328,84 +776,258 @@ class Database:
 
         return i
 
-    def process_left_outer_join(self, tokens, i, normal_name):
-        join_name = tokens[i]
-        i += 1
+    def process_join(self, tokens, i, joins):
+        """
+        Gets a single JOIN clause and its ON conditions
+        :param tokens: The list of current tokens for the query
+        :param i: the current index into the tokens, at the start of the JOIN clause
+        :param joins: The list of joins, each a tuple of if it's outer, the table name and its key pairs
+        :return: the new index into the list of tokens
+        """
+        outer = False
+        if tokens[i] == "LEFT":
+            outer = True
+            i += 1
+            if tokens[i] == "OUTER":
+                i += 1
+        elif tokens[i] == "INNER":
+            i += 1
+        if tokens[i] != "JOIN":
+            raise QueryError("Invalid JOIN clause. Stuck at token {}".format(tokens[i]))
+        join_name = tokens[i + 1]
+        i += 2
 
-        # Handles grabbing ALL THE DATA from the table to join on first
-        normal_table = self.select(["*"], normal_name, aggregates=[None])
-        normal_headers = self.tables[normal_name].headers
-        normal_types = self.tables[normal_name].types
-        normal_default = self.tables[normal_name].default
+        # Grabs the equality conditions, joined by AND
+        if tokens[i] != "ON":
+            raise QueryError("Need to have key to join on")
+        keys = []
+        while tokens[i] == "ON" or tokens[i] == "AND":
+            if i + 3 >= len(tokens) or tokens[i + 2] != "=":
+                raise QueryError("Need to have key to join on")
+            if tokens[i + 1] == tokens[i + 3]:
+                raise QueryError("Joining keys can't be the same key")
+            keys.append((tokens[i + 1], tokens[i + 3]))
+            i += 4
+
+        joins.append((outer, join_name, keys))
+        return i
+
+    def column_names(self, name):
+        """
+        Gets the column names of a table or view
+        :param name: The name of the table or view
+        :return: The list of column names, in order
+        """
+        if name not in self.tables.keys():
+            raise TableError("Table {} does not exists".format(name))
+        if isinstance(self.tables[name], View):
+            return list(self.tables[name].columns)
+        return [h for h in self.tables[name].headers.keys()]
 
-        # Handles grabbing ALL THE DATA from the table to join on first
-        join_table = self.select(["*"], join_name, aggregates=[None])
-        join_headers = self.tables[join_name].headers
-        join_types = self.tables[join_name].types
-        join_default = self.tables[join_name].default
+    def relation(self, name):
+        """
+        Gets the rows and qualified column names of a table or view to feed into a join
+        :param name: The name of the table or view
+        :return: The list of rows as tuples and the list of column names
+        """
+        if name not in self.tables.keys():
+            raise TableError("Table {} does not exists".format(name))
+        table = self.tables[name]
+        self.read(name)
 
-        # Valid syntax check
-        if i + 3 < len(tokens) and tokens[i] != "ON" or tokens[i+2] != "=":
-            raise QueryError("Need to have key to join on")
-        i += 1
+        if isinstance(table, View):
+            rows = list(self.select(["*"], name, aggregates=[None]))
+            return rows, [name + "." + col[col.find(".") + 1:] for col in table.columns]
+        return [tuple(row) for row in table.table], [h for h in table.headers.keys()]
 
-        # Grabs the equality statement values
-        left_key = tokens[i]
-        right_key = tokens[i+2]
-        if left_key == right_key:
-            raise QueryError("Joining keys can't be the same key")
-        i += 3
-
-        # Creates the joined table with name for a TEMPORARY TABLE
-        jname = "JOIN1"
-        ind = 1
-        while jname in self.tables:
-            ind += 1
-            jname = "JOIN" + str(ind)
-        table = Table(jname, [], True, [normal_name, join_name], {})
-        table.headers = {**normal_headers, **join_headers}
-        table.types = {**normal_types, **join_types}
-        table.rowCnt = len(normal_table)
-        table.default = {**normal_default, **join_default}
-
-        # Adds the right side table headers with updated indexes
-        cnt = len(normal_headers)
-        for key in join_headers:
-            table.headers[key] = cnt
-            cnt += 1
-
-        left_key = table.append_table_name([left_key])[0]
-        right_key = table.append_table_name([right_key])[0]
-
-        # Checks to see which table contains which key
-        if left_key in normal_headers and right_key in join_headers: pass
-        elif right_key in normal_headers and left_key in join_headers: left_key, right_key = right_key, left_key
-        else: raise QueryError("Can't join tables based on keys provided")
-
-        # Handles joining
-        new_table = list()
-        for record in normal_table:
-            key_to_search = record[normal_headers[left_key]]
-            for join_record in join_table:
-                if key_to_search == join_record[join_headers[right_key]] and key_to_search is not None:
-                    new_table.append(record + join_record)
-                    break
+    def join(self, name, joins):
+        """
+        Pipelines the tables of a FROM clause through a chain of joins, without registering any
+        temporary table.  Inner joins are reordered so the largest table is streamed and every other
+        table is hashed, smallest first.  A sort-merge join is used instead of hashing when both sides
+        are already ordered on the key
+        :param name: The name of the first table in the FROM clause
+        :param joins: The joins from process_join
+        :return: An unregistered Table holding the joined rows
+        """
+        names = [name] + [j[1] for j in joins]
+        if len(set(names)) != len(names):
+            raise QueryError("Can't join a table with itself")
+        inputs = {n: self.relation(n) for n in names}
+        owner = {col: n for n in names for col in inputs[n][1]}
+
+        # Qualifies the join keys and figures out which tables they link
+        resolver = Table(name, [], True, names, {})
+        resolver.headers = owner
+        conditions = []
+        for outer, join_name, keys in joins:
+            for left_key, right_key in keys:
+                left_key, right_key = resolver.append_table_name([left_key, right_key])
+                if left_key not in owner or right_key not in owner or owner[left_key] == owner[right_key]:
+                    raise QueryError("Can't join tables based on keys provided")
+                conditions.append((outer, join_name, left_key, right_key))
+
+        # Picks the order to join in
+        if any(j[0] for j in joins):  # Outer joins have to stay in the order they were written
+            order = names
+        else:
+            order = [max(names, key=lambda n: len(inputs[n][0]))]
+            while len(order) < len(names):
+                remaining = [n for n in names if n not in order]
+                linked = [n for n in remaining if self.linked(n, order, conditions, owner)]
+                order.append(min(linked or remaining, key=lambda n: len(inputs[n][0])))
+
+        # Builds the pipeline of joins
+        rows, columns = inputs[order[0]]
+        ordered_on = None  # The key columns the streamed rows are known to be ordered on
+        for right_name in order[1:]:
+            right_rows, right_columns = inputs[right_name]
+
+            # Finds the keys linking this table to the ones already joined
+            left_idx, right_idx, outer = [], [], False
+            for c_outer, join_name, left_key, right_key in conditions:
+                if owner[left_key] == right_name:
+                    left_key, right_key = right_key, left_key
+                elif owner[right_key] != right_name:
+                    continue
+                if left_key in columns:
+                    left_idx.append(columns.index(left_key))
+                    right_idx.append(right_columns.index(right_key))
+                    outer = outer or (c_outer and join_name == right_name)
+                elif c_outer and join_name == right_name:
+                    raise QueryError("Can't join tables based on keys provided")
+
+            left_key = itemgetter(*left_idx) if len(left_idx) > 0 else lambda row: ()
+            right_key = itemgetter(*right_idx) if len(right_idx) > 0 else lambda row: ()
+
+            # Can we merge instead of hashing
+            key_cols = tuple(columns[ind] for ind in left_idx)
+            left_ordered = ordered_on == key_cols or (isinstance(rows, list) and is_sorted(rows, left_key))
+            if len(left_idx) > 0 and left_ordered and is_sorted(right_rows, right_key):
+                rows = merge_join(rows, right_rows, left_key, right_key, outer, len(right_columns))
+                ordered_on = key_cols
+            else:  # Hashing keeps the order of the streamed side
+                rows = hash_join(rows, right_rows, left_key, right_key, outer, len(right_columns))
+            columns = columns + right_columns
+
+        # The headers stay in FROM clause order, pointing at where the pipeline put each column
+        table = Table(name, [], True, names, {})
+        positions = {col: ind for ind, col in enumerate(columns)}
+        for n in names:
+            for col in inputs[n][1]:
+                table.headers[col] = positions[col]
+                if n in self.tables and isinstance(self.tables[n], Table):
+                    table.types[col] = self.tables[n].types[col]
+        table.table = list(rows)
+        table.rowCnt = len(table.table)
+        return table
+
+    def linked(self, name, joined, conditions, owner):
+        """
+        Checks if a join condition links a table to the tables that were already joined
+        :param name: The name of the table
+        :param joined: The names of the tables that were already joined
+        :param conditions: The join conditions, with the qualified key names last
+        :param owner: The name of the table each qualified column belongs to
+        """
+        for condition in conditions:
+            tables = {owner[condition[2]], owner[condition[3]]}
+            if name in tables and (tables - {name}) <= set(joined):
+                return True
+        return False
+
+    """Savepoints, backed by an undo log of only the rows that were touched"""
+
+    def savepoint(self, name):
+        """
+        Opens a savepoint, starting the undo log if this is the first one
+        :param name: The name of the savepoint
+        """
+        if self.undo_log is None:
+            self.undo_log = []
+            for owned in self.owned:
+                if isinstance(self.tables.get(owned), Table):
+                    self.tables[owned].undo_log = self.undo_log
+        self.savepoints.append((name, len(self.undo_log), 0 if self.changes is None else len(self.changes),
+                                0 if self.writes is None else len(self.writes)))
+
+    def find_savepoint(self, name):
+        """
+        Finds the most recent savepoint with the given name
+        :param name: The name of the savepoint
+        :return: The index of the savepoint in the savepoint stack
+        """
+        for i in range(len(self.savepoints) - 1, -1, -1):
+            if self.savepoints[i][0] == name:
+                return i
+        raise TransactionError("No such savepoint: {}".format(name))
+
+    def release(self, name):
+        """
+        Releases a savepoint and every savepoint opened after it, keeping their changes
+        :param name: The name of the savepoint
+        """
+        del self.savepoints[self.find_savepoint(name):]
+        if len(self.savepoints) == 0:
+            self.clear_savepoints()
+
+    def rollback_to(self, name):
+        """
+        Undoes every change made since a savepoint, leaving the savepoint itself open
+        :param name: The name of the savepoint
+        """
+        i = self.find_savepoint(name)
+        mark = self.savepoints[i][1]
+        if self.changes is not None:  # The undone changes never happened as far as the feed knows
+            del self.changes[self.savepoints[i][2]:]
+        if self.writes is not None:  # Nor are they applied again if an optimistic transaction is replayed
+            del self.writes[self.savepoints[i][3]:]
+        del self.savepoints[i + 1:]
+
+        # Undo the changes newest first so each one sees the table the way it left it
+        while len(self.undo_log) > mark:
+            entry = self.undo_log.pop()
+            if entry[0] == "CREATE":
+                del self.tables[entry[1]]
+                self.owned.discard(entry[1])
+            elif entry[0] == "DROP":
+                self.tables[entry[1]] = entry[2]
+                if entry[1] in self.owned and isinstance(entry[2], Table):
+                    entry[2].undo_log = self.undo_log
+                    entry[2].changes = self.changes
             else:
-                new_table.append(record + tuple([None] * len(join_record)))
+                entry[1].undo(entry)
 
-        # Creates the temporary table in memory
-        table.table = new_table
+    def clear_savepoints(self):
+        """
+        Forgets every savepoint and stops recording changes
+        """
+        self.savepoints = []
+        self.undo_log = None
+        for name in self.owned:
+            if isinstance(self.tables.get(name), Table):
+                self.tables[name].undo_log = None
 
-        self.tables[jname] = table
-        return i, jname
+    def capture(self, changes):
+        """
+        Starts or stops recording the row images of every change made to the tables
+        :param changes: The list to record them in, or None to stop
+        """
+        self.changes = changes
+        for name in self.owned:
+            if isinstance(self.tables.get(name), Table):
+                self.tables[name].changes = changes
 
     """Basic Processing for queries once the tokens have been interpreted"""
 
-    def create(self, name, columns, exists, default):
+    def create(self, name, columns, exists, default, unique=(), primary_key=None, cluster=None):
         """
         This method creates a table in the database
         :param name: The name of the table
         :param columns: The columns and their types
+        :param unique: The indexes of the PRIMARY KEY and UNIQUE columns
+        :param primary_key: The index of the PRIMARY KEY column, or None
+        :param cluster: The index of the column to keep the rows sorted on, or None
         """
         # Checks to see if the table already exists
         if name in self.tables.keys() and not exists:
@@ -413,8 +1035,13 @@ class Database:
         elif name in self.tables.keys() and exists:
             return
 
-        table = Table(name, columns, False, [name], default)
+        table = Table(name, columns, False, [name], default, unique, primary_key, cluster)
         self.tables[name] = table
+        self.owned.add(name)
+        table.changes = self.changes
+        if self.undo_log is not None:
+            table.undo_log = self.undo_log
+            self.undo_log.append(("CREATE", name))
 
     def create_view(self, tokens):
         """
@@ -428,36 +1055,50 @@ class Database:
 
         view = View(name, tokens[4:], self)
         self.tables[name] = view
+        if self.undo_log is not None:
+            self.undo_log.append(("CREATE", name))
 
-    def insert(self, name, values, columns_to_insert, all_default):
+    def insert(self, name, values, columns_to_insert, all_default, on_conflict=None):
         """
         Inserts a row into the database, if possible
         :param values: The values to be inserted into the database
         :param name: The name of the table
+        :param on_conflict: What to do when a row's key is already in the table, see Table.insert
         """
         # Checks to see if the table exists
         if name not in self.tables.keys():
             raise TableError("Table {} does not exists".format(name))
 
-        self.tables[name].insert(values, columns_to_insert, all_default)
+        self.writable(name).insert(values, columns_to_insert, all_default, on_conflict)
 
     def update(self, name, where, columns_to_set):
         # Checks to see if the table exists
         if name not in self.tables.keys():
             raise TableError("Table {} does not exists".format(name))
+        where = self.bind(where)
+        self.read(name, list(where))
 
-        self.tables[name].update(where, columns_to_set)
+        self.writable(name).update(where, columns_to_set)
 
     def delete(self, name, where):
         # Checks to see if the table exists
         if name not in self.tables.keys():
             raise TableError("Table {} does not exists".format(name))
+        where = self.bind(where)
+        self.read(name, list(where))
 
-        self.tables[name].delete(where)
+        self.writable(name).delete(where)
 
-    def select(self, columns_to_get, name, order_by=[], distinct=False, where=[], collations=[], aggregates=[]):
+    def select(self, columns_to_get, name, order_by=[], distinct=False, where=[], collations=[], aggregates=[],
+               sample=None):
         # Checks to see if the table exists
         if name not in self.tables.keys():
             raise TableError("Table {} does not exists".format(name))
-
-        return self.tables[name].select(columns_to_get, order_by, distinct, where, collations, aggregates)
+        where = self.bind(where)
+        self.read(name, list(where))
+
+        if isinstance(self.tables[name], View):
+            return self.tables[name].select(columns_to_get, order_by, distinct, where, collations, aggregates,
+                                            sample)
+        return self.tables[name].select(columns_to_get, order_by, distinct, where, collations, aggregates,
+                                        self.sort_budget, sample)
@@ -20,4 +20,12 @@ class TableError(Exception):
 
 
 class TransactionError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class ConstraintError(Exception):
+    pass
+
+
+class MemoryLimitError(Exception):
+    pass
@@ -0,0 +1,170 @@
+"""
+This class represents the background thread that publishes the committed database to a file for read replicas,
+which are ReplicaConnections in other processes.  The file holds every column in a compact binary layout that
+readers mmap and read in place, so any number of reader processes share one copy of the data through the page
+cache.  Each publish writes a new file and renames it over the old one, so readers see whole snapshots only
+
+The layout is the 8 byte magic, the length of the catalog as an unsigned 64 bit integer, the catalog as JSON and
+then the segments the catalog points at, each starting on an 8 byte boundary.  A column is stored as one of
+    "q"      its values as 64 bit integers, 0 for NULL
+    "d"      its values as 64 bit floats, 0.0 for NULL
+    "text"   the 64 bit offsets of each value in a blob of UTF-8, then the blob
+    "pickle" a pickled list, for columns mixing types or with integers too big for 64 bits
+along with a byte per row that is 1 for NULL
+"""
+import array
+import json
+import os
+import pickle
+import struct
+import threading
+from View import View
+
+MAGIC = b"PYDBREP1"
+_LENGTH = struct.Struct("<Q")
+
+
+class Replica:
+    def __init__(self, path, snapshot):
+        """
+        Starts the publisher thread
+        :param path: The path of the file to publish to
+        :param snapshot: The function that gets the latest committed Database
+        """
+        self.path = path
+        self.snapshot = snapshot
+        self.published = None  # The generation of the database in the file
+        self.encoded = {}  # The catalog entry and segments of each table, for the version they were encoded at
+        self.publishes = 0  # How many times the file was written
+        self.failures = 0  # How many publishes the thread has had fail
+        self.error = None  # The exception of the last one that failed
+        self.running = threading.Lock()  # Only one publish at a time
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="replica " + path, daemon=True)
+        self.thread.start()
+
+    def poke(self):
+        """
+        Wakes the thread up after a commit.  Commits made while it's publishing are picked up together by the
+        next publish
+        """
+        self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            try:
+                self.publish()
+            except Exception as e:  # The thread has to outlive it, or the readers would be stuck on this snapshot
+                self.failures += 1
+                self.error = e
+
+    def publish(self):
+        """
+        Writes the latest committed database to the file, unless the file already holds it
+        :return: The generation of the database in the file
+        """
+        with self.running:
+            database = self.snapshot()
+            if database.generation == self.published and os.path.exists(self.path):
+                return self.published
+            self.encoded = Replica.write(database, self.path, self.encoded)
+            self.published = database.generation
+            self.publishes += 1
+            return self.published
+
+    @staticmethod
+    def write(database, path, encoded=None):
+        """
+        Writes a database to a replica file, swapping it in whole
+        :param database: The committed Database
+        :param path: The path of the file
+        :param encoded: What the last write returned, so the tables that haven't changed aren't encoded again
+        :return: The encoded tables, to hand to the next write
+        """
+        encoded = {} if encoded is None else encoded
+        tables = {}
+        views = []
+        for name, table in database.tables.items():
+            if isinstance(table, View):
+                views.append({"name": name, "query": table.query})
+            elif name in encoded and encoded[name][0] == table.version:
+                tables[name] = encoded[name]
+            else:
+                tables[name] = (table.version,) + Replica.encode_table(table)
+
+        # The segments go after the catalog, which needs their offsets, so they're numbered relative to its end
+        catalog = {"generation": database.generation, "log_seq": database.log_seq, "tables": [], "views": views}
+        segments = []
+        offset = 0
+        for name, (version, entry, data) in tables.items():
+            entry = dict(entry, columns=[dict(column) for column in entry["columns"]])
+            for column in entry["columns"]:
+                for key in ("values", "offsets", "nulls"):
+                    if key in column:
+                        segment = data[column[key]]
+                        column[key] = [offset, len(segment)]
+                        segments.append(segment + bytes(-len(segment) % 8))
+                        offset += len(segments[-1])
+            catalog["tables"].append(entry)
+        header = json.dumps(catalog).encode("utf-8")
+        header += b" " * (-(len(MAGIC) + _LENGTH.size + len(header)) % 8)
+
+        with open(path + "-tmp", "wb") as file:
+            file.write(MAGIC + _LENGTH.pack(len(header)) + header)
+            for segment in segments:
+                file.write(segment)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + "-tmp", path)
+        return tables
+
+    @staticmethod
+    def encode_table(table):
+        """
+        Encodes the columns of a table
+        :param table: The Table
+        :return: The catalog entry of the table, whose columns point at their segments by index, and the list
+        of segments
+        """
+        names = sorted(table.headers, key=table.headers.get)
+        entry = {"name": table.name, "headers": names, "types": table.types, "rel_tables": table.rel_tables,
+                 "rows": len(table.table), "primary_key": table.primary_key, "cluster": table.cluster,
+                 "columns": []}
+        data = []
+        for ind in range(len(names)):
+            values = [row[ind] for row in table.table]
+            column, segments = Replica.encode_column(values)
+            for key, segment in segments.items():
+                column[key] = len(data)
+                data.append(segment)
+            entry["columns"].append(column)
+        return entry, data
+
+    @staticmethod
+    def encode_column(values):
+        """
+        Encodes the values of one column in the most compact kind that holds them exactly
+        :param values: The list of values
+        :return: The catalog entry of the column and its segments by name
+        """
+        nulls = bytes(value is None for value in values)
+        present = [value for value in values if value is not None]
+        kinds = set(type(value) for value in present)
+        try:
+            if kinds <= {int}:
+                return {"kind": "q"}, {"values": array.array("q", [0 if v is None else v for v in values]).tobytes(),
+                                       "nulls": nulls}
+            elif kinds == {float}:
+                return {"kind": "d"}, {"values": array.array("d", [0.0 if v is None else v for v in values]).tobytes(),
+                                       "nulls": nulls}
+            elif kinds == {str}:
+                blob = [b"" if v is None else v.encode("utf-8", "surrogatepass") for v in values]
+                offsets = array.array("q", [0])
+                for value in blob:
+                    offsets.append(offsets[-1] + len(value))
+                return {"kind": "text"}, {"offsets": offsets.tobytes(), "values": b"".join(blob), "nulls": nulls}
+        except OverflowError:  # An integer too big for 64 bits
+            pass
+        return {"kind": "pickle"}, {"values": pickle.dumps(values, pickle.HIGHEST_PROTOCOL)}
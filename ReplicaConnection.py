@@ -0,0 +1,242 @@
+"""
+This class represents a read-only connection to a replica file published by Replica, for reader processes.
+The file is mmap'd, so the columns are read in place and every process attached to it shares the one copy
+the OS caches.  Before each query the connection checks if a newer snapshot was published and switches to it
+"""
+import functools
+import json
+import mmap
+import os
+import pickle
+from Database import Database
+from Table import Table, VERSIONS
+from View import View
+from Replica import MAGIC, _LENGTH
+from tokenizer import tokenize
+from Errors import CommandError, QueryError
+import vectorized
+
+_BATCH = 4096  # The rows decoded at a time when a table is scanned
+_COLLATION_CACHE_SIZE = 65536
+
+
+class ReplicaConnection:
+    def __init__(self, path):
+        """
+        Attaches to a replica file
+        :param path: The path of the file, the replica argument of the writing Connection
+        """
+        self.path = path
+        self.database = None
+        self.identity = None  # Which file the database was mapped from
+        self.collations = {}
+        self.refresh()
+
+    def refresh(self):
+        """
+        Switches to the latest published snapshot if there's a new one.  Publishing renames a whole new file
+        over the old one, so a snapshot is never seen half written, and queries already running on the old
+        one keep its mapping
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            raise CommandError("No replica has been published to {}".format(self.path))
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if identity == self.identity:
+            return
+        with open(self.path, "rb") as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.database = ReplicaConnection.attach(self.path, memoryview(buffer))
+        self.database.collations = dict(self.collations)
+        self.identity = identity
+
+    @staticmethod
+    def attach(name, buffer):
+        """
+        Builds a Database over the tables in a replica file, without copying their columns
+        :param name: The name of the database
+        :param buffer: The memoryview of the whole file
+        :return: The Database
+        """
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise CommandError("{} is not a replica file".format(name))
+        length = _LENGTH.unpack_from(buffer, len(MAGIC))[0]
+        start = len(MAGIC) + _LENGTH.size
+        catalog = json.loads(bytes(buffer[start:start + length]).decode("utf-8"))
+        data = buffer[start + length:]
+
+        database = Database(name)
+        database.generation = catalog["generation"]
+        database.log_seq = catalog["log_seq"]
+        for entry in catalog["tables"]:
+            table = Table.__new__(Table)
+            table.__dict__.update(name=entry["name"], headers={col: i for i, col in enumerate(entry["headers"])},
+                                  types=entry["types"], rel_tables=entry["rel_tables"], rowCnt=entry["rows"],
+                                  default={}, undo_log=None, changes=None, version=next(VERSIONS), vectors={},
+                                  zones={}, indexes={}, primary_key=entry["primary_key"], cluster=entry["cluster"])
+            columns = [Column(column, data, entry["rows"]) for column in entry["columns"]]
+            table.table = Rows(columns, entry["rows"])
+
+            # NumPy can use the columns in place, so the vectorized scans don't build arrays of their own
+            if vectorized.ENABLED:
+                for col, ind in table.headers.items():
+                    array = columns[ind].array(table.types.get(col))
+                    if array is not None:
+                        table.vectors[ind] = (table.version,) + array
+            database.tables[entry["name"]] = table
+
+        for entry in catalog["views"]:  # In the order they were created, so a view can use the ones before it
+            database.tables[entry["name"]] = View(entry["name"], entry["query"], database)
+        return database
+
+    @staticmethod
+    def segment(data, where):
+        """
+        Gets a segment of the file without copying it
+        :param data: The memoryview of the segments
+        :param where: The offset and length of the segment from the catalog
+        """
+        return data[where[0]:where[0] + where[1]]
+
+    @property
+    def generation(self):
+        """
+        The generation of the snapshot the connection is on, which goes up with every commit
+        """
+        return self.database.generation
+
+    def close(self):
+        self.database = None
+        self.identity = None
+
+    def execute(self, statement):
+        """
+        Runs a SELECT on the latest published snapshot
+        :return: The list of rows
+        """
+        tokens = tokenize(statement)
+        if tokens[-1] != ";":
+            raise QueryError("Query missing ';' at the end")
+        if tokens[0] != "SELECT":
+            raise CommandError("A replica is read-only, so it only runs SELECT")
+        self.refresh()
+        return self.database.select_prep(tokens)
+
+    def column(self, table, name):
+        """
+        Gets a column of a table without copying it
+        :param table: The name of the table
+        :param name: The name of the column
+        :return: The Column, whose values and nulls are memoryviews of the file
+        """
+        self.refresh()
+        if table not in self.database.tables or not isinstance(self.database.tables[table], Table):
+            raise QueryError("Table {} does not exists".format(table))
+        table = self.database.tables[table]
+        return table.table.columns[table.resolve(name)]
+
+    def create_collation(self, name, function, key=False, cache_size=_COLLATION_CACHE_SIZE):
+        """
+        Creates a sorting collation, see Connection.create_collation
+        """
+        if key:
+            collation = functools.lru_cache(maxsize=cache_size)(function)
+        else:
+            collation = functools.cmp_to_key(function)
+        self.collations[name] = collation
+        if self.database is not None:
+            self.database.collations[name] = collation
+
+
+class Column:
+    """
+    A column of a replica file.  Numbers are read straight out of the mapped file, text is decoded a value at a
+    time as it's read
+    """
+    def __init__(self, entry, data, rows):
+        """
+        :param entry: The catalog entry of the column
+        :param data: The memoryview of the segments of the file
+        :param rows: The number of rows
+        """
+        self.kind = entry["kind"]
+        self.rows = rows
+        if self.kind == "pickle":  # The one kind that has to be copied out
+            self.values = pickle.loads(ReplicaConnection.segment(data, entry["values"]))
+            self.nulls = bytes(value is None for value in self.values)
+            return
+        self.nulls = ReplicaConnection.segment(data, entry["nulls"])
+        if self.kind == "text":
+            self.offsets = ReplicaConnection.segment(data, entry["offsets"]).cast("q")
+            self.values = ReplicaConnection.segment(data, entry["values"])
+        else:
+            self.values = ReplicaConnection.segment(data, entry["values"]).cast(self.kind)
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, i):
+        if self.nulls[i]:
+            return None
+        elif self.kind == "text":
+            return str(self.values[self.offsets[i]:self.offsets[i + 1]], "utf-8", "surrogatepass")
+        return self.values[i]
+
+    def slice(self, start, end):
+        """
+        Decodes the values of a range of rows
+        :return: The list of values
+        """
+        if self.kind == "text":
+            offsets, values = self.offsets, self.values
+            decoded = [str(values[offsets[i]:offsets[i + 1]], "utf-8", "surrogatepass") for i in range(start, end)]
+        else:
+            decoded = self.values[start:end].tolist() if self.kind != "pickle" else self.values[start:end]
+            if self.kind == "pickle":
+                return decoded
+        nulls = self.nulls[start:end]
+        if any(nulls):
+            return [None if null else value for value, null in zip(decoded, nulls)]
+        return decoded
+
+    def array(self, kind):
+        """
+        Gets the NumPy arrays of the values and null mask of a numeric column, sharing the file's memory
+        :param kind: The SQL type of the column
+        :return: The tuple of the arrays, or None if the column isn't stored as that type's numbers
+        """
+        if {"INTEGER": "q", "REAL": "d"}.get(kind) != self.kind:
+            return None
+        np = vectorized.np
+        return np.frombuffer(self.values, dtype=np.int64 if self.kind == "q" else np.float64), \
+            np.frombuffer(self.nulls, dtype=np.bool_)
+
+
+class Rows:
+    """
+    The rows of a replica table, decoded from its columns as they're read.  A scan decodes them a batch at a
+    time, so it never holds more than a batch of rows beyond the ones it keeps
+    """
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, end, step = i.indices(self.rows)
+            if step != 1:
+                return [self[k] for k in range(start, end, step)]
+            return list(zip(*[column.slice(start, end) for column in self.columns])) if end > start else []
+        if i < 0:
+            i += self.rows
+        if not 0 <= i < self.rows:
+            raise IndexError("row index out of range")
+        return tuple(column[i] for column in self.columns)
+
+    def __iter__(self):
+        for start in range(0, self.rows, _BATCH):
+            yield from zip(*[column.slice(start, min(start + _BATCH, self.rows)) for column in self.columns])
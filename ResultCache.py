@@ -0,0 +1,101 @@
+"""
+This class represents the result cache of a connection, which keeps the rows of repeated SELECTs until a
+table or view they read changes
+"""
+import sys
+from collections import OrderedDict
+
+
+class ResultCache:
+    def __init__(self, capacity):
+        """
+        Creates an empty cache
+        :param capacity: The most bytes of results the cache holds before evicting the least recently used
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()  # Each key maps to the versions the query read, its rows and their size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(tokens):
+        """
+        Gets the key of a query.  The types are kept so 1 and 1.0 aren't the same query
+        :param tokens: The list of tokens of the query
+        """
+        return tuple((type(token), token) for token in tokens)
+
+    @staticmethod
+    def cacheable(tokens):
+        """
+        Checks if a query gives the same rows every time it's run on the same tables.  A TABLESAMPLE without
+        REPEATABLE picks a different sample each time
+        :param tokens: The list of tokens of the query
+        """
+        return "TABLESAMPLE" not in tokens or "REPEATABLE" in tokens
+
+    @staticmethod
+    def measure(rows):
+        """
+        Estimates the bytes the rows of a result take up
+        :param rows: The list of rows as tuples
+        """
+        size = sys.getsizeof(rows)
+        for row in rows:
+            size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+        return size
+
+    def get(self, tokens, tables):
+        """
+        Gets the rows of a query if none of the tables and views it read have changed since
+        :param tokens: The list of tokens of the query
+        :param tables: The tables of the database the query is run on
+        :return: A copy of the list of rows, or None if the query isn't cached
+        """
+        key = ResultCache.key(tokens)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        reads, rows, size = entry
+        for name, version in reads.items():
+            if name not in tables or tables[name].version != version:  # Stale, so it won't ever hit again
+                self.misses += 1
+                del self.entries[key]
+                self.size -= size
+                return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return list(rows)
+
+    def reads(self, tokens):
+        """
+        Gets the names of the tables and views a cached query read
+        :param tokens: The list of tokens of the query
+        """
+        entry = self.entries.get(ResultCache.key(tokens))
+        return [] if entry is None else list(entry[0])
+
+    def put(self, tokens, reads, rows):
+        """
+        Caches the rows of a query, evicting the least recently used queries to make room
+        :param tokens: The list of tokens of the query
+        :param reads: The version of each table and view the query read
+        :param rows: The list of rows
+        """
+        size = ResultCache.measure(rows)
+        if size > self.capacity:
+            return
+        key = ResultCache.key(tokens)
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[2]
+        while self.size + size > self.capacity:
+            self.size -= self.entries.popitem(last=False)[1][2]
+        self.entries[key] = (reads, list(rows), size)
+        self.size += size
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
@@ -0,0 +1,77 @@
+"""
+This class represents a subquery in a WHERE condition, for IN (SELECT ...) and EXISTS (SELECT ...).  A subquery
+that doesn't refer to the outer query is run once per statement, while a correlated one is run once for each
+distinct set of values of the outer columns it refers to
+"""
+from Errors import QueryError
+
+
+class Reference(str):
+    """
+    An unquoted name on the right of a WHERE condition.  It compares like the text it holds, but in a
+    subquery it can be a column of the outer query
+    """
+
+
+class Subquery:
+    def __init__(self, plan, kind):
+        """
+        :param plan: The plan of the SELECT from Database.parse_select
+        :param kind: "IN" to test against the values of its one column, "EXISTS" to test if it has any rows
+        """
+        self.plan = plan
+        self.kind = kind
+
+        # Conditions comparing to a column of a table the subquery doesn't read refer to the outer query
+        tables = [plan["name"]] + [join[1] for join in plan["joins"]]
+        self.positions = [i for i, (col, op, val) in enumerate(plan["where"])
+                          if isinstance(val, Reference) and "." in val and val[:val.find(".")] not in tables]
+        self.outer = [plan["where"][i][2] for i in self.positions]
+
+    def run(self, database, values):
+        """
+        Runs the subquery
+        :param database: The Database to run it on
+        :param values: The values of the outer columns, in the order of self.outer
+        :return: The frozenset of the values for "IN", or if there were any rows for "EXISTS"
+        """
+        where = [list(condition) for condition in self.plan["where"]]
+        for position, value in zip(self.positions, values):
+            where[position][2] = value
+        rows = database.run_select(dict(self.plan, where=where))
+
+        if self.kind == "EXISTS":
+            return any(True for _ in rows)
+        values = set()
+        for row in rows:
+            if len(row) != 1:
+                raise QueryError("A subquery for IN must select exactly one column")
+            values.add(row[0])
+        return frozenset(values)
+
+    def bind(self, database):
+        """
+        Gets what a condition tests against when its statement runs
+        :param database: The Database the statement runs on
+        :return: The result of run if the subquery doesn't refer to the outer query, otherwise a Correlated
+        """
+        if len(self.outer) == 0:
+            return self.run(database, ())
+        return Correlated(self, database)
+
+
+class Correlated:
+    """
+    A correlated subquery bound to the database of a statement, remembering its result for each set of values
+    of the outer columns.  The compiled WHERE calls it with those values
+    """
+    def __init__(self, subquery, database):
+        self.subquery = subquery
+        self.database = database
+        self.outer = subquery.outer
+        self.results = {}
+
+    def __call__(self, *values):
+        if values not in self.results:
+            self.results[values] = self.subquery.run(self.database, values)
+        return self.results[values]
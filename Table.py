@@ -1,18 +1,31 @@
 """
 This class represents an individual table in a database
 """
-from Errors import SQLTypeError, QueryError
+from Errors import SQLTypeError, QueryError, ConstraintError
 from operator import itemgetter
-import functools
-_OPERATORS = ["<", ">", "=", "!=", "IS", "IS NOT"]
+from operators import hash_distinct, OrderKey, external_run, external_merge, batches
+from itertools import chain, count
+from copy import deepcopy
+import sys
+import math
+import bisect
+from expressions import compile_pipeline
+import approximate
+import vectorized
+import zonemaps
+_OPERATORS = ["<", ">", "=", "!=", "<=", ">=", "IS", "IS NOT", "IN", "NOT IN", "EXISTS", "NOT EXISTS"]
+VERSIONS = count(1)  # Shared by every table, so a version is never reused, even by a transaction's copy
 
 
 class Table:
-    def __init__(self, name, columns, join, rel_tables, default):
+    def __init__(self, name, columns, join, rel_tables, default, unique=(), primary_key=None, cluster=None):
         """
         Constructor
         :param name: The name of the table
         :param columns: The name of the columns for a table (holds tuples with 0: name and 1: type)
+        :param unique: The indexes of the PRIMARY KEY and UNIQUE columns
+        :param primary_key: The index of the PRIMARY KEY column, or None
+        :param cluster: The index of the column the rows are kept sorted on, or None
         """
         self.name = name  # The name of the table
         self.headers = dict()  # The column headers of the table
@@ -21,11 +34,56 @@ class Table:
         self.rel_tables = rel_tables
         self.rowCnt = 0  # The size of the table
         self.default = default
+        self.undo_log = None  # The undo log of the database while a savepoint is open
+        self.changes = None  # The row images of the transaction's changes, while a change feed is listening
+        self.version = next(VERSIONS)  # Changes every time the rows change
+        self.vectors = dict()  # The NumPy arrays of the numeric columns, for the version they were built at
+        self.zones = dict()  # The zone maps of the columns range filters have used, and how many rows they cover
+        self.indexes = {ind: dict() for ind in unique}  # Maps each key of a unique column to its row
+        self.primary_key = primary_key
+        self.cluster = cluster
 
         # Creates the column headers for the table
         if not join:
             self.create(columns)
 
+    def __getstate__(self):
+        """
+        Leaves the NumPy arrays and zone maps out when the table is pickled.  They're rebuilt when they're
+        next used, and queries on other threads may be adding to them while it's written
+        """
+        state = dict(self.__dict__)
+        state["vectors"] = {}
+        state["zones"] = {}
+        return state
+
+    def __deepcopy__(self, memo):
+        """
+        Copies the table for a transaction.  The values in the rows are never changed in place, so only the
+        row lists and the indexes pointing at them are copied, which is a lot faster than copying generically
+        """
+        table = Table.__new__(Table)
+        memo[id(self)] = table
+        table.__dict__.update(self.__dict__)
+        table.headers = dict(self.headers)
+        table.types = dict(self.types)
+        table.rel_tables = list(self.rel_tables)
+        table.default = deepcopy(self.default, memo)
+        table.table = [list(row) for row in self.table]
+        table.vectors = dict(self.vectors)  # The arrays are replaced rather than changed, so they're shared
+        table.zones = dict(self.zones)
+
+        copies = {}
+        if len(self.indexes) > 0 or self.undo_log is not None:
+            copies = {id(old): new for old, new in zip(self.table, table.table)}
+        table.indexes = {ind: {key: copies[id(row)] for key, row in index.items()}
+                         for ind, index in self.indexes.items()}
+        if self.undo_log is not None or self.changes is not None:  # Entries in them point at the rows
+            memo.update(copies)
+            table.undo_log = deepcopy(self.undo_log, memo)
+            table.changes = deepcopy(self.changes, memo)
+        return table
+
     def append_table_name(self, container):
         """
         Helper function that adds potential table names to the columns
@@ -33,6 +91,8 @@ class Table:
         :return: The edited container
         """
         for i in range(len(container)):
+            if not isinstance(container[i], str):  # An expression, not a column
+                continue
             ind = container[i].find(".")
             if ind == -1 and container[i] != "*":  # Found a column without a table name
                 for el in self.rel_tables:
@@ -43,50 +103,50 @@ class Table:
 
         return container
 
-    def where(self, where):
+    def resolve(self, col):
         """
-        Goes through all the columns checking the where condition
-        :param where: The where operands
-        :return: The list of indexes where WHERE CLAUSE is true
+        Gets the index of a column in a row, adding its table name if need be
+        :param col: The name of the column
+        :return: The index of the column
         """
-        where_true = []
-        op = where.pop(1)
-        val = where.pop()
-        where = self.append_table_name(where)[0]
-
-        # Error checking
-        if op not in _OPERATORS:
-            raise QueryError("Operator {} is not valid".format(op))
-        elif where not in self.headers:
-            raise QueryError("Column {} not in table {}".format(where, self.name))
-
-        # Executes WHERE clause
-        for i, row in enumerate(self.table):
-            col = row[self.headers[where]]
-
-            # Handles conditional
-            if op == "IS" and val is None:
-                if col is None:
-                    where_true.append(i)
-            elif op == "IS NOT" and val is None:
-                if col is not None:
-                    where_true.append(i)
-            elif op == ">":
-                if col is not None and col > val:
-                    where_true.append(i)
-            elif op == "<":
-                if col is not None and col < val:
-                    where_true.append(i)
-            elif op == "=":
-                if col is not None and col == val:
-                    where_true.append(i)
-            elif op == "!=":
-                if col is not None and col != val:
-                    where_true.append(i)
-            else:
+        name = self.append_table_name([col])[0]
+        if name not in self.headers:
+            raise QueryError("{} is not a column name in {}".format(col, self.name))
+        return self.headers[name]
+
+    def layout(self):
+        """
+        Gets what identifies the layout of the rows, which the compiled pipelines are cached by
+        """
+        return tuple(self.headers.items()), tuple(self.rel_tables)
+
+    def check_where(self, where):
+        """
+        Error checks the where conditions before they are compiled
+        :param where: The list of conditions, each a list of the column, operator and value
+        """
+        for col, op, val in where:
+            if op not in _OPERATORS:
+                raise QueryError("Operator {} is not valid".format(op))
+            elif (op == "IS" or op == "IS NOT") and val is not None:
                 raise QueryError("IS/IS NOT must be followed by NULL")
 
-        return where_true
+    def where(self, where):
+        """
+        Goes through all the rows checking the where conditions, which are ANDed together
+        :param where: The list of conditions, each a list of the column, operator and value
+        :return: The list of indexes where WHERE CLAUSE is true
+        """
+        self.check_where(where)
+        bounds = self.cluster_range(where)
+        candidates = zonemaps.indexes(self, where) if bounds is None else range(bounds[0], bounds[1])
+        if candidates is None:
+            indexes = vectorized.where(self, where)
+            if indexes is not None:
+                return indexes.tolist()
+            candidates = range(len(self.table))
+        pipeline, params = compile_pipeline("indexes", [], where, self.resolve, self.layout())
+        return pipeline(self.table, candidates, params)
 
     def create(self, columns):
         """
@@ -99,17 +159,19 @@ class Table:
             self.headers[self.name + "." + column[0]] = i
             self.types[self.name + "." + column[0]] = column[1]
 
-    def insert(self, values, columns_to_insert, all_default):
+    def insert(self, values, columns_to_insert, all_default, on_conflict=None):
         """
         Inserts the individual values into the table, type checking to make sure everything lines up
         :param values: The values to insert into the table, IN ORDER OF THE COLUMNS
+        :param on_conflict: What to do with a row that has the same key as one already in the table, a tuple of
+        "ABORT", "IGNORE", "REPLACE" or "UPDATE", the conflict target column or None and the SET columns for
+        "UPDATE".  None aborts
         """
         # Are we doing a default insert??
         if all_default:
             if len(self.default) != len(self.headers):
                 raise QueryError("There aren't default values specified for every column")
-            values = [v for v in self.default.values()]
-            self.table.append(values)
+            self.insert_rows([[v for v in self.default.values()]], on_conflict)
             return
 
         # Are we doing a full-insert??
@@ -163,7 +225,252 @@ class Table:
                     if not isinstance(row[i], str) and row[i] is not None:
                         raise SQLTypeError("Value: {} is not {}".format(row[i], type))
 
-        self.table += values
+        self.insert_rows(values, on_conflict)
+
+    def insert_rows(self, values, on_conflict):
+        """
+        Adds rows to the table, checking their keys against the unique indexes
+        :param values: The list of full rows
+        :param on_conflict: See insert
+        """
+        action, target, sets = ("ABORT", None, []) if on_conflict is None else on_conflict
+        if len(self.indexes) == 0:
+            self.append_rows(values)
+            return
+        for row in values:
+            self.check_not_null(row)
+
+        # Without anything to do for a conflict, all the keys are checked before anything changes
+        if action == "ABORT":
+            keys = {ind: set() for ind in self.indexes}
+            for row in values:
+                for ind, index in self.indexes.items():
+                    if row[ind] is None:
+                        continue
+                    if row[ind] in index or row[ind] in keys[ind]:
+                        raise ConstraintError("UNIQUE constraint failed: {}".format(self.column_name(ind)))
+                    keys[ind].add(row[ind])
+            self.append_rows(values)
+            return
+
+        target_ind = None if target is None else self.resolve(target)
+        if target_ind is not None and target_ind not in self.indexes:
+            raise QueryError("ON CONFLICT target {} is not a PRIMARY KEY or UNIQUE column".format(target))
+
+        # Otherwise each row is checked against the rows inserted before it
+        for row in values:
+            conflicts = self.key_conflicts(row)
+            if len(conflicts) == 0:
+                self.append_rows([row])
+                continue
+            if target_ind is not None and (len(conflicts) > 1 or conflicts[0][target_ind] != row[target_ind]):
+                raise ConstraintError("UNIQUE constraint failed: {}".format(self.name))
+
+            if action == "REPLACE":  # Replaces the first conflicting row in place, dropping the rest
+                self.remove_rows(conflicts[1:])
+                self.replace_row(conflicts[0], row)
+            elif action == "UPDATE":
+                self.update_rows([conflicts[0]], sets, [row])
+
+    def append_rows(self, values):
+        """
+        Appends rows that passed every check to the table, or puts them in order if it's clustered
+        :param values: The list of full rows
+        """
+        if self.changes is not None:
+            self.changes += [("INSERT", self.name, None, tuple(row)) for row in values]
+        if self.cluster is None:
+            if self.undo_log is not None:
+                self.undo_log.append(("INSERT", self, len(self.table)))
+            self.table += values
+        else:
+            if self.undo_log is not None:
+                self.undo_log.append(("PLACE", self, list(values)))
+            key = self.cluster_key()
+            if len(values) == 1:
+                bisect.insort_right(self.table, values[0], key=key)
+            else:  # Sorting two sorted runs back to back only takes a merge
+                self.table += sorted(values, key=key)
+                self.table.sort(key=key)
+            self.zones.clear()
+        for row in values:
+            self.index_add(row)
+        self.version = next(VERSIONS)
+
+    def remove_rows(self, rows):
+        """
+        Removes rows from the table
+        :param rows: The list of rows, which are the row objects in the table
+        """
+        if len(rows) == 0:
+            return
+        removing = set(id(row) for row in rows)
+        new_table = []
+        deleted = []
+        for i in range(len(self.table)):
+            if id(self.table[i]) not in removing:
+                new_table.append(self.table[i])
+            else:
+                deleted.append((i, self.table[i]))
+        if self.undo_log is not None:
+            self.undo_log.append(("DELETE", self, deleted))
+        if self.changes is not None:
+            self.changes += [("DELETE", self.name, tuple(row), None) for i, row in deleted]
+        for i, row in deleted:
+            self.index_remove(row)
+        self.table = new_table
+        self.zones.clear()  # The rows after the first deleted one have moved
+        self.version = next(VERSIONS)
+
+    def replace_row(self, row, values):
+        """
+        Overwrites a row in place, for INSERT OR REPLACE
+        :param row: The row object in the table
+        :param values: The new full row
+        """
+        if self.undo_log is not None:
+            self.undo_log.append(("UPDATE", self, row, list(row)))
+        old = tuple(row)
+        self.index_remove(row)
+        row[:] = values
+        self.index_add(row)
+        for ind in [ind for ind in self.zones if old[ind] != row[ind]]:
+            del self.zones[ind]
+        if self.cluster is not None and old[self.cluster] != row[self.cluster]:
+            self.recluster()
+        if self.changes is not None:
+            self.changes.append(("UPDATE", self.name, old, tuple(row)))
+        self.version = next(VERSIONS)
+
+    """Clustering"""
+
+    def cluster_key(self):
+        """
+        Gets the key the rows of a clustered table are kept sorted by, NULLs first like ORDER BY
+        """
+        ind = self.cluster
+        return lambda row: (row[ind] is not None, row[ind])
+
+    def recluster(self):
+        """
+        Puts the rows back in order after their keys changed.  They're mostly still in order, which the sort
+        takes advantage of
+        """
+        self.table.sort(key=self.cluster_key())
+        self.zones.clear()
+
+    def cluster_range(self, where):
+        """
+        Finds the rows matching the conditions on the cluster column with binary searches
+        :param where: The list of conditions, already checked
+        :return: The start and end of the rows that could match, or None if no condition is on the cluster
+        column
+        """
+        if self.cluster is None:
+            return None
+        ind = self.cluster
+        rows = self.table
+        start, end = None, None
+        for col, op, val in where:
+            if not isinstance(col, str) or op in ("!=", "IN", "NOT IN") or self.resolve(col) != ind:
+                continue
+            if start is None:
+                start, end = 0, len(rows)
+            nulls = bisect.bisect_left(rows, True, key=lambda row: row[ind] is not None)  # Where NULLs end
+            if op == "IS":
+                lo, hi = 0, nulls
+            elif op == "IS NOT":
+                lo, hi = nulls, len(rows)
+            elif val is None:  # Comparing to NULL is never true
+                lo, hi = 0, 0
+            else:
+                try:
+                    left = bisect.bisect_left(rows, val, lo=nulls, key=itemgetter(ind))
+                    right = bisect.bisect_right(rows, val, lo=nulls, key=itemgetter(ind))
+                except TypeError:  # Let the scan raise the error
+                    continue
+                lo, hi = {"=": (left, right), "<": (nulls, left), "<=": (nulls, right), ">": (right, len(rows)),
+                          ">=": (left, len(rows))}[op]
+            start, end = max(start, lo), min(end, hi)
+        if start is None:
+            return None
+        return start, max(start, end)
+
+    """Key indexes"""
+
+    def column_name(self, ind):
+        for name, i in self.headers.items():
+            if i == ind:
+                return name
+
+    def check_not_null(self, row):
+        if self.primary_key is not None and row[self.primary_key] is None:
+            raise ConstraintError("NOT NULL constraint failed: {}".format(self.column_name(self.primary_key)))
+
+    def index_add(self, row):
+        for ind, index in self.indexes.items():
+            if row[ind] is not None:
+                index[row[ind]] = row
+
+    def index_remove(self, row):
+        for ind, index in self.indexes.items():
+            if row[ind] is not None and index.get(row[ind]) is row:
+                del index[row[ind]]
+
+    def key_conflicts(self, row):
+        """
+        Gets the rows already in the table that have the same key as a row in any unique column
+        :param row: The full row
+        :return: The list of conflicting rows, without repeats
+        """
+        conflicts = []
+        for ind, index in self.indexes.items():
+            existing = None if row[ind] is None else index.get(row[ind])
+            if existing is not None and existing is not row and all(existing is not c for c in conflicts):
+                conflicts.append(existing)
+        return conflicts
+
+    def probe(self, where):
+        """
+        Looks the matching rows up in a key index, if one of the conditions is an equality on a unique column
+        :param where: The list of conditions, already checked
+        :return: The list of rows that could match, or None if no index fits
+        """
+        for col, op, val in where:
+            if op != "=" or val is None or not isinstance(col, str):
+                continue
+            ind = self.resolve(col)
+            if ind in self.indexes:
+                row = self.indexes[ind].get(val)
+                return [] if row is None else [row]
+        return None
+
+    def matches(self, where):
+        """
+        Gets the rows matching the where conditions, going through a key index if one fits
+        :param where: The list of conditions, each a list of the column, operator and value
+        :return: The list of row objects
+        """
+        self.check_where(where)
+        rows = self.probe(where)
+        if rows is None:
+            return [self.table[i] for i in self.where(where)]
+        pipeline, params = compile_pipeline("rows", [], where, self.resolve, self.layout())
+        return pipeline(rows, params)
+
+    def touches(self, where, images):
+        """
+        Checks if any row images of other transactions' changes match the where conditions of a read
+        :param where: The list of conditions, each a list of the column, operator and value
+        :param images: The list of old and new rows, as tuples
+        :return: True if one matches, or if the conditions can't be checked against the table anymore
+        """
+        try:
+            self.check_where(where)
+            pipeline, params = compile_pipeline("rows", [], where, self.resolve, self.layout())
+            return len(pipeline(images, params)) > 0
+        except (QueryError, TypeError, IndexError):
+            return True
 
     def delete(self, where):
         """
@@ -172,58 +479,272 @@ class Table:
         """
         # delete all rows in the table
         if len(where) == 0:
-            self.table.clear()
+            if self.undo_log is not None:
+                self.undo_log.append(("DELETE", self, list(enumerate(self.table))))
+            if self.changes is not None:
+                self.changes += [("DELETE", self.name, tuple(row), None) for row in self.table]
+            self.table = []
+            for index in self.indexes.values():
+                index.clear()
+            self.zones.clear()
+            self.version = next(VERSIONS)
 
         # Delete rows based on WHERE
         else:
-            where_true = self.where(where)
-            new_table = []
-            for i in range(len(self.table)):
-                if i not in where_true:
-                    new_table.append(self.table[i])
-            self.table = new_table
+            self.remove_rows(self.matches(where))
 
     def update(self, where, columns_to_get):
         """
         Updates the rows of the table matching the WHERE clause, or all of them if none
         :param where:
-        :param columns_to_get: The columns that need updating, each el as tuple with column name and value
+        :param columns_to_get: The columns that need updating, each el as a list of the column name and the
+        expression to set it to
         """
         # Get the rows to update
         if len(where) > 0:
-            where_true = self.where(where)
+            rows = self.matches(where)
         else:
-            where_true = [i for i in range(len(self.table))]
+            rows = self.table
+        self.update_rows(rows, columns_to_get)
 
+    def resolve_excluded(self, col):
+        """
+        Resolves a column for ON CONFLICT DO UPDATE, where excluded.col is the row that couldn't be inserted,
+        which comes after the existing row
+        """
+        if isinstance(col, str) and col.startswith("excluded."):
+            return len(self.headers) + self.resolve(self.name + col[len("excluded"):])
+        return self.resolve(col)
+
+    def update_rows(self, rows, columns_to_get, excluded=None):
+        """
+        Sets columns of rows in the table
+        :param rows: The row objects to update
+        :param columns_to_get: See update
+        :param excluded: The rows that couldn't be inserted, one for each row, for ON CONFLICT DO UPDATE
+        """
         # Adds the table name to the columns
+        targets = []
         for col in columns_to_get:
-            col[0] = self.append_table_name([col[0]])[0]
+            name = self.append_table_name([col[0]])[0]
+            targets.append((self.resolve(name), self.types[name]))
+
+        # Every SET expression is worked out from the old row before anything is changed
+        source = rows
+        if excluded is None:
+            pipeline, params = compile_pipeline("project", [col[1] for col in columns_to_get], [], self.resolve,
+                                                self.layout())
+        else:
+            pipeline, params = compile_pipeline("project", [col[1] for col in columns_to_get], [],
+                                                self.resolve_excluded, ("excluded",) + self.layout())
+            source = [list(row) + list(other) for row, other in zip(rows, excluded)]
+        try:
+            new_values = pipeline(source, params)
+        except TypeError as e:
+            raise SQLTypeError("Can't evaluate SET expression: {}".format(e))
+
+        # Type checking to make sure you're setting the correct type
+        for values in new_values:
+            for (ind, type), value in zip(targets, values):
+                if value is None:
+                    continue
+                if type == "INTEGER" and not isinstance(value, int):  # If the value is an integer
+                    raise SQLTypeError("Value: {} is not INTEGER".format(value))
+                elif type == "REAL" and not isinstance(value, float):  # If the value is a float
+                    raise SQLTypeError("Value: {} is not REAL".format(value))
+                elif type == "TEXT" and not isinstance(value, str):  # If the value is a string
+                    raise SQLTypeError("Value: {} is not TEXT".format(value))
+
+        # The new keys can't clash with each other or the rows that aren't changing
+        keyed = [k for k, (ind, type) in enumerate(targets) if ind in self.indexes]
+        if len(keyed) > 0:
+            updating = set(id(row) for row in rows)
+            for k in keyed:
+                ind = targets[k][0]
+                seen = set()
+                for row, values in zip(rows, new_values):
+                    key = values[k]
+                    if key is None:
+                        if ind == self.primary_key:
+                            raise ConstraintError("NOT NULL constraint failed: {}".format(self.column_name(ind)))
+                        continue
+                    existing = self.indexes[ind].get(key)
+                    if key in seen or (existing is not None and id(existing) not in updating):
+                        raise ConstraintError("UNIQUE constraint failed: {}".format(self.column_name(ind)))
+                    seen.add(key)
+            for row in rows:
+                self.index_remove(row)
 
         # Updates the actual table
-        for i, row in enumerate(self.table):
-            if i in where_true:
-                for col in columns_to_get:
-
-                    # Type checking to make sure you're setting the correct type
-                    if self.types[col[0]] == "INTEGER":  # If the value is an integer
-                        if not isinstance(col[1], int) and col[1] is not None:
-                            raise SQLTypeError("Value: {} is not INTEGER".format(col[1]))
-                    elif self.types[col[0]] == "REAL":  # If the value is a float
-                        if not isinstance(col[1], float) and row[i] is not None:
-                            raise SQLTypeError("Value: {} is not REAL".format(col[1]))
-                    elif self.types[col[0]] == "TEXT":  # If the value is a string
-                        if not isinstance(col[1], str) and row[i] is not None:
-                            raise SQLTypeError("Value: {} is not TEXT".format(col[1]))
-
-                    row[self.headers[col[0]]] = col[1]
-
-    def select(self, columns, order_by, distinct, where, collations, aggregates):
-        """
-        Selects records from the table
-        :param columns:
+        for row, values in zip(rows, new_values):
+            if self.undo_log is not None:  # Remember the old image of the row
+                self.undo_log.append(("UPDATE", self, row, list(row)))
+            old = tuple(row)
+            for (ind, type), value in zip(targets, values):
+                row[ind] = value
+            if self.changes is not None:
+                self.changes.append(("UPDATE", self.name, old, tuple(row)))
+        if len(keyed) > 0:
+            for row in rows:
+                self.index_add(row)
+        for ind, type in targets:
+            self.zones.pop(ind, None)
+        if self.cluster is not None and any(ind == self.cluster for ind, type in targets):
+            self.recluster()
+        self.version = next(VERSIONS)
+
+    def undo(self, entry):
+        """
+        Reverts a single change recorded in the undo log.  Entries are undone newest first, so the
+        table is always in the exact state the change left it in
+        :param entry: The undo log entry (the operation, this table, then the saved data)
+        """
+        op = entry[0]
+        if op == "INSERT":  # Drop everything appended since the insert started
+            for row in self.table[entry[2]:]:
+                self.index_remove(row)
+            del self.table[entry[2]:]
+        elif op == "DELETE":  # Put the deleted rows back where they were
+            for i, row in entry[2]:
+                self.table.insert(i, row)
+                self.index_add(row)
+        elif op == "UPDATE":  # Restore the old image of the row in place
+            self.index_remove(entry[2])
+            entry[2][:] = entry[3]
+            self.index_add(entry[2])
+            if self.cluster is not None:
+                self.recluster()
+        elif op == "PLACE":  # Take out the rows put in order in a clustered table
+            placed = set(id(row) for row in entry[2])
+            for row in entry[2]:
+                self.index_remove(row)
+            self.table = [row for row in self.table if id(row) not in placed]
+        self.zones.clear()
+        self.version = next(VERSIONS)
+
+    @staticmethod
+    def sort_key(rows, ind, collation):
+        """
+        Builds the key to sort the rows by for a single column.  NULLs sort before everything else
+        :param rows: The rows that will be sorted
+        :param ind: The index of the column to sort on
+        :param collation: The key function of the collation to sort with, or None
+        :return: The key function for list.sort
+        """
+        nulls = False
+        for row in rows:
+            if row[ind] is None:
+                nulls = True
+                break
+
+        if collation is None and not nulls:
+            return itemgetter(ind)
+        elif collation is None:
+            return lambda row: (row[ind] is not None, row[ind])
+        elif not nulls:
+            return lambda row: collation(row[ind])
+        return lambda row: (False, None) if row[ind] is None else (True, collation(row[ind]))
+
+    @staticmethod
+    def sort_rows(rows, order_by_ind, directions, collations):
+        """
+        Sorts the rows in place on every ORDER BY column.  Sorts on the last column first, since the sort
+        is stable the earlier columns then only break ties by the later ones
+        :param rows: The rows to sort
+        :param order_by_ind: The indexes of the columns to sort on
+        :param directions: "A" or "D" for each column
+        :param collations: The key function of each column's collation, or None
+        :return: The sorted rows
+        """
+        for i in range(len(order_by_ind) - 1, -1, -1):
+            rows.sort(key=Table.sort_key(rows, order_by_ind[i], collations[i]), reverse=directions[i] == "D")
+        return rows
+
+    def vectorized_select(self, columns, where, aggregates, agg_found, runs=None):
+        """
+        Runs a select without an ORDER BY on the NumPy arrays of the table
+        :param runs: The runs of rows from approximate.sample, or None to read every row
+        :return: The selected rows, or None if part of the query can't be vectorized
+        """
+        indexes = None if runs is None else vectorized.sampled(runs)
+        if len(where) > 0:
+            indexes = vectorized.where(self, where, indexes)
+            if indexes is None:
+                return None
+
+        names = []
+        for col in columns:
+            if not isinstance(col, str):  # Expressions go through the compiled pipeline
+                return None
+            names.append(self.append_table_name([col])[0])
+            if names[-1] not in self.headers:
+                raise QueryError("{} is not a column name in {}".format(col, self.name))
+
+        if agg_found:
+            record = []
+            for func, name in zip(aggregates, names):
+                value = vectorized.aggregate(self, func, name, indexes)
+                if value is None:
+                    return None
+                record.append(value[0])
+            return [tuple(record)]
+        elif indexes is None:  # Nothing to gain over the compiled projection
+            return None
+        return vectorized.project(self, names, indexes)
+
+    def sort_run_size(self, budget):
+        """
+        Works out how many rows can be sorted at once within the memory budget
+        :param budget: The memory budget in bytes, or None for no limit
+        :return: The number of rows per sorted run, or None for no limit
+        """
+        if budget is None:
+            return None
+        sample = self.table[:100]
+        row_size = sum(sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row) for row in sample) / len(sample)
+        return max(1, int(budget // row_size))
+
+    def external_select(self, columns, distinct, where, order_by_ind, directions, collations, run_size):
+        """
+        Selects records with an ORDER BY too big for the memory budget.  The table is filtered and sorted a
+        run at a time, the runs are spilled to temporary files and then merged back as the rows are read
+        :return: A generator of the selected rows
+        """
+        try:
+            pipeline, params = compile_pipeline("rows", [], where, self.resolve, self.layout())
+            runs = []
+            for start in range(0, len(self.table), run_size):
+                run = pipeline(self.table[start:start + run_size], params)
+                runs.append(external_run(self.sort_rows(run, order_by_ind, directions, collations)))
+        except TypeError as e:
+            raise SQLTypeError("Can't evaluate expression: {}".format(e))
+
+        # Orders the rows the same way sort_rows does, but on every column at once
+        descending = tuple(direction == "D" for direction in directions)
+        keys = list(zip(order_by_ind, collations))
+
+        def merge_key(row):
+            return OrderKey(tuple((False, None) if row[i] is None else (True, row[i] if c is None else c(row[i]))
+                                  for i, c in keys), descending)
+
+        pipeline, params = compile_pipeline("project", columns, [], self.resolve, self.layout())
+        rows = chain.from_iterable(pipeline(batch, params)
+                                   for batch in batches(external_merge(runs, merge_key), run_size))
+        if distinct:
+            rows = hash_distinct(rows)
+        return rows
+
+    def select(self, columns, order_by, distinct, where, collations, aggregates, budget=None, sample=None):
+        """
+        Selects records from the table.  The WHERE clause and the columns are compiled into one function,
+        which is reused by every query of the same shape
+        :param columns: The column names or expression trees to select
         :param order_by:
+        :param budget: The memory budget in bytes for sorting, past which the sort spills to disk
+        :param sample: The method, percent and seed of a TABLESAMPLE, or None to read every row
+        :return: The list of selected rows, or a generator of them if the sort spilled to disk
         """
-        if len(self.table) == 0:
+        if len(self.table) == 0 and aggregates.count(None) == len(aggregates):  # Aggregates still give a row
             return []
 
         order_by_ind = list()
@@ -233,7 +754,7 @@ class Table:
         # Replaces * with columns
         new_columns = list()
         for col in columns:
-            ind = col.find("*")
+            ind = col.find("*") if isinstance(col, str) else -1
             if col == "*":  # Get everything
                 new_columns += [k for k in self.headers.keys()]
             elif ind != -1:  # get everything from a specific table
@@ -248,25 +769,30 @@ class Table:
                 new_columns.append(col)
 
         columns = new_columns
-        matching_rows = self.table
-
-        # Handles the where clause if it exists
-        if len(where) > 0:
-            where_true = self.where(where)
-            new_matches = []
-            for i in where_true:
-                new_matches.append(matching_rows[i])
-            matching_rows = new_matches
+        self.check_where(where)
+        runs = None
+        if sample is not None:  # Only the sampled rows are read, so there's nothing for an index to narrow
+            runs = approximate.sample(len(self.table), *sample)
+            source = None
+            bounds = None
+        else:
+            source = self.probe(where)  # The rows from a key index, if the WHERE has a key lookup
+            bounds = self.cluster_range(where) if source is None else None
+        if bounds is not None:  # Or the range of a clustered table the conditions on its key allow
+            source = self.table[bounds[0]:bounds[1]]
+        elif source is None and runs is None:  # Or the rows in the chunks whose zone maps say they could match
+            source = zonemaps.rows(self, where)
 
-        # Handles removing duplicate rows
-        if distinct:
-            matching_rows = set(matching_rows)
-            matching_rows = list(matching_rows)
+        # Uh-Oh, combining an aggregate with a non-aggregate
+        agg_found = aggregates.count(None) != len(aggregates)
+        if agg_found and None in aggregates:
+            raise QueryError("Cannot combine aggregate with non aggregate")
 
         # Gets the indexes to sort by
+        directions = []
+        presorted = False
         if len(order_by) > 0:
             # Separates the order_by table names and their directions
-            directions = []
             new_order_by = []
             for order in order_by:
                 new_order_by.append(order[1:])
@@ -278,140 +804,88 @@ class Table:
             for i in range(len(order_by)):
                 for j in range(len(headers)):
                     if order_by[i] == headers[j]:
-                        order_by_ind.append(j)
+                        order_by_ind.append(self.headers[headers[j]])
             if len(order_by_ind) != len(set(order_by)):  # makes sure all the columns were valid
                 raise QueryError("Cannot Order records with non-existent column")
 
-            # Are we ordering the data to be returned
-            if directions[0] == "A":
-                if collations[0] is not None:
-                    temp = {row[order_by_ind[0]]: row for row in matching_rows}
-                    keys = [k for k in temp]
-                    keys.sort(key=functools.cmp_to_key(collations[0]))
-                    matching_rows = []
-                    for val in keys:
-                        matching_rows.append(temp[val])
-                else:
-                    matching_rows.sort(key=itemgetter(order_by_ind[0]))
-
-            elif directions[0] == "D":
-                if collations[0] is not None:
-                    temp = {row[order_by_ind[0]]: row for row in matching_rows}
-                    keys = [k for k in temp]
-                    keys.sort(reverse=True, key=functools.cmp_to_key(collations[0]))
-                    matching_rows = []
-                    for val in keys:
-                        matching_rows.append(temp[val])
-                else:
-                    matching_rows.sort(reverse=True, key=itemgetter(order_by_ind[0]))
-
-            new_matching_rows = matching_rows.copy()
-            not_duplicate = []
-
-            # Handles extra sorts for duplicate columns
-            for i in range(1, len(order_by_ind)):
-                prev_col = order_by_ind[i-1]
-                curr_dup_rows, dup_rows = [], []
-                j = 0
-
-                while j < len(matching_rows):
-
-                    # Keep going through duplicates as you find them
-                    dup_found = False
-
-                    while j + 1 < len(matching_rows) and j not in not_duplicate:
-                        # Check if matching
-                        if collations[i - 1] is not None:
-                            matched = collations[0](matching_rows[j][prev_col], matching_rows[j + 1][prev_col])
-                            if not matched:  # matched == 0, so same
-                                matched = True
-                            else:
-                                matched = False
-                        else:
-                            matched = matching_rows[j][prev_col] == matching_rows[j + 1][prev_col]
-
-                        if not matched:
-                            break
-
-                        dup_found = True
-                        curr_dup_rows.append(matching_rows[j])
-                        j += 1
-
-                    # One last duplicate to add to the tail end
-                    if dup_found and j not in not_duplicate:
-                        curr_dup_rows.append(matching_rows[j])
-                        dup_rows.append(curr_dup_rows)
-                        curr_dup_rows = []
-
-                    # Was not duplicated so add it to list of rows to avoid
-                    elif j not in not_duplicate:
-                        not_duplicate.append(j)
-
-                    j += 1
-
-                # Are we ordering the data to be returned
-                for matches in dup_rows:
-                    if directions[i] == "A":
-                        if collations[i] is not None:
-                            temp = {row[order_by_ind[i]]: row for row in matches}
-                            keys = [k for k in temp]
-                            keys.sort(key=functools.cmp_to_key(collations[i]))
-                            matches = []
-                            for val in keys:
-                                matches.append(temp[val])
-                        else:
-                            matches.sort(key=itemgetter(order_by_ind[i]))
-                    elif directions[i] == "D":
-                        if collations[i] is not None:
-                            temp = {row[order_by_ind[i]]: row for row in matches}
-                            keys = [k for k in temp]
-                            keys.sort(reverse=True, key=functools.cmp_to_key(collations[i]))
-                            matches = []
-                            for val in keys:
-                                matches.append(temp[val])
-                        else:
-                            matches.sort(reverse=True, key=itemgetter(order_by_ind[i]))
-
-                # Replace the data in the table
-                dup_rows = [item for t in dup_rows for item in t]
-                dup = 0
-                for row in range(len(matching_rows)):
-                    if row not in not_duplicate:
-                        new_matching_rows[row] = dup_rows[dup]
-                        dup += 1
-
-                matching_rows = new_matching_rows
-
-        # Gets the aggregates now to avoid wasted runtime by repeatedly doing it in a loop
-        agg_found = False
-        for i in range(len(aggregates)):
-            if aggregates[i] == "max":
-                aggregates[i] = max([r[self.headers[columns[i]]] for r in matching_rows])
-                agg_found = True
-            elif aggregates[i] == "min":
-                aggregates[i] = min([r[self.headers[columns[i]]] for r in matching_rows])
-                agg_found = True
-
-        # Uh-Oh, combining an aggregate with a non-aggregate
-        if agg_found and None in aggregates:
-            raise QueryError("Cannot combine aggregate with non aggregate")
-
-        # Create single row of aggregate data and return
+            # A clustered table is already in order on its key
+            presorted = self.cluster is not None and order_by_ind == [self.cluster] and directions == ["A"] and \
+                collations[0] is None
+
+            # Too big to sort within the memory budget, so sort it in runs on disk
+            run_size = self.sort_run_size(budget)
+            scanned = self.table if source is None else source
+            if not agg_found and not presorted and runs is None and run_size is not None and len(scanned) > run_size:
+                return self.external_select(columns, distinct, where, order_by_ind, directions, collations, run_size)
+
+        # Numeric filters, aggregates and projections can be run on NumPy arrays instead
+        if vectorized.usable(self) and len(order_by) == 0 and source is None:
+            result = self.vectorized_select(columns, where, aggregates, agg_found, runs)
+            if result is not None:
+                if distinct:
+                    result = list(hash_distinct(result))
+                return result
+
+        if runs is not None:
+            source = approximate.gather(self.table, runs)
+        elif source is None:
+            source = self.table
+        try:
+            # Nothing to do between filtering and projecting, so do both in one pass
+            if (len(order_by) == 0 or presorted) and not agg_found:
+                pipeline, params = compile_pipeline("scan", columns, where, self.resolve, self.layout())
+                matching_rows = pipeline(source, params)
+                if distinct:
+                    matching_rows = list(hash_distinct(matching_rows))
+                return matching_rows
+
+            # Handles the where clause if it exists
+            matching_rows = source
+            if len(where) > 0:
+                pipeline, params = compile_pipeline("rows", [], where, self.resolve, self.layout())
+                matching_rows = pipeline(matching_rows, params)
+        except TypeError as e:
+            raise SQLTypeError("Can't evaluate expression: {}".format(e))
+
+        # Sort a copy so the order of the table itself is left alone.  The order doesn't matter for aggregates
+        if len(order_by_ind) > 0 and not agg_found:
+            matching_rows = self.sort_rows(list(matching_rows), order_by_ind, directions, collations)
+
+        # Create single row of aggregate data, skipping NULLs
         if agg_found:
+            for i in range(len(aggregates)):
+                ind = self.resolve(columns[i])
+                values = (r[ind] for r in matching_rows if r[ind] is not None)
+                if aggregates[i] == "approx_count_distinct":  # Streamed through a fixed size sketch
+                    aggregates[i] = approximate.count_distinct(values)
+                    continue
+                elif isinstance(aggregates[i], tuple):  # approx_quantile, streamed through a reservoir
+                    aggregates[i] = approximate.quantile(values, aggregates[i][1])
+                    continue
+                values = list(values)
+                if aggregates[i] == "max":
+                    aggregates[i] = max(values, default=None)
+                elif aggregates[i] == "min":
+                    aggregates[i] = min(values, default=None)
+                elif aggregates[i] == "sum":
+                    if len(values) == 0:
+                        aggregates[i] = None
+                    elif any(isinstance(v, float) for v in values):  # The same exactly rounded sum NumPy gives
+                        aggregates[i] = math.fsum(values)
+                    else:
+                        aggregates[i] = sum(values)
             matching_rows = [tuple(aggregates)]
 
         # Nah, just gather the rows normally
         else:
-            # Gather the actual data
-            new_matching_rows = []
-            for row in matching_rows:
-                record = list()
-                for col in columns:
-                    if col not in self.headers:  # column does not exist
-                        raise QueryError("{} is not a column name in {}".format(col, self.name))
-                    record.append(row[self.headers[col]])
-                new_matching_rows.append(tuple(record))
-            matching_rows = new_matching_rows
+            pipeline, params = compile_pipeline("project", columns, [], self.resolve, self.layout())
+            try:
+                matching_rows = pipeline(matching_rows, params)
+            except TypeError as e:
+                raise SQLTypeError("Can't evaluate expression: {}".format(e))
 
-        return matching_rows
+        # Handles removing duplicate rows, only hashing the columns that were selected
+        if distinct:
+            matching_rows = list(hash_distinct(matching_rows))
 
+        return matching_rows
@@ -2,42 +2,94 @@
 This class is derived class of a table
 """
 from Errors import QueryError
-from Table import Table
+from Table import Table, VERSIONS
+from expressions import map_columns, unparse
+from tokenizer import keyword_positions
 
 
 class View:
     def __init__(self, name, query, database):
         """
-        Initializes the view
+        Initializes the view, parsing its query once so it can be merged into the queries run on it
         :param query:
         """
         self.name = name
         self.query = query
         self.database = database
         self.columns = list()
+        self.plan = None
+        self.version = next(VERSIONS)  # Views never change, but one with the same name might replace it
 
-        # Parses the query to get the data it needs
-        i = 1
-        while query[i] != "FROM":
-            if query[i] == ",":
-                i += 1
-                continue
-            if query[i + 1] == "," or query[i + 1] == "FROM":  # preceded by a comma or FROM is next
-                self.columns.append(query[i])
+        # Simple views are kept as their plan, everything else has to be run in full
+        unions = keyword_positions(query, "UNION")
+        if len(unions) > 0:
+            plan = database.parse_select(query[:unions[0]] + [";"])
+        else:
+            plan = database.parse_select(query)
+            if len(plan["joins"]) == 0 and not plan["distinct"] and plan["sample"] is None and \
+                    plan["aggregates"].count(None) == len(plan["aggregates"]) and \
+                    all(isinstance(col, str) for col in plan["columns"]):
+                self.plan = plan
+        self.sub_name = plan["name"]
+
+        # Gets the columns of the view, replacing '*'
+        for col in plan["columns"]:
+            if col == "*":
+                for sub_name in [self.sub_name] + [join[1] for join in plan["joins"]]:
+                    self.columns += database.column_names(sub_name)
+            elif isinstance(col, str):
+                self.columns.append(col)
+            else:  # An expression, named by its text
+                self.columns.append(unparse(col))
+
+    def base_column(self, col):
+        """
+        Finds the column of the underlying table that a column of the view comes from
+        :param col: The column name used on the view, optionally with the view's name in front of it
+        :return: The column name to use on the underlying table
+        """
+        if col in self.columns:
+            return col
+        bare = col[col.find(".") + 1:]
+        if col.find(".") != -1 and col[:col.find(".")] != self.name:
+            raise QueryError("{} is not a column name in {}".format(col, self.name))
+        for view_col in self.columns:
+            if view_col[view_col.find(".") + 1:] == bare:
+                return view_col
+        raise QueryError("{} is not a column name in {}".format(col, self.name))
+
+    def select(self, columns_to_get, order_by, distinct, where, collations, aggregates, sample=None):
+        # Correlated subqueries are called with the view's columns, so they need the view's rows
+        if self.plan is None or any(hasattr(condition[2], "outer") for condition in where):
+            return self.materialize_select(columns_to_get, order_by, distinct, where, collations, aggregates,
+                                           sample)
+
+        # Merges the query into the view's own, so the WHERE and the columns reach the underlying table
+        columns = []
+        for col in columns_to_get:
+            if col == "*" or col == self.name + ".*":
+                columns += self.columns
+            elif isinstance(col, str):
+                columns.append(self.base_column(col))
             else:
-                raise QueryError("Missing comma separator")
-            i += 1
-        i += 2
-        self.sub_name = query[i-1]
+                columns.append(map_columns(col, self.base_column))
+        # The view's own conditions are already on the underlying table
+        where = self.plan["where"] + [[c[0] if c[0] is None else self.base_column(c[0]), c[1], c[2]] for c in where]
+        if len(order_by) == 0:  # The view's ordering only matters if the query doesn't have its own
+            order_by = list(self.plan["order_by"])
+            collations = list(self.plan["collations"])
+        order_by = [order[0] + self.base_column(order[1:]) for order in order_by]
 
-        # removes '*'
-        for col in self.columns:
-            if col == '*':
-                self.columns = [h for h in self.database.tables[self.sub_name].headers.keys()]
+        # Sampling the underlying table before the view's own conditions picks each of the view's rows alike
+        return self.database.select(columns, self.sub_name, order_by, distinct, where, collations, aggregates,
+                                    sample)
 
-    def select(self, columns_to_get, order_by, distinct, where, collations, aggregates):
-        data = self.database.select_prep(self.query)
-        table = Table(self.sub_name, self.columns, False, [self.sub_name], {})
+    def materialize_select(self, columns_to_get, order_by, distinct, where, collations, aggregates, sample=None):
+        """
+        Runs the whole query of the view and then the query on its output, for views that can't be merged
+        """
+        data = list(self.database.select_prep(self.query))
+        table = Table(self.sub_name, [], True, [self.sub_name], {})
         table.table = data
 
         # Sets the types/headers for the table
@@ -49,4 +101,5 @@ class View:
             if found != -1 and col[:found] not in table.rel_tables:
                 table.rel_tables.append(col[:found])
 
-        return table.select(columns_to_get, order_by, distinct, where, collations, aggregates)
\ No newline at end of file
+        return table.select(columns_to_get, order_by, distinct, where, collations, aggregates,
+                            self.database.sort_budget, sample)
@@ -0,0 +1,161 @@
+"""
+This class represents the write-ahead log of a database, which holds the statements of every committed
+transaction so the database can be rebuilt when it's connected to again
+"""
+import json
+import os
+import struct
+import threading
+import zlib
+from Errors import TransactionError
+
+_HEADER = struct.Struct("<II")  # The length and checksum of a record
+_SYNC_MODES = ["OFF", "NORMAL", "FULL"]
+
+
+class WriteAheadLog:
+    def __init__(self, path, sync_mode="FULL", start_seq=0):
+        """
+        Opens the log, creating it if it doesn't exist
+        :param path: The path of the log file
+        :param sync_mode: "OFF" leaves writing to the OS buffers, "NORMAL" hands every record to the OS and
+        "FULL" also fsyncs before a commit returns, batching concurrent commits into one fsync
+        :param start_seq: The sequence number the last checkpoint got up to, if the log is empty
+        """
+        if sync_mode not in _SYNC_MODES:
+            raise TransactionError("Sync mode {} is not one of {}".format(sync_mode, ", ".join(_SYNC_MODES)))
+        self.path = path
+        self.sync_mode = sync_mode
+        self.ends = [(seq, end) for seq, statements, end in WriteAheadLog.scan(path)]  # Where each record ends
+        self.file = open(path, "ab")
+        self.lock = threading.Condition()
+        self.written = self.ends[-1][0] if len(self.ends) > 0 else start_seq  # The last record written
+        self.synced = self.written  # The sequence number of the last record known to be on disk
+        self.syncing = False  # Is a commit fsyncing on behalf of everyone waiting
+        self.fsyncs = 0  # How many fsyncs the log has done
+
+    @staticmethod
+    def scan(path):
+        """
+        Reads every complete record in a log, cutting off a torn record at the end left by a crash
+        :param path: The path of the log file
+        :return: The list of records, each a tuple of its sequence number, the list of statements of its
+        transaction and the offset it ends at
+        """
+        records = []
+        if not os.path.exists(path):
+            return records
+        with open(path, "rb") as file:
+            data = file.read()
+
+        i = 0
+        while i + _HEADER.size <= len(data):
+            length, checksum = _HEADER.unpack_from(data, i)
+            payload = data[i + _HEADER.size:i + _HEADER.size + length]
+            if len(payload) != length or zlib.crc32(payload) != checksum:
+                break
+            seq, statements = json.loads(payload.decode("utf-8"))
+            i += _HEADER.size + length
+            records.append((seq, statements, i))
+
+        # Cuts off the torn record so new records don't end up behind it
+        if i < len(data):
+            with open(path, "r+b") as file:
+                file.truncate(i)
+        return records
+
+    @staticmethod
+    def read(path, after=0):
+        """
+        Reads the transactions in a log that come after a checkpoint
+        :param path: The path of the log file
+        :param after: The sequence number the checkpoint got up to
+        :return: The list of records, each the list of statements of a transaction
+        """
+        return [statements for seq, statements, end in WriteAheadLog.scan(path) if seq > after]
+
+    def write(self, statements):
+        """
+        Appends the record of a committed transaction
+        :param statements: The statements of the transaction, in order
+        :return: The sequence number of the record, to wait on with sync
+        """
+        with self.lock:
+            payload = json.dumps([self.written + 1, statements]).encode("utf-8")
+            self.file.write(_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            if self.sync_mode != "OFF":
+                self.file.flush()
+            self.written += 1
+            self.ends.append((self.written, self.file.tell()))
+            return self.written
+
+    def sync(self, seq):
+        """
+        Waits until a record is on disk.  Whoever gets here first fsyncs every record written so far, and
+        the commits that arrive during that fsync are all covered by the next one (group commit)
+        :param seq: The sequence number from write
+        """
+        if self.sync_mode != "FULL":
+            return
+        with self.lock:
+            while self.synced < seq:
+                if self.syncing:  # Someone else is already fsyncing, wait for them
+                    self.lock.wait()
+                    continue
+
+                self.syncing = True
+                target = self.written
+                self.file.flush()
+                self.lock.release()
+                try:
+                    os.fsync(self.file.fileno())
+                finally:
+                    self.lock.acquire()
+                    self.syncing = False
+                self.synced = max(self.synced, target)
+                self.fsyncs += 1
+                self.lock.notify_all()
+
+    def size(self):
+        """
+        Gets the size of the log file in bytes
+        """
+        with self.lock:
+            return self.ends[-1][1] if len(self.ends) > 0 else 0
+
+    def truncate(self, seq):
+        """
+        Drops the records a checkpoint has folded into the main database file, keeping the ones after it.
+        Only the records after the checkpoint are copied while commits wait
+        :param seq: The sequence number the checkpoint got up to
+        :return: How many records were dropped
+        """
+        with self.lock:
+            done = [end for record_seq, end in self.ends if record_seq <= seq]
+            if len(done) == 0:
+                return 0
+            cut = done[-1]
+            self.file.flush()
+            with open(self.path, "rb") as file:
+                file.seek(cut)
+                tail = file.read()
+
+            with open(self.path + "-tmp", "wb") as file:
+                file.write(tail)
+                file.flush()
+                os.fsync(file.fileno())
+            self.file.close()
+            os.replace(self.path + "-tmp", self.path)
+            self.file = open(self.path, "ab")
+            self.ends = [(record_seq, end - cut) for record_seq, end in self.ends if record_seq > seq]
+            return len(done)
+
+    def close(self):
+        """
+        Closes the log, making sure everything written is on disk
+        """
+        with self.lock:
+            self.file.flush()
+            if self.sync_mode != "OFF":
+                os.fsync(self.file.fileno())
+            self.file.close()
@@ -0,0 +1,201 @@
+"""
+This file holds TABLESAMPLE and the approximate aggregates, which trade a little accuracy for reading far less.
+A sample picks its rows by jumping straight from one to the next, so it costs the rows it keeps and not the
+size of the table.  approx_count_distinct is a HyperLogLog sketch and approx_quantile a reservoir sample, both
+computed in one pass over the values with a fixed amount of memory however many there are
+"""
+import hashlib
+import math
+import random
+import struct
+import sys
+from itertools import chain, islice
+
+BLOCK_SIZE = 1024  # The rows in each block SYSTEM sampling picks or skips
+PRECISION = 14  # HyperLogLog keeps 2 ** 14 registers, for about 0.8% standard error
+RESERVOIR_SIZE = 10000  # The values kept for approx_quantile, for about 1% error in the rank
+SEED = 0  # The reservoir is seeded so the same data always gives the same answer
+MASK = (1 << 64) - 1
+_REGISTERS = 1 << PRECISION
+_RANK_BITS = 64 - PRECISION
+_END = object()
+
+
+def _uniform(rand):
+    """
+    Gets a random number in (0, 1), so its log is always defined
+    """
+    return rand.random() or sys.float_info.min
+
+
+def _skips(rand, n, probability):
+    """
+    Generates the positions below n that are each picked with the probability, jumping the geometrically
+    distributed gap between one and the next instead of rolling for each
+    """
+    if probability >= 1:
+        yield from range(n)
+        return
+    if probability <= 0:
+        return
+    scale = 1 / math.log(1 - probability)
+    position = -1
+    while True:
+        position += int(math.log(_uniform(rand)) * scale) + 1
+        if position >= n:
+            return
+        yield position
+
+
+def sample(n, method, percent, seed=None):
+    """
+    Picks the rows of a TABLESAMPLE
+    :param n: The number of rows in the table
+    :param method: "BERNOULLI" to pick each row, or "SYSTEM" to pick each block of rows, with the probability
+    :param percent: The percent of the rows to pick, from 0 to 100
+    :param seed: The seed from REPEATABLE, or None for a different sample every time
+    :return: The list of the start and end of each run of picked rows, in order
+    """
+    rand = random.Random(seed)
+    if method == "BERNOULLI":
+        return [(i, i + 1) for i in _skips(rand, n, percent / 100)]
+
+    runs = []
+    for block in _skips(rand, (n + BLOCK_SIZE - 1) // BLOCK_SIZE, percent / 100):
+        start = block * BLOCK_SIZE
+        if len(runs) > 0 and runs[-1][1] == start:  # Neighbouring blocks are read as one
+            runs[-1] = (runs[-1][0], min(n, start + BLOCK_SIZE))
+        else:
+            runs.append((start, min(n, start + BLOCK_SIZE)))
+    return runs
+
+
+def gather(rows, runs):
+    """
+    Gets the sampled rows of a table
+    :param rows: The rows of the table
+    :param runs: The runs from sample
+    :return: The list of rows
+    """
+    return list(chain.from_iterable(rows[start:end] for start, end in runs))
+
+
+def mix(h):
+    """
+    Scrambles a 64 bit integer so every bit of the result depends on every bit of it (the splitmix64 finalizer)
+    """
+    h = ((h ^ (h >> 30)) * 0xbf58476d1ce4e5b9) & MASK
+    h = ((h ^ (h >> 27)) * 0x94d049bb133111eb) & MASK
+    return h ^ (h >> 31)
+
+
+def value_hash(value):
+    """
+    Hashes a value to 64 bits the same way in every process.  Whole numbers hash the same as ints and floats,
+    so they count once like they do for DISTINCT
+    """
+    if isinstance(value, float):
+        if value.is_integer() and -2 ** 63 <= value < 2 ** 63:
+            value = int(value)
+        else:
+            return mix(struct.unpack("<Q", struct.pack("<d", value))[0])
+    if isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+        return mix(value & MASK)
+    if isinstance(value, str):
+        data = value.encode("utf-8", "surrogatepass")
+    else:
+        data = repr(value).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def estimate(registers):
+    """
+    Estimates the number of distinct values from the registers of a HyperLogLog sketch
+    :param registers: The rank of each register, 0 if no value landed in it
+    """
+    registers = list(registers)
+    alpha = 0.7213 / (1 + 1.079 / _REGISTERS)
+    raw = alpha * _REGISTERS * _REGISTERS / sum(2.0 ** -rank for rank in registers)
+    zeros = registers.count(0)
+    if raw <= 2.5 * _REGISTERS and zeros > 0:  # Few values, so counting the empty registers is more accurate
+        return round(_REGISTERS * math.log(_REGISTERS / zeros))
+    return round(raw)
+
+
+def count_distinct(values):
+    """
+    Estimates how many distinct values there are with a HyperLogLog sketch
+    :param values: An iterable of the values, without NULLs
+    :return: The estimated count
+    """
+    registers = bytearray(_REGISTERS)
+    low = (1 << _RANK_BITS) - 1
+    for value in values:
+        h = value_hash(value)
+        register = h >> _RANK_BITS
+        rank = _RANK_BITS + 1 - (h & low).bit_length()  # The position of the first 1 bit
+        if rank > registers[register]:
+            registers[register] = rank
+    return estimate(registers)
+
+
+def pick(ordered, q):
+    """
+    Gets the value at a quantile of a sorted list, or None if it's empty
+    :param q: The quantile from 0 to 1
+    """
+    if len(ordered) == 0:
+        return None
+    return ordered[round(q * (len(ordered) - 1))]
+
+
+def _swaps(size, seed):
+    """
+    Generates how many values to skip past a full reservoir before the next one swaps in, and the slot it
+    takes (Algorithm L).  None of it depends on the values, so the same seed always keeps the same positions
+    """
+    rand = random.Random(seed)
+    weight = math.exp(math.log(_uniform(rand)) / size)
+    while True:
+        yield int(math.log(_uniform(rand)) / math.log(1 - weight)), rand.randrange(size)
+        weight *= math.exp(math.log(_uniform(rand)) / size)
+
+
+def positions(n, size=RESERVOIR_SIZE, seed=SEED):
+    """
+    Gets the positions of the values quantile would keep out of n of them, so values already in an array can
+    be sampled exactly the same way without streaming through them
+    :param n: The number of values
+    :return: The list of positions, in no particular order
+    """
+    reservoir = list(range(min(n, size)))
+    if n > size:
+        position = size - 1
+        for skip, slot in _swaps(size, seed):
+            position += skip + 1
+            if position >= n:
+                break
+            reservoir[slot] = position
+    return reservoir
+
+
+def quantile(values, q, size=RESERVOIR_SIZE, seed=SEED):
+    """
+    Estimates a quantile from a uniform sample of the values, kept with reservoir sampling.  Once the
+    reservoir is full it jumps straight to the next value to swap in, so most values are only skipped over
+    :param values: An iterable of the values, without NULLs
+    :param q: The quantile from 0 to 1
+    :param size: The most values to keep
+    :param seed: The seed of the sample
+    :return: One of the values, or None if there weren't any
+    """
+    values = iter(values)
+    reservoir = list(islice(values, size))
+    if len(reservoir) == size:
+        for skip, slot in _swaps(size, seed):
+            value = next(islice(values, skip, None), _END)
+            if value is _END:
+                break
+            reservoir[slot] = value
+    reservoir.sort()
+    return pick(reservoir, q)
@@ -0,0 +1,232 @@
+"""
+This file is the transaction throughput benchmark, which runs several connections doing a mix of reads and
+writes against one database and reports how each transaction mode holds up under contention.  It sweeps
+the isolation modes, transaction sizes, table sizes and the number of tables the transactions are spread
+over, and for each run reports the committed transactions per second, how many were aborted by a
+TransactionError and the latency percentiles of the committed ones.
+
+The connections either run on their own threads or are interleaved a statement at a time on one thread
+in a seeded random order, which makes a run repeatable.  Run it as
+    python benchmark.py --connections 4 --modes DEFERRED,EXCLUSIVE --tx-sizes 1,10 --table-sizes 100 --tables 1,4
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from Connection import Connection, _ALL_DATABASES, _LOCKS, _TABLE_LOCKS
+from Errors import TransactionError
+
+_MODES = ["DEFERRED", "IMMEDIATE", "EXCLUSIVE", "OPTIMISTIC"]
+_LOAD_CHUNK = 1000  # The rows put in each INSERT when filling the table
+_RUNS = itertools.count(1)  # So every run gets a database of its own
+
+
+def load(conn, rows, tables):
+    """
+    Creates the benchmark tables and fills them, in one transaction
+    :param conn: The Connection
+    :param rows: The number of rows in each table
+    :param tables: The number of tables
+    """
+    for t in range(tables):
+        conn.execute("CREATE TABLE bench{} (id INTEGER, val INTEGER);".format(t))
+    conn.execute("BEGIN TRANSACTION;")
+    for t in range(tables):
+        for start in range(0, rows, _LOAD_CHUNK):
+            conn.executemany("INSERT INTO bench{} VALUES (?, ?);".format(t),
+                             [(i, 0) for i in range(start, min(start + _LOAD_CHUNK, rows))])
+    conn.execute("COMMIT TRANSACTION;")
+
+
+def worker(conn, mode, transactions, tx_size, rows, tables, read_ratio, rand, stats):
+    """
+    Runs the transactions of one connection, yielding after every statement so a scheduler can interleave
+    it with the others
+    :param conn: The Connection
+    :param mode: "DEFERRED", "IMMEDIATE", "EXCLUSIVE" or "OPTIMISTIC"
+    :param transactions: How many transactions to attempt
+    :param tx_size: The statements in each transaction
+    :param rows: The number of rows in each table
+    :param tables: The number of tables, each transaction sticking to one of them
+    :param read_ratio: The fraction of the statements that are SELECTs, the rest being UPDATEs
+    :param rand: The Random to pick the statements with
+    :param stats: The dict the commits, aborts and latencies are added to
+    """
+    for _ in range(transactions):
+        statements = []
+        table = "bench{}".format(rand.randrange(tables))
+        for _ in range(tx_size):
+            key = rand.randrange(rows)
+            if rand.random() < read_ratio:
+                statements.append("SELECT val FROM {} WHERE id = {};".format(table, key))
+            else:
+                statements.append("UPDATE {} SET val = {} WHERE id = {};".format(
+                    table, rand.randrange(1000), key))
+
+        start = time.perf_counter()
+        try:
+            conn.execute("BEGIN {} TRANSACTION;".format(mode))
+            yield
+            for statement in statements:
+                conn.execute(statement)
+                yield
+            conn.execute("COMMIT TRANSACTION;")
+        except TransactionError:
+            if not conn.auto_commit:  # Ends the transaction, its locks are already gone.  A conflict already did
+                conn.execute("ROLLBACK TRANSACTION;")
+            stats["aborts"] += 1
+            yield
+            continue
+        stats["commits"] += 1
+        stats["latencies"].append(time.perf_counter() - start)
+        yield
+
+
+def run_threads(workers):
+    """
+    Runs every worker on its own thread, giving up the GIL between statements
+    """
+    def drive(work):
+        for _ in work:
+            time.sleep(0)
+
+    threads = [threading.Thread(target=drive, args=(work,)) for work in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_interleaved(workers, rand):
+    """
+    Runs the workers on this thread, stepping a randomly picked one a statement at a time
+    """
+    active = list(workers)
+    while len(active) > 0:
+        work = rand.choice(active)
+        try:
+            next(work)
+        except StopIteration:
+            active.remove(work)
+
+
+def percentile(values, fraction):
+    """
+    Gets a percentile by the nearest rank
+    :param values: The sorted list of values
+    :param fraction: The percentile as a fraction, e.g. 0.99
+    """
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def run(mode, connections, transactions, tx_size, rows, tables, read_ratio, scheduler, seed):
+    """
+    Runs one configuration against a new database
+    :param scheduler: "threads" or "interleaved"
+    :return: The dict of the results
+    """
+    filename = "bench-{}.db".format(next(_RUNS))
+    load(Connection(filename, 0.1, None), rows, tables)
+    rand = random.Random(seed)
+    stats = [{"commits": 0, "aborts": 0, "latencies": []} for _ in range(connections)]
+    workers = [worker(Connection(filename, 0.1, mode), mode, transactions, tx_size, rows, tables, read_ratio,
+                      random.Random(rand.random()), stats[i]) for i in range(connections)]
+
+    start = time.perf_counter()
+    if scheduler == "threads":
+        run_threads(workers)
+    else:
+        run_interleaved(workers, rand)
+    elapsed = time.perf_counter() - start
+
+    # Every lock should be back once the connections are done, otherwise a lock leaked
+    leaked = {level: count for level, count in _LOCKS[filename].items() if count != 0}
+    for table, locks in _TABLE_LOCKS[filename].items():
+        leaked.update({"{}.{}".format(table, level): count for level, count in locks.items() if count != 0})
+    del _ALL_DATABASES[filename], _LOCKS[filename], _TABLE_LOCKS[filename]
+
+    commits = sum(s["commits"] for s in stats)
+    aborts = sum(s["aborts"] for s in stats)
+    latencies = sorted(itertools.chain.from_iterable(s["latencies"] for s in stats))
+    return {
+        "mode": mode, "connections": connections, "tx_size": tx_size, "rows": rows, "tables": tables,
+        "read_ratio": read_ratio, "scheduler": scheduler, "commits": commits, "aborts": aborts,
+        "abort_rate": aborts / (commits + aborts) if commits + aborts > 0 else 0.0,
+        "tx_per_second": commits / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": _ms(percentile(latencies, 0.5)), "p95_ms": _ms(percentile(latencies, 0.95)),
+        "p99_ms": _ms(percentile(latencies, 0.99)), "leaked_locks": leaked,
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def sweep(modes, connections, transactions, tx_sizes, table_sizes, table_counts, read_ratio, scheduler, seed):
+    """
+    Runs every combination of the modes, transaction sizes, table sizes and numbers of tables
+    :return: The list of result dicts, in the order they ran
+    """
+    return [run(mode, connections, transactions, tx_size, rows, tables, read_ratio, scheduler, seed)
+            for rows in table_sizes for tables in table_counts for tx_size in tx_sizes for mode in modes]
+
+
+def report(results):
+    """
+    Prints the results as a table
+    """
+    header = "{:<10} {:>5} {:>8} {:>6} {:>7} {:>8} {:>7} {:>9} {:>9} {:>9}".format(
+        "mode", "conns", "rows", "tables", "tx_size", "tx/s", "aborts", "p50 ms", "p95 ms", "p99 ms")
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print("{:<10} {:>5} {:>8} {:>6} {:>7} {:>8.1f} {:>6.1f}% {:>9} {:>9} {:>9}".format(
+            result["mode"], result["connections"], result["rows"], result["tables"], result["tx_size"],
+            result["tx_per_second"],
+            result["abort_rate"] * 100, *[_format(result[key]) for key in ("p50_ms", "p95_ms", "p99_ms")]))
+        if len(result["leaked_locks"]) > 0:
+            print("  leaked locks: {}".format(result["leaked_locks"]))
+
+
+def _format(value):
+    return "-" if value is None else "{:.3f}".format(value)
+
+
+def _numbers(text, kind=int):
+    return [kind(part) for part in text.split(",") if part.strip() != ""]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures transaction throughput under contention")
+    parser.add_argument("--modes", default=",".join(_MODES), help="The transaction modes to sweep")
+    parser.add_argument("--connections", type=int, default=4, help="The connections running at once")
+    parser.add_argument("--transactions", type=int, default=200, help="The transactions each connection tries")
+    parser.add_argument("--tx-sizes", default="1,10", help="The statements per transaction to sweep")
+    parser.add_argument("--table-sizes", default="100,10000", help="The rows in each table to sweep")
+    parser.add_argument("--tables", default="1,4", help="The numbers of tables to spread the transactions over")
+    parser.add_argument("--read-ratio", type=float, default=0.8, help="The fraction of statements that read")
+    parser.add_argument("--scheduler", choices=["threads", "interleaved"], default="interleaved",
+                        help="Real threads, or one thread stepping the connections in a seeded order")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON lines")
+    args = parser.parse_args()
+
+    modes = [mode.strip().upper() for mode in args.modes.split(",")]
+    for mode in modes:
+        if mode not in _MODES:
+            parser.error("Mode {} is not one of {}".format(mode, ", ".join(_MODES)))
+    results = sweep(modes, args.connections, args.transactions, _numbers(args.tx_sizes),
+                    _numbers(args.table_sizes), _numbers(args.tables), args.read_ratio, args.scheduler, args.seed)
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,427 @@
+"""
+This file is the differential harness, which runs random workloads through this engine and an in-memory stdlib
+sqlite3 database side by side and checks they give the same results.  A workload is a random schema, random
+data and a random mix of statements within the SQL this engine supports.  Every statement is run and timed on
+both, and the report gives, for each type of statement, how many there were, how many gave different results
+and how long this engine took next to sqlite3.
+
+Rows are compared as multisets, since without an ORDER BY neither database promises an order, and the ORDER BY
+keys are compared in order on top of that.  Reals are compared to 9 significant digits so summing in a
+different order isn't a difference.  A statement both databases refuse counts as the same.  Once a write gives
+different results the databases no longer hold the same data, so the rest of that workload is skipped.  Run it as
+    python differential.py --workloads 20 --statements 200 --rows 500 --seed 0
+The exit status is 1 if any statement gave different results
+"""
+import argparse
+import itertools
+import random
+import sqlite3
+import sys
+import time
+from Connection import Connection, _ALL_DATABASES, _LOCKS, _TABLE_LOCKS
+
+_LOAD_CHUNK = 500  # The rows put in each INSERT when filling the tables
+_RUNS = itertools.count(1)  # So every workload gets a database of its own
+_TYPES = ["INTEGER", "REAL", "TEXT"]
+_WORDS = ["apple", "Banana", "cherry", "date", "Elder", "fig", "grape", "kiwi", "lemon", "mango", "x", "zz top"]
+_COMPARISONS = ["=", "!=", "<", ">", "<=", ">="]
+_NULL_FRACTION = 0.1
+_WRITES = ["INSERT", "EXECUTEMANY", "UPDATE", "DELETE", "TRANSACTION"]
+
+# How often each type of statement is picked
+_MIX = {"SELECT": 20, "ORDER BY": 10, "AGGREGATE": 10, "EXPRESSION": 8, "JOIN": 8, "SUBQUERY": 8, "UNION": 4,
+        "VIEW": 5, "INSERT": 8, "EXECUTEMANY": 4, "UPDATE": 8, "DELETE": 3, "TRANSACTION": 4}
+
+
+def backwards(left, right):
+    """
+    The collation both databases get, which sorts text in reverse
+    """
+    return (left < right) - (left > right)
+
+
+def value(rand, kind, nulls=True):
+    """
+    Makes a random value of a column type, from a small range so equality conditions match now and then
+    """
+    if nulls and rand.random() < _NULL_FRACTION:
+        return None
+    elif kind == "INTEGER":
+        return rand.randrange(50)
+    elif kind == "REAL":
+        return round(rand.uniform(0, 50), 2)  # Rounded so it's never written in scientific notation
+    return rand.choice(_WORDS)
+
+
+def literal(item):
+    """
+    Writes a value as SQL
+    """
+    if item is None:
+        return "NULL"
+    elif isinstance(item, str):
+        return "'" + item.replace("'", "''") + "'"
+    return repr(item)
+
+
+def make_row(rand, schema, name, nulls=True):
+    """
+    Makes a row for a table, with the next key if it has one
+    """
+    row = []
+    for col, kind in schema["tables"][name]:
+        if col == "id":
+            row.append(schema["next_id"][name])
+            schema["next_id"][name] += 1
+        else:
+            row.append(value(rand, kind, nulls))
+    return tuple(row)
+
+
+def create(rand, schema, tables, rows):
+    """
+    Makes the statements creating and filling the tables and a view on each
+    :return: The list of the type, SQL and parameters of each statement
+    """
+    statements = []
+    for t in range(tables):
+        name = "t{}".format(t)
+        columns = [("id", "INTEGER")] + [("c{}".format(i), rand.choice(_TYPES)) for i in range(rand.randint(2, 4))]
+        schema["tables"][name] = columns
+        schema["next_id"][name] = 0
+        key = " PRIMARY KEY" if rand.random() < 0.5 else ""
+        statements.append(("CREATE", "CREATE TABLE {} ({});".format(
+            name, ", ".join("{} {}{}".format(col, kind, key if col == "id" else "") for col, kind in columns)), None))
+
+    statements.append(("TRANSACTION", "BEGIN TRANSACTION;", None))
+    for name in schema["tables"]:
+        for start in range(0, rows, _LOAD_CHUNK):
+            chunk = [make_row(rand, schema, name) for _ in range(start, min(start + _LOAD_CHUNK, rows))]
+            statements.append(("LOAD", "INSERT INTO {} VALUES {};".format(
+                name, ", ".join("(" + ", ".join(literal(item) for item in row) + ")" for row in chunk)), None))
+    statements.append(("TRANSACTION", "COMMIT TRANSACTION;", None))
+
+    for name, columns in list(schema["tables"].items()):
+        view = "v" + name[1:]
+        picked = rand.sample(columns, rand.randint(1, len(columns)))
+        schema["views"][view] = picked
+        statements.append(("CREATE", "CREATE VIEW {} AS SELECT {} FROM {}{};".format(
+            view, ", ".join(col for col, kind in picked), name, where(rand, columns)), None))
+    return statements
+
+
+def condition(rand, columns, prefix=""):
+    """
+    Makes a random WHERE condition on one of the columns
+    :param prefix: What to put in front of the column name, to qualify it
+    """
+    col, kind = rand.choice(columns)
+    roll = rand.random()
+    if roll < 0.1:
+        return "{}{} IS {}".format(prefix, col, rand.choice(["NULL", "NOT NULL"]))
+    elif roll < 0.25:
+        items = [value(rand, kind, nulls=rand.random() < 0.2) for _ in range(rand.randint(1, 4))]
+        return "{}{} {} ({})".format(prefix, col, rand.choice(["IN", "NOT IN"]),
+                                     ", ".join(literal(item) for item in items))
+    return "{}{} {} {}".format(prefix, col, rand.choice(_COMPARISONS), literal(value(rand, kind, nulls=False)))
+
+
+def where(rand, columns, prefix="", chance=0.7):
+    """
+    Makes a WHERE clause of one or two conditions, or nothing
+    """
+    if rand.random() >= chance:
+        return ""
+    return " WHERE " + " AND ".join(condition(rand, columns, prefix) for _ in range(rand.randint(1, 2)))
+
+
+def pick_columns(rand, columns):
+    return rand.sample(columns, rand.randint(1, len(columns)))
+
+
+def same_type(rand, left, right):
+    """
+    Picks a column from each list with the same type, falling back to the keys
+    """
+    pairs = [(a, b) for a in left for b in right if a[1] == b[1]]
+    return rand.choice(pairs) if len(pairs) > 0 else (left[0], right[0])
+
+
+def statement(rand, schema, kind):
+    """
+    Makes a random statement of a type
+    :return: The SQL, and the positions of the ORDER BY keys in its columns or the rows for EXECUTEMANY.  A
+    JOIN or a subquery needs two tables, so it's a plain SELECT if it picks the same one twice
+    """
+    name = rand.choice(list(schema["tables"]))
+    columns = schema["tables"][name]
+    other = rand.choice(list(schema["tables"]))
+
+    if kind == "SELECT":
+        picked = "*" if rand.random() < 0.2 else ", ".join(col for col, _ in pick_columns(rand, columns))
+        distinct = "DISTINCT " if rand.random() < 0.2 else ""
+        return "SELECT {}{} FROM {}{};".format(distinct, picked, name, where(rand, columns)), None
+
+    elif kind == "ORDER BY":
+        picked = pick_columns(rand, columns)
+        keys = rand.sample(range(len(picked)), rand.randint(1, len(picked)))
+        order = []
+        for key in keys:
+            col, col_kind = picked[key]
+            collate = " COLLATE backwards" if col_kind == "TEXT" and rand.random() < 0.3 else ""
+            order.append(col + collate + rand.choice(["", " ASC", " DESC"]))
+        return "SELECT {} FROM {}{} ORDER BY {};".format(", ".join(col for col, _ in picked), name,
+                                                        where(rand, columns), ", ".join(order)), keys
+
+    elif kind == "AGGREGATE":
+        parts = []
+        for col, col_kind in pick_columns(rand, columns):
+            functions = ["min", "max", "sum"] if col_kind != "TEXT" else ["min", "max"]
+            parts.append("{}({})".format(rand.choice(functions), col))
+        return "SELECT {} FROM {}{};".format(", ".join(parts), name, where(rand, columns)), None
+
+    elif kind == "EXPRESSION":
+        numbers = [col for col, col_kind in columns if col_kind != "TEXT"]
+        parts = []
+        for _ in range(rand.randint(1, 3)):
+            if rand.random() < 0.3:
+                parts.append("{} || '-' || {}".format(rand.choice(columns)[0], rand.choice(columns)[0]))
+            else:
+                parts.append("{} {} {}".format(rand.choice(numbers), rand.choice(["+", "-", "*", "/"]),
+                                               rand.choice(numbers + [str(rand.randint(0, 5))])))
+        return "SELECT {} FROM {}{};".format(", ".join(parts), name, where(rand, columns)), None
+
+    elif kind == "JOIN":
+        if other == name:
+            return statement(rand, schema, "SELECT")
+        left, right = same_type(rand, columns, schema["tables"][other])
+        picked = ["{}.{}".format(name, col) for col, _ in pick_columns(rand, columns)] + \
+            ["{}.{}".format(other, col) for col, _ in pick_columns(rand, schema["tables"][other])]
+        join = rand.choice(["JOIN", "INNER JOIN", "LEFT OUTER JOIN", "LEFT JOIN"])
+        return "SELECT {} FROM {} {} {} ON {}.{} = {}.{}{};".format(
+            ", ".join(picked), name, join, other, name, left[0], other, right[0],
+            where(rand, columns, name + ".")), None
+
+    elif kind == "SUBQUERY":
+        if other == name:
+            return statement(rand, schema, "SELECT")
+        left, right = same_type(rand, columns, schema["tables"][other])
+        picked = ", ".join(col for col, _ in pick_columns(rand, columns))
+        if rand.random() < 0.6:
+            test = "{} {} (SELECT {} FROM {}{})".format(left[0], rand.choice(["IN", "NOT IN"]), right[0], other,
+                                                         where(rand, schema["tables"][other]))
+        else:  # Correlated on the outer table
+            test = "{}EXISTS (SELECT id FROM {} WHERE {}.{} = {}.{})".format(
+                rand.choice(["", "NOT "]), other, other, right[0], name, left[0])
+        return "SELECT {} FROM {} WHERE {};".format(picked, name, test), None
+
+    elif kind == "UNION":
+        left, right = same_type(rand, columns, schema["tables"][other])
+        keys = [0] if rand.random() < 0.5 else None  # The ORDER BY sorts the rows of both SELECTs
+        order = " ORDER BY {}{}".format(left[0], rand.choice(["", " ASC", " DESC"])) if keys is not None else ""
+        return "SELECT {} FROM {}{} {} SELECT {} FROM {}{}{};".format(
+            left[0], name, where(rand, columns), rand.choice(["UNION", "UNION ALL"]), right[0], other,
+            where(rand, schema["tables"][other]), order), keys
+
+    elif kind == "VIEW":
+        view = rand.choice(list(schema["views"]))
+        view_columns = schema["views"][view]
+        picked = "*" if rand.random() < 0.3 else ", ".join(col for col, _ in pick_columns(rand, view_columns))
+        return "SELECT {} FROM {}{};".format(picked, view, where(rand, view_columns)), None
+
+    elif kind == "INSERT":
+        rows = [make_row(rand, schema, name) for _ in range(rand.randint(1, 5))]
+        return "INSERT INTO {} VALUES {};".format(
+            name, ", ".join("(" + ", ".join(literal(item) for item in row) + ")" for row in rows)), None
+
+    elif kind == "EXECUTEMANY":  # Parameters can't be NULL, which executemany writes out as the text None
+        rows = [make_row(rand, schema, name, nulls=False) for _ in range(rand.randint(1, 20))]
+        return "INSERT INTO {} VALUES ({});".format(name, ", ".join("?" * len(columns))), rows
+
+    elif kind == "UPDATE":
+        assignments = []
+        for col, col_kind in rand.sample(columns[1:], rand.randint(1, len(columns) - 1)):
+            if col_kind != "TEXT" and rand.random() < 0.3:
+                assignments.append("{} = {} + 1".format(col, col))
+            else:
+                assignments.append("{} = {}".format(col, literal(value(rand, col_kind))))
+        return "UPDATE {} SET {}{};".format(name, ", ".join(assignments), where(rand, columns, chance=0.9)), None
+
+    elif kind == "DELETE":
+        return "DELETE FROM {} WHERE {};".format(name, condition(rand, columns)), None
+    raise ValueError("Unknown statement type {}".format(kind))
+
+
+def workload(rand, schema, statements):
+    """
+    Generates the statements of a workload after the tables are made.  Now and then the next few are wrapped
+    in a transaction, which commits or rolls back
+    :return: A generator of the type, SQL and parameters of each statement
+    """
+    kinds = list(_MIX)
+    weights = [_MIX[kind] for kind in kinds]
+    left = 0  # The statements before the open transaction ends, or 0 if there isn't one
+    for _ in range(statements):
+        kind = rand.choices(kinds, weights)[0]
+        if kind == "TRANSACTION":
+            if left == 0:
+                left = rand.randint(2, 8)
+                yield kind, "BEGIN TRANSACTION;", None
+            continue
+        sql, extra = statement(rand, schema, kind)
+        yield kind, sql, extra
+        if left > 0:
+            left -= 1
+            if left == 0:
+                yield "TRANSACTION", rand.choice(["COMMIT TRANSACTION;", "ROLLBACK TRANSACTION;"]), None
+    if left > 0:
+        yield "TRANSACTION", "COMMIT TRANSACTION;", None
+
+
+def _normalize(item):
+    if isinstance(item, float):
+        return float("{:.9g}".format(item))
+    return item
+
+
+def _sort_key(row):
+    return tuple((0,) if item is None else (1, item) if isinstance(item, (int, float)) else (2, str(item))
+                 for item in row)
+
+
+def same(kind, extra, ours, theirs):
+    """
+    Checks if both databases gave the same result
+    :param ours: The list of rows from this engine, or the name of the error it raised
+    :param theirs: The same from sqlite3
+    """
+    if isinstance(ours, str) or isinstance(theirs, str):
+        return isinstance(ours, str) and isinstance(theirs, str)
+    ours = [tuple(_normalize(item) for item in row) for row in ours]
+    theirs = [tuple(_normalize(item) for item in row) for row in theirs]
+    if kind in ("ORDER BY", "UNION") and extra is not None and \
+            [[row[i] for i in extra] for row in ours] != [[row[i] for i in extra] for row in theirs]:
+        return False
+    return sorted(ours, key=_sort_key) == sorted(theirs, key=_sort_key)
+
+
+def run_one(conn, lite, kind, sql, extra):
+    """
+    Runs a statement on both databases
+    :return: The result of each as same takes them, and the seconds each took
+    """
+    start = time.perf_counter()
+    try:
+        if kind == "EXECUTEMANY":
+            conn.executemany(sql, extra)
+            ours = []
+        else:
+            result = conn.execute(sql)
+            ours = [] if result is None else list(result)
+    except Exception as e:
+        ours = type(e).__name__
+    ours_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        if kind == "EXECUTEMANY":
+            lite.executemany(sql, extra)
+            theirs = []
+        else:
+            theirs = lite.execute(sql).fetchall()
+    except sqlite3.Error as e:
+        theirs = type(e).__name__
+    return ours, theirs, ours_time, time.perf_counter() - start
+
+
+def run(seed, tables, rows, statements, stats, show):
+    """
+    Runs one workload on a fresh pair of databases
+    :param stats: The dict the count, differences and time of each type of statement are added to
+    :param show: How many more differences to print
+    :return: The number of differences left to print
+    """
+    rand = random.Random(seed)
+    filename = "differential-{}.db".format(next(_RUNS))
+    conn = Connection(filename, 0.1, None)
+    conn.create_collation("backwards", backwards)
+    lite = sqlite3.connect(":memory:", isolation_level=None)
+    lite.create_collation("backwards", backwards)
+
+    # The name and type of each column of each table and view, and the next key of each table
+    schema = {"tables": {}, "views": {}, "next_id": {}}
+    try:
+        for kind, sql, extra in itertools.chain(create(rand, schema, tables, rows),
+                                                workload(rand, schema, statements)):
+            ours, theirs, ours_time, theirs_time = run_one(conn, lite, kind, sql, extra)
+            entry = stats.setdefault(kind, {"count": 0, "different": 0, "ours": 0.0, "sqlite": 0.0})
+            entry["count"] += 1
+            entry["ours"] += ours_time
+            entry["sqlite"] += theirs_time
+            if same(kind, extra, ours, theirs):
+                continue
+
+            entry["different"] += 1
+            shown = show > 0
+            if shown:
+                show -= 1
+                print("Workload {} {}: {}".format(seed, kind, sql if len(sql) <= 300 else sql[:300] + "..."))
+                print("  this engine: {}".format(_preview(ours)))
+                print("  sqlite3:     {}".format(_preview(theirs)))
+            if kind in _WRITES or kind in ("CREATE", "LOAD"):
+                if shown:
+                    print("  the databases differ now, so the rest of workload {} is skipped".format(seed))
+                break
+    finally:
+        lite.close()
+        conn.close()
+        for registry in (_ALL_DATABASES, _LOCKS, _TABLE_LOCKS):
+            registry.pop(filename, None)
+    return show
+
+
+def _preview(result):
+    if isinstance(result, str):
+        return "raised " + result
+    result = sorted(result, key=_sort_key)
+    return "{} rows {}{}".format(len(result), result[:5], " ..." if len(result) > 5 else "")
+
+
+def report(stats):
+    """
+    Prints the statements, differences and timings of each type of statement
+    """
+    header = "{:<12} {:>7} {:>10} {:>11} {:>11} {:>8}".format(
+        "statement", "count", "different", "engine ms", "sqlite ms", "ratio")
+    print(header)
+    print("-" * len(header))
+    for kind in sorted(stats, key=lambda kind: -stats[kind]["ours"]):
+        entry = stats[kind]
+        ratio = entry["ours"] / entry["sqlite"] if entry["sqlite"] > 0 else float("inf")
+        print("{:<12} {:>7} {:>10} {:>11.1f} {:>11.1f} {:>7.1f}x".format(
+            kind, entry["count"], entry["different"], entry["ours"] * 1000, entry["sqlite"] * 1000, ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks this engine's results and speed against sqlite3")
+    parser.add_argument("--workloads", type=int, default=20, help="The workloads to run, each on new databases")
+    parser.add_argument("--statements", type=int, default=200, help="The random statements in each workload")
+    parser.add_argument("--rows", type=int, default=500, help="The rows each table starts with")
+    parser.add_argument("--tables", type=int, default=3, help="The tables in each workload")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the first workload")
+    parser.add_argument("--show", type=int, default=10, help="How many differences to print")
+    args = parser.parse_args()
+
+    stats = {}
+    show = args.show
+    for seed in range(args.seed, args.seed + args.workloads):
+        show = run(seed, args.tables, args.rows, args.statements, stats, show)
+    report(stats)
+    different = sum(entry["different"] for entry in stats.values())
+    print("{} of {} statements gave different results".format(different,
+                                                             sum(entry["count"] for entry in stats.values())))
+    sys.exit(1 if different > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""
+This file holds the expression engine, which parses the expressions in SELECT lists and SET clauses and
+compiles each query's filter and projection into a single Python function
+"""
+from Errors import QueryError
+
+_COMPARISONS = {"<": "<", ">": ">", "=": "==", "!=": "!=", "<=": "<=", ">=": ">="}
+_ADDITIVE = ["+", "-"]
+_MULTIPLICATIVE = ["*", "/"]
+_PIPELINE_CACHE_SIZE = 1024
+_PIPELINES = {}  # The compiled pipelines, keyed by the shape of the query and the table
+
+
+"""Parsing"""
+
+
+def parse_expression(tokens, i):
+    """
+    Parses an expression out of the tokens, stopping at the first token that can't continue it
+    :param tokens: The list of tokens of the query
+    :param i: The index of the start of the expression
+    :return: The expression tree and the index just past it.  Trees are tuples of the operator and
+    its operands, ("COLUMN", name) or ("VALUE", value)
+    """
+    left, i = parse_additive(tokens, i)
+    while i < len(tokens) and tokens[i] in _COMPARISONS:
+        op = tokens[i]
+        right, i = parse_additive(tokens, i + 1)
+        left = (op, left, right)
+    return left, i
+
+
+def parse_additive(tokens, i):
+    left, i = parse_multiplicative(tokens, i)
+    while i < len(tokens) and tokens[i] in _ADDITIVE:
+        op = tokens[i]
+        right, i = parse_multiplicative(tokens, i + 1)
+        left = (op, left, right)
+    return left, i
+
+
+def parse_multiplicative(tokens, i):
+    left, i = parse_concat(tokens, i)
+    while i < len(tokens) and tokens[i] in _MULTIPLICATIVE:
+        op = tokens[i]
+        right, i = parse_concat(tokens, i + 1)
+        left = (op, left, right)
+    return left, i
+
+
+def parse_concat(tokens, i):
+    left, i = parse_unary(tokens, i)
+    while i < len(tokens) and tokens[i] == "||":
+        right, i = parse_unary(tokens, i + 1)
+        left = ("||", left, right)
+    return left, i
+
+
+def parse_unary(tokens, i):
+    if i < len(tokens) and tokens[i] == "-":
+        operand, i = parse_unary(tokens, i + 1)
+        return ("NEG", operand), i
+    return parse_primary(tokens, i)
+
+
+def parse_primary(tokens, i):
+    if i >= len(tokens):
+        raise QueryError("Expression ended unexpectedly")
+    token = tokens[i]
+
+    if token is None or isinstance(token, int) or isinstance(token, float):  # NULL or a number
+        return ("VALUE", token), i + 1
+    elif token == "'":  # A string
+        return ("VALUE", tokens[i + 1]), i + 3
+    elif token == "(":
+        node, i = parse_expression(tokens, i + 1)
+        if i >= len(tokens) or tokens[i] != ")":
+            raise QueryError("Missing ')' in expression")
+        return node, i + 1
+    elif token in "(),;" or token in _COMPARISONS or token in _ADDITIVE or token in _MULTIPLICATIVE:
+        raise QueryError("Invalid expression. Stuck at token {}".format(token))
+    return ("COLUMN", token), i + 1
+
+
+def map_columns(node, function):
+    """
+    Rewrites every column name in an expression tree
+    :param node: The expression tree
+    :param function: The function taking a column name and returning its new name
+    :return: The new expression tree
+    """
+    if node[0] == "COLUMN":
+        return ("COLUMN", function(node[1]))
+    elif node[0] == "VALUE":
+        return node
+    return (node[0],) + tuple(map_columns(operand, function) for operand in node[1:])
+
+
+"""Runtime helpers the compiled code calls"""
+
+
+def _divide(left, right):
+    """
+    Divides like SQL does: NULL for a NULL operand or dividing by 0, and integer division truncating
+    towards 0 for two integers
+    """
+    if left is None or right is None or right == 0:
+        return None
+    if isinstance(left, int) and isinstance(right, int):
+        quotient = abs(left) // abs(right)
+        return quotient if (left < 0) == (right < 0) else -quotient
+    return left / right
+
+
+def _text(value):
+    """
+    Converts a value to text like SQL does, which writes reals with 15 significant digits and always a
+    decimal point
+    """
+    if not isinstance(value, float):
+        return str(value)
+    elif value in (float("inf"), float("-inf")):
+        return "Inf" if value > 0 else "-Inf"
+    text = "%.15g" % (value + 0.0)  # Adding 0.0 turns -0.0 into 0.0
+    mantissa, e, exponent = text.partition("e")
+    if "." not in mantissa and mantissa.lstrip("-").isdigit():
+        mantissa += ".0"
+    return mantissa + e + exponent
+
+
+def _concat(left, right):
+    """
+    Concatenates two values as text, NULL if either is NULL
+    """
+    if left is None or right is None:
+        return None
+    return _text(left) + _text(right)
+
+
+_NAMESPACE = {"_divide": _divide, "_concat": _concat}
+
+
+"""Compiling"""
+
+
+def template(node, params):
+    """
+    Swaps the literal values of an expression tree for numbered parameters, so queries that only differ
+    by their values share one compiled pipeline
+    :param node: The expression tree
+    :param params: The list the literal values are appended to
+    :return: The hashable template of the tree
+    """
+    if node[0] == "VALUE":
+        params.append(node[1])
+        return ("PARAM", len(params) - 1, node[1] is None)
+    elif node[0] == "COLUMN":
+        return node
+    return (node[0],) + tuple(template(operand, params) for operand in node[1:])
+
+
+def condition_template(condition, params):
+    """
+    Swaps the value of a WHERE condition for a numbered parameter.  A correlated subquery keeps the outer
+    columns it's called with in its template, since the compiled code depends on them
+    :param condition: The condition, a list of the column, operator and value
+    :param params: The list the value is appended to
+    :return: The hashable template of the condition
+    """
+    col, op, val = condition
+    param = template(("VALUE", val), params)
+    if hasattr(val, "outer"):
+        param += (tuple(val.outer),)
+    return col, op, param
+
+
+class _Generator:
+    """
+    Generates the Python source for the templates of a single pipeline
+    """
+    def __init__(self, resolve):
+        self.resolve = resolve
+        self.temps = 0
+
+    def temp(self):
+        self.temps += 1
+        return "t{}".format(self.temps)
+
+    def operand(self, src):
+        """
+        Gets a name for an operand that is used more than once, so it's only evaluated once
+        :return: The source that evaluates and names the operand and the source of its name
+        """
+        if src.startswith("row[") or src.startswith("p"):  # Cheap to evaluate again
+            return src, src
+        name = self.temp()
+        return "({} := {})".format(name, src), name
+
+    def expression(self, node):
+        """
+        :return: The source of the node and if it could evaluate to NULL
+        """
+        op = node[0]
+        if op == "PARAM":
+            return "p{}".format(node[1]), node[2]
+        elif op == "COLUMN":
+            return "row[{}]".format(self.resolve(node[1])), True
+        elif op == "NEG":
+            src, nullable = self.expression(node[1])
+            if not nullable:
+                return "(-{})".format(src), False
+            first, name = self.operand(src)
+            return "(None if {} is None else -{})".format(first, name), True
+
+        left, left_null = self.expression(node[1])
+        right, right_null = self.expression(node[2])
+        if op == "/":
+            return "_divide({}, {})".format(left, right), True
+        elif op == "||":
+            return "_concat({}, {})".format(left, right), True
+
+        # Arithmetic and comparisons only need the NULL checks for operands that could be NULL
+        checks = []
+        if left_null:
+            first, left = self.operand(left)
+            checks.append("{} is None".format(first))
+        if right_null:
+            first, right = self.operand(right)
+            checks.append("{} is None".format(first))
+        if op in _COMPARISONS:
+            src = "({} {} {})".format(left, _COMPARISONS[op], right)
+            src = "(1 if {} else 0)".format(src)
+        else:
+            src = "({} {} {})".format(left, op, right)
+        if len(checks) == 0:
+            return src, False
+        return "(None if {} else {})".format(" or ".join(checks), src), True
+
+    def subquery(self, param):
+        """
+        :return: The source of the value of a subquery parameter, calling it with the outer columns if it's
+        correlated
+        """
+        if len(param) == 3:
+            return "p{}".format(param[1])
+        return "(p{}({}))".format(param[1], "".join("row[{}], ".format(self.resolve(col)) for col in param[3]))
+
+    def condition(self, condition):
+        """
+        :return: The source of a single WHERE condition, which is False for a NULL column
+        """
+        col, op, param = condition
+        if op == "EXISTS":
+            return self.subquery(param)
+        elif op == "NOT EXISTS":
+            return "not {}".format(self.subquery(param))
+        col = "row[{}]".format(self.resolve(col))
+        if op == "IS":
+            return "{} is None".format(col)
+        elif op == "IS NOT":
+            return "{} is not None".format(col)
+        elif op == "IN":  # Probes the hash set
+            return "({} is not None and {} in {})".format(col, col, self.subquery(param))
+        elif op == "NOT IN":  # True for anything if the set is empty, otherwise never if it has a NULL in it
+            first, values = self.operand(self.subquery(param))
+            return "(not {} or ({} is not None and None not in {} and {} not in {}))".format(first, col, values,
+                                                                                          col, values)
+        elif param[2]:  # Comparing to NULL is never true
+            return "False"
+        return "({} is not None and {} {} p{})".format(col, col, _COMPARISONS[op], param[1])
+
+
+def compile_pipeline(kind, columns, where, resolve, key):
+    """
+    Compiles the filter and projection of a query into a single Python function, reusing the function
+    if a query of the same shape was already compiled
+    :param kind: "indexes" to get the indexes of the matching rows of a table, "rows" to get the matching
+    rows, "project" to project every row or "scan" to filter and project at once
+    :param columns: The columns to project, each a column name or an expression tree
+    :param where: The WHERE conditions, each a list of the column, operator and value
+    :param resolve: The function that turns a column name into its index in a row
+    :param key: What identifies the layout of the rows, e.g. the headers of the table
+    :return: The compiled function and the parameters to call it with.  It's called as
+    function(rows, params), or function(rows, candidates, params) for "indexes"
+    """
+    params = []
+    column_templates = tuple(template(("COLUMN", col) if isinstance(col, str) else col, params)
+                             for col in columns)
+    where_templates = tuple(condition_template(c, params) for c in where)
+
+    cache_key = (kind, key, column_templates, where_templates)
+    if cache_key in _PIPELINES:
+        return _PIPELINES[cache_key], params
+
+    generator = _Generator(resolve)
+    cond = " and ".join(generator.condition(c) for c in where_templates) or "True"
+    projection = "".join(generator.expression(c)[0] + ", " for c in column_templates)
+
+    lines = []
+    if kind == "indexes":
+        lines.append("def pipeline(table, candidates, params):")
+    else:
+        lines.append("def pipeline(rows, params):")
+    if len(params) > 0:
+        lines.append("    " + "".join("p{}, ".format(k) for k in range(len(params))) + "= params")
+    if kind == "indexes":
+        lines.append("    return [i for i in candidates for row in (table[i],) if {}]".format(cond))
+    elif kind == "rows":
+        lines.append("    return [row for row in rows if {}]".format(cond))
+    elif kind == "project":
+        lines.append("    return [({}) for row in rows]".format(projection))
+    else:
+        lines.append("    return [({}) for row in rows if {}]".format(projection, cond))
+
+    namespace = dict(_NAMESPACE)
+    exec(compile("\n".join(lines), "<pipeline>", "exec"), namespace)
+    if len(_PIPELINES) >= _PIPELINE_CACHE_SIZE:
+        _PIPELINES.clear()
+    _PIPELINES[cache_key] = namespace["pipeline"]
+    return namespace["pipeline"], params
+
+
+def unparse(node):
+    """
+    Writes an expression tree back out as text, to name the columns it makes
+    :param node: The expression tree
+    :return: The text of the expression
+    """
+    if node[0] == "COLUMN":
+        return node[1]
+    elif node[0] == "VALUE":
+        if node[1] is None:
+            return "NULL"
+        return "'{}'".format(node[1]) if isinstance(node[1], str) else str(node[1])
+    elif node[0] == "NEG":
+        return "-" + unparse(node[1])
+    return "{} {} {}".format(unparse(node[1]), node[0], unparse(node[2]))
@@ -0,0 +1,78 @@
+"""
+This file holds the memory accounting of a database, which estimates the bytes each table, column and index
+takes up.  Big tables are estimated from an even sample of their rows, so an estimate costs about the same
+no matter how big the table is
+"""
+import sys
+
+_SAMPLE_ROWS = 1024  # Tables with more rows than this are estimated from this many of them
+_SHARED = (type(None), bool)  # Values Python only ever has one of
+
+
+def value_size(value):
+    """
+    Estimates the bytes of a single value, which is 0 for the values Python shares between every use
+    :param value: The value in a row
+    """
+    if isinstance(value, _SHARED) or (type(value) is int and -5 <= value <= 256):
+        return 0
+    return sys.getsizeof(value)
+
+
+def sample(rows):
+    """
+    Gets the rows to estimate a table from
+    :param rows: The list of rows of the table
+    :return: The rows to look at and what to multiply their bytes by
+    """
+    if len(rows) <= _SAMPLE_ROWS:
+        return rows, 1.0
+    step = len(rows) / _SAMPLE_ROWS
+    return [rows[int(i * step)] for i in range(_SAMPLE_ROWS)], len(rows) / _SAMPLE_ROWS
+
+
+def table_usage(table, values=True):
+    """
+    Estimates the bytes a table takes up
+    :param table: The Table
+    :param values: Count the values in the rows.  A transaction's copy of a database shares the values
+    with the database it was copied from, so only its lists and dicts are new
+    :return: The dict of the number of rows, the bytes of the row lists, of each column's values, of each
+    index and of the cached NumPy arrays and zone maps, and the total
+    """
+    rows, scale = sample(table.table)
+    names = sorted(table.headers, key=table.headers.get)
+    columns = [0] * len(names)
+    row_bytes = 0
+    for row in rows:
+        row_bytes += sys.getsizeof(row)
+        if values:
+            for i, value in enumerate(row):
+                columns[i] += value_size(value)
+
+    indexes = {names[ind].split(".", 1)[1]: sys.getsizeof(index) for ind, index in table.indexes.items()}
+    caches = sum(arrays[1].nbytes + arrays[2].nbytes for arrays in table.vectors.values() if arrays[1] is not None)
+    for covered, built in table.zones.values():  # Each zone is a tuple of 3
+        caches += 0 if built is None else sys.getsizeof(built) + len(built) * sys.getsizeof((0, 0, 0))
+    usage = {
+        "rows": len(table.table),
+        "row_bytes": sys.getsizeof(table.table) + int(row_bytes * scale),
+        "columns": {name.split(".", 1)[1]: int(size * scale) for name, size in zip(names, columns)},
+        "indexes": indexes,
+        "caches": caches,
+    }
+    usage["bytes"] = usage["row_bytes"] + sum(usage["columns"].values()) + sum(indexes.values()) + caches
+    return usage
+
+
+def database_usage(database, values=True, names=None):
+    """
+    Estimates the bytes the tables of a database take up.  Views only hold their query, so they're left out
+    :param database: The Database
+    :param values: See table_usage
+    :param names: The names of the tables to count, or None for all of them
+    :return: The dict of each table's usage by name, and the total
+    """
+    tables = {name: table_usage(table, values) for name, table in database.tables.items()
+              if hasattr(table, "table") and (names is None or name in names)}
+    return {"tables": tables, "bytes": sum(usage["bytes"] for usage in tables.values())}
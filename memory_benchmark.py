@@ -0,0 +1,108 @@
+"""
+This file checks the memory estimates of Database.memory_usage against what tracemalloc sees being
+allocated.  For each shape and size of table it loads a database, measures the memory it holds and the
+memory a transaction writing the table copies, and prints them next to the estimates.  Run it as
+    python memory_benchmark.py --rows 1000,10000
+"""
+import argparse
+import gc
+import itertools
+import random
+import time
+import tracemalloc
+from Connection import Connection, _ALL_DATABASES, _LOCKS, _TABLE_LOCKS
+
+_LOAD_CHUNK = 1000  # The rows put in each INSERT when loading the table
+_RUNS = itertools.count(1)  # So every run gets a database of its own
+
+# The columns of each table shape, and how to make a row of it.  Reals stay above 0.001 so they're never
+# written out in scientific notation, which the tokenizer doesn't read
+_SHAPES = {
+    "integers": ("a INTEGER, b INTEGER", lambda rand, i: (i, rand.randrange(10 ** 9))),
+    "reals": ("a REAL, b REAL", lambda rand, i: (rand.uniform(0.001, 1), rand.uniform(1, 1000))),
+    "short text": ("a TEXT, b TEXT", lambda rand, i: ("k{}".format(i), "v{}".format(rand.randrange(100)))),
+    "long text": ("a TEXT", lambda rand, i: ("x" * rand.randrange(50, 200),)),
+    "mixed": ("a INTEGER PRIMARY KEY, b REAL, c TEXT",
+              lambda rand, i: (i, rand.uniform(0.001, 1), "name{}".format(i))),
+}
+
+
+def load(filename, columns, make_row, rows, seed):
+    """
+    Creates a database with one table of random rows
+    :return: The Connection, with the copy of its last transaction dropped
+    """
+    rand = random.Random(seed)
+    conn = Connection(filename, 0.1, None)
+    conn.execute("CREATE TABLE t ({});".format(columns))
+    conn.execute("BEGIN TRANSACTION;")
+    for start in range(0, rows, _LOAD_CHUNK):
+        values = [make_row(rand, i) for i in range(start, min(start + _LOAD_CHUNK, rows))]
+        conn.executemany("INSERT INTO t VALUES ({});".format(", ".join("?" * len(values[0]))), values)
+    conn.execute("COMMIT TRANSACTION;")
+    conn.database = None
+    return conn
+
+
+def measure(shape, rows, seed):
+    """
+    Loads one table and compares the estimates to tracemalloc
+    :return: The dict of the measured and estimated bytes of the database and of a copy of it
+    """
+    columns, make_row = _SHAPES[shape]
+    filename = "memory-{}.db".format(next(_RUNS))
+
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+    conn = load(filename, columns, make_row, rows, seed)
+    gc.collect()
+    measured = tracemalloc.get_traced_memory()[0] - before
+
+    database = _ALL_DATABASES[filename]
+    start = time.perf_counter()
+    estimated = database.memory_usage()["bytes"]
+    elapsed = time.perf_counter() - start
+
+    # A transaction's copy of the table shares the values, so only its lists and dicts are new
+    before = tracemalloc.get_traced_memory()[0]
+    snapshot = database.snapshot()
+    snapshot.writable("t")
+    copy_measured = tracemalloc.get_traced_memory()[0] - before
+    copy_estimated = snapshot.memory_usage(False, snapshot.owned)["bytes"]
+
+    del snapshot, conn, database
+    for registry in (_ALL_DATABASES, _LOCKS, _TABLE_LOCKS):
+        registry.pop(filename, None)
+    return {"shape": shape, "rows": rows, "measured": measured, "estimated": estimated,
+            "copy_measured": copy_measured, "copy_estimated": copy_estimated, "estimate_ms": elapsed * 1000}
+
+
+def _error(estimated, measured):
+    return (estimated - measured) / measured * 100 if measured > 0 else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the memory estimates against tracemalloc")
+    parser.add_argument("--rows", default="1000,10000", help="The table sizes to load")
+    parser.add_argument("--shapes", default=",".join(_SHAPES), help="The table shapes to load")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    header = "{:<11} {:>7} {:>11} {:>11} {:>7} {:>11} {:>11} {:>7} {:>9}".format(
+        "shape", "rows", "measured", "estimated", "error", "copy meas.", "copy est.", "error", "est. ms")
+    print(header)
+    print("-" * len(header))
+    tracemalloc.start()
+    for rows in [int(part) for part in args.rows.split(",")]:
+        for shape in [part.strip() for part in args.shapes.split(",")]:
+            result = measure(shape, rows, args.seed)
+            print("{:<11} {:>7} {:>11} {:>11} {:>6.1f}% {:>11} {:>11} {:>6.1f}% {:>9.2f}".format(
+                shape, rows, result["measured"], result["estimated"],
+                _error(result["estimated"], result["measured"]), result["copy_measured"],
+                result["copy_estimated"], _error(result["copy_estimated"], result["copy_measured"]),
+                result["estimate_ms"]))
+    tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    main()
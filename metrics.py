@@ -0,0 +1,242 @@
+"""
+This file holds the lock and transaction metrics of every database, so lock contention can be traced back
+to a database, lock level and connection.  Nothing is recorded until the metrics are enabled, and the
+connections only check the ENABLED flag until then
+"""
+import threading
+import time
+import weakref
+
+ENABLED = False
+_LEVELS = ["S", "R", "E"]
+_BUCKETS = [0.0001, 0.001, 0.01, 0.1, 1.0, 10.0]  # The upper bounds of the commit duration histogram
+_METRICS = {}  # The metrics of each database, by filename
+_CONNECTIONS = weakref.WeakSet()  # Every open connection, to see who is holding locks
+_LOCK = threading.Lock()
+
+
+def enable(on=True):
+    """
+    Turns recording on or off
+    """
+    global ENABLED
+    ENABLED = on
+
+
+def reset():
+    """
+    Forgets everything recorded so far
+    """
+    with _LOCK:
+        _METRICS.clear()
+
+
+def register(connection):
+    _CONNECTIONS.add(connection)
+
+
+def database(filename):
+    """
+    Gets the metrics of a database, starting them at 0.  Only call this holding _LOCK
+    """
+    if filename not in _METRICS:
+        _METRICS[filename] = {
+            "locks": {level: {"attempts": 0, "acquired": 0, "failures": 0, "waits": 0, "wait_seconds": 0.0,
+                              "hold_seconds": 0.0} for level in _LEVELS},
+            "commits": {"read": 0, "write": 0},
+            "rollbacks": 0,
+            "commit_seconds": 0.0,
+            "copy_seconds": 0.0,
+            "commit_buckets": [0] * (len(_BUCKETS) + 1),
+        }
+    return _METRICS[filename]
+
+
+"""Recording"""
+
+
+def acquired(connection, level, table=None):
+    """
+    Records a lock being granted.  If the connection failed to get it before, this ends a wait
+    :param connection: The Connection
+    :param level: "S", "R" or "E"
+    :param table: The table the lock is on, or None for the whole database
+    """
+    now = time.perf_counter()
+    with _LOCK:
+        stats = database(connection.filename)["locks"][level]
+        stats["attempts"] += 1
+        stats["acquired"] += 1
+        failed_at = connection.lock_waits.pop(level, None)
+        if failed_at is not None:
+            stats["waits"] += 1
+            stats["wait_seconds"] += now - failed_at
+    connection.lock_times[level if table is None else (level, table)] = now
+
+
+def failed(connection, level):
+    """
+    Records a lock being refused, which starts a wait if the connection tries again
+    """
+    with _LOCK:
+        stats = database(connection.filename)["locks"][level]
+        stats["attempts"] += 1
+        stats["failures"] += 1
+    connection.lock_waits.setdefault(level, time.perf_counter())
+
+
+def released(connection, level, table=None):
+    """
+    Records a lock being released, adding how long it was held
+    """
+    since = connection.lock_times.pop(level if table is None else (level, table), None)
+    if since is None:  # Taken before the metrics were enabled
+        return
+    with _LOCK:
+        database(connection.filename)["locks"][level]["hold_seconds"] += time.perf_counter() - since
+
+
+def copied(filename, seconds):
+    """
+    Records the time spent copying the database, for a transaction or to publish its commit
+    """
+    with _LOCK:
+        database(filename)["copy_seconds"] += seconds
+
+
+def committed(filename, kind, seconds):
+    """
+    Records a commit
+    :param kind: "read" for a transaction that changed nothing, otherwise "write"
+    :param seconds: How long the commit took, copying the database included
+    """
+    with _LOCK:
+        stats = database(filename)
+        stats["commits"][kind] += 1
+        stats["commit_seconds"] += seconds
+        bucket = 0
+        while bucket < len(_BUCKETS) and seconds > _BUCKETS[bucket]:
+            bucket += 1
+        stats["commit_buckets"][bucket] += 1
+
+
+def rolled_back(filename):
+    with _LOCK:
+        database(filename)["rollbacks"] += 1
+
+
+"""Reporting"""
+
+
+def connections(filename=None):
+    """
+    Gets the open connections
+    :param filename: The database they're connected to, or None for all of them
+    """
+    return [connection for connection in list(_CONNECTIONS) if filename is None or connection.filename == filename]
+
+
+def holders(filename=None):
+    """
+    Gets the connections currently holding locks
+    :param filename: The database to look at, or None for all of them
+    :return: The list of dicts with the database, the id of the connection, the levels it holds on the
+    database or any table, the level it holds on each table and how long it's held each database lock, if
+    it was taken while the metrics were enabled
+    """
+    now = time.perf_counter()
+    result = []
+    for connection in connections(filename):
+        held = [level for level, flag in zip(_LEVELS, (connection.shared, connection.reserved,
+                                                       connection.exclusive)) if flag]
+        tables = dict(connection.table_locks)
+        if len(held) > 0 or len(tables) > 0:
+            result.append({"database": connection.filename, "connection": id(connection),
+                           "levels": [level for level in _LEVELS if level in held or level in tables.values()],
+                           "tables": tables,
+                           "held_seconds": {level: now - connection.lock_times[level] for level in held
+                                            if level in connection.lock_times}})
+    return result
+
+
+def snapshot(filename=None):
+    """
+    Gets a copy of the metrics
+    :param filename: The database to get, or None for all of them
+    :return: A dict of each database's metrics, with the connections holding locks under "holders"
+    """
+    with _LOCK:
+        names = list(_METRICS) if filename is None else [filename]
+        result = {}
+        for name in names:
+            stats = database(name)
+            result[name] = {
+                "locks": {level: dict(values) for level, values in stats["locks"].items()},
+                "commits": dict(stats["commits"]),
+                "rollbacks": stats["rollbacks"],
+                "commit_seconds": stats["commit_seconds"],
+                "copy_seconds": stats["copy_seconds"],
+                "commit_buckets": dict(zip([str(b) for b in _BUCKETS] + ["+Inf"], stats["commit_buckets"])),
+            }
+    for holder in holders(filename):
+        if holder["database"] in result:
+            result[holder["database"]].setdefault("holders", []).append(holder)
+    for stats in result.values():
+        stats.setdefault("holders", [])
+    return result
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def prometheus():
+    """
+    Dumps the metrics in the Prometheus text format
+    :return: The text
+    """
+    stats = snapshot()
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for labels, value in samples:
+            text = ",".join("{}=\"{}\"".format(k, _label(v)) for k, v in labels)
+            lines.append("{}{{{}}} {}".format(name, text, value))
+
+    for key, help_text in [("attempts", "Lock acquisition attempts"), ("acquired", "Locks granted"),
+                           ("failures", "Lock requests refused with a TransactionError"),
+                           ("waits", "Locks granted after being refused at least once")]:
+        family("db_lock_{}_total".format(key), "counter", help_text,
+               [((("database", db), ("level", level)), values["locks"][level][key])
+                for db, values in stats.items() for level in _LEVELS])
+    family("db_lock_wait_seconds_total", "counter", "Time from a refused lock request to the lock being granted",
+           [((("database", db), ("level", level)), values["locks"][level]["wait_seconds"])
+            for db, values in stats.items() for level in _LEVELS])
+    family("db_lock_hold_seconds_total", "counter", "Time locks were held",
+           [((("database", db), ("level", level)), values["locks"][level]["hold_seconds"])
+            for db, values in stats.items() for level in _LEVELS])
+    family("db_lock_holders", "gauge", "Connections currently holding a lock",
+           [((("database", db), ("level", level)),
+             sum(1 for holder in values["holders"] if level in holder["levels"]))
+            for db, values in stats.items() for level in _LEVELS])
+    family("db_commits_total", "counter", "Committed transactions",
+           [((("database", db), ("kind", kind)), count) for db, values in stats.items()
+            for kind, count in values["commits"].items()])
+    family("db_rollbacks_total", "counter", "Rolled back transactions",
+           [((("database", db),), values["rollbacks"]) for db, values in stats.items()])
+    family("db_copy_seconds_total", "counter", "Time spent copying database snapshots",
+           [((("database", db),), values["copy_seconds"]) for db, values in stats.items()])
+
+    # The commit durations as a histogram, whose buckets are cumulative
+    lines.append("# HELP db_commit_seconds Commit duration, snapshot copy included")
+    lines.append("# TYPE db_commit_seconds histogram")
+    for db, values in stats.items():
+        total = 0
+        for bound, count in values["commit_buckets"].items():
+            total += count
+            lines.append("db_commit_seconds_bucket{{database=\"{}\",le=\"{}\"}} {}".format(_label(db), bound, total))
+        lines.append("db_commit_seconds_sum{{database=\"{}\"}} {}".format(_label(db), values["commit_seconds"]))
+        lines.append("db_commit_seconds_count{{database=\"{}\"}} {}".format(_label(db), total))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,195 @@
+"""
+This file holds the streaming operators that query results are pipelined through
+"""
+from itertools import chain, islice
+import heapq
+import pickle
+import tempfile
+_SPILL_BATCH = 1024  # Rows pickled together when spilling a run
+
+
+def hash_distinct(rows):
+    """
+    Streams the rows through, dropping every row that was already seen
+    :param rows: An iterable of hashable rows (tuples)
+    :return: A generator of the distinct rows, in the order they first appeared
+    """
+    seen = set()
+    for row in rows:
+        if row not in seen:
+            seen.add(row)
+            yield row
+
+
+def union(left, right, keep_duplicates):
+    """
+    Streams the rows of two queries one after the other
+    :param left: The rows of the left query
+    :param right: The rows of the right query
+    :param keep_duplicates: UNION ALL keeps the duplicates, UNION drops them
+    :return: A generator of the combined rows
+    """
+    rows = chain(left, right)
+    if keep_duplicates:
+        return rows
+    return hash_distinct(rows)
+
+
+def is_sorted(rows, key):
+    """
+    Checks if the rows are already ordered on a key, stopping at the first row out of order
+    :param rows: A list of rows
+    :param key: The function that gets the key of a row
+    :return: True if the keys never decrease and none of them are NULL
+    """
+    prev = None
+    for i, row in enumerate(rows):
+        curr = key(row)
+        if curr is None or (isinstance(curr, tuple) and None in curr):
+            return False
+        if i > 0 and curr < prev:
+            return False
+        prev = curr
+    return True
+
+
+def hash_join(left, right, left_key, right_key, outer, right_width):
+    """
+    Joins two inputs by hashing the right one and streaming the left one past it
+    :param left: An iterable of tuple rows, streamed
+    :param right: An iterable of tuple rows, hashed
+    :param left_key: The function that gets the join key of a left row
+    :param right_key: The function that gets the join key of a right row
+    :param outer: Is this a LEFT OUTER JOIN, keeping left rows without a match
+    :param right_width: The number of columns in a right row, for padding unmatched rows with NULLs
+    :return: A generator of the joined rows
+    """
+    buckets = {}
+    for row in right:
+        key = right_key(row)
+        if key is None or (isinstance(key, tuple) and None in key):  # NULL never equals anything
+            continue
+        if key in buckets:
+            buckets[key].append(row)
+        else:
+            buckets[key] = [row]
+
+    padding = (None,) * right_width
+    for row in left:
+        matches = buckets.get(left_key(row))
+        if matches is not None:
+            for match in matches:
+                yield row + match
+        elif outer:
+            yield row + padding
+
+
+def merge_join(left, right, left_key, right_key, outer, right_width):
+    """
+    Joins two inputs that are both already ordered on their join keys, keeping the order of the left one
+    :param left: An iterable of tuple rows ordered on left_key
+    :param right: A list of tuple rows ordered on right_key
+    :param left_key: The function that gets the join key of a left row
+    :param right_key: The function that gets the join key of a right row
+    :param outer: Is this a LEFT OUTER JOIN, keeping left rows without a match
+    :param right_width: The number of columns in a right row, for padding unmatched rows with NULLs
+    :return: A generator of the joined rows
+    """
+    padding = (None,) * right_width
+    j = 0
+    group_key = None
+    group = []
+    for row in left:
+        key = left_key(row)
+
+        # Moves the right side up to the group of rows with the same key
+        if len(group) == 0 or key != group_key:
+            while j < len(right) and right_key(right[j]) < key:
+                j += 1
+            group = []
+            group_key = key
+            while j < len(right) and right_key(right[j]) == key:
+                group.append(right[j])
+                j += 1
+
+        if len(group) > 0:
+            for match in group:
+                yield row + match
+        elif outer:
+            yield row + padding
+
+
+class OrderKey:
+    """
+    Compares rows on every ORDER BY column at once, for merging runs that were sorted separately
+    """
+    __slots__ = ("values", "descending")
+
+    def __init__(self, values, descending):
+        """
+        :param values: The sort key of the row for each column, (False, None) for NULL
+        :param descending: If each column is sorted descending
+        """
+        self.values = values
+        self.descending = descending
+
+    def __lt__(self, other):
+        for mine, theirs, descending in zip(self.values, other.values, self.descending):
+            if mine == theirs:
+                continue
+            return theirs < mine if descending else mine < theirs
+        return False
+
+    def __eq__(self, other):  # Ties have to compare equal for the merge to stay stable
+        return self.values == other.values
+
+
+def batches(rows, size):
+    """
+    Groups a stream of rows into lists
+    :param rows: An iterable of rows
+    :param size: The most rows in a list
+    :return: A generator of the lists
+    """
+    rows = iter(rows)
+    batch = list(islice(rows, size))
+    while len(batch) > 0:
+        yield batch
+        batch = list(islice(rows, size))
+
+
+def external_run(rows):
+    """
+    Spills a sorted run of rows to a temporary file, which is deleted once it's closed
+    :param rows: The list of sorted rows
+    :return: The temporary file, rewound to the start
+    """
+    run = tempfile.TemporaryFile()
+    for batch in batches(rows, _SPILL_BATCH):
+        pickle.dump(batch, run, pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def read_run(run):
+    """
+    Streams the rows of a spilled run back, closing its file at the end
+    """
+    with run:
+        while True:
+            try:
+                batch = pickle.load(run)
+            except EOFError:
+                return
+            for row in batch:
+                yield row
+
+
+def external_merge(runs, key):
+    """
+    Merges the spilled runs back into one sorted stream with a k-way merge
+    :param runs: The temporary files from external_run
+    :param key: The function that gets the key of a row to merge on
+    :return: A generator of the sorted rows
+    """
+    return heapq.merge(*[read_run(run) for run in runs], key=key)
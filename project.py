@@ -8,11 +8,14 @@ Sources: None
 from Connection import Connection
 
 
-def connect(filename, timeout=0.1, isolation_level=None):
+def connect(filename, timeout=0.1, isolation_level=None, memory_budget=None, journal_mode=None, synchronous="FULL",
+            checkpoint_threshold=4194304, checkpoint_interval=None, result_cache=None,
+            memory_limit=None, replica=None):
     """
     Creates a Connection object with the given filename
     """
-    return Connection(filename, timeout, isolation_level)
+    return Connection(filename, timeout, isolation_level, memory_budget, journal_mode, synchronous,
+                      checkpoint_threshold, checkpoint_interval, result_cache, memory_limit, replica)
 
 
 def check(sql_statement, conn, expected):
@@ -0,0 +1,110 @@
+"""
+This file holds the regression tests for query results that have to be the same whichever way a query runs.
+Tables below vectorized._MIN_ROWS run the compiled pipelines and bigger ones run on NumPy, so the tests run
+each query on a table of each size.  Run them from this directory as
+    python -m pytest -q test_queries.py
+"""
+import itertools
+import random
+import pytest
+import vectorized
+from Connection import Connection
+from Errors import QueryError
+
+_SMALL = 10
+_LARGE = 2000  # Over vectorized._MIN_ROWS
+_RUNS = itertools.count(1)  # So every test gets a database of its own
+
+
+def connect():
+    """
+    Opens a connection on a new database
+    :return: The Connection
+    """
+    return Connection("test-{}.db".format(next(_RUNS)), 0.1, None)
+
+
+def load(conn, rows):
+    """
+    Creates t (id INTEGER, x INTEGER) and u (y INTEGER), where x is NULL in every tenth row and u is empty
+    """
+    conn.execute("CREATE TABLE t (id INTEGER, x INTEGER);")
+    conn.execute("CREATE TABLE u (y INTEGER);")
+    conn.execute("INSERT INTO t VALUES {};".format(
+        ", ".join("({}, {})".format(i, "NULL" if i % 10 == 0 else i) for i in range(rows))))
+
+
+def test_compare_to_null_matches_nothing():
+    for rows in (_SMALL, _LARGE):
+        conn = connect()
+        load(conn, rows)
+        for op in ("=", "!=", "<", ">", "<=", ">="):
+            assert list(conn.execute("SELECT id FROM t WHERE x {} NULL;".format(op))) == []
+            assert list(conn.execute("SELECT id FROM t WHERE id >= 0 AND x {} NULL;".format(op))) == []
+
+
+def test_not_in_empty_subquery_keeps_nulls():
+    for rows in (_SMALL, _LARGE):
+        conn = connect()
+        load(conn, rows)
+        result = conn.execute("SELECT id FROM t WHERE x NOT IN (SELECT y FROM u);")
+        assert sorted(row[0] for row in result) == list(range(rows))
+        assert list(conn.execute("SELECT id FROM t WHERE x IN (SELECT y FROM u);")) == []
+
+
+def test_aggregates_of_empty_table_give_one_row():
+    conn = connect()
+    conn.execute("CREATE TABLE t (id INTEGER, x INTEGER);")
+    assert list(conn.execute("SELECT min(x), max(x), sum(x) FROM t;")) == [(None, None, None)]
+    assert list(conn.execute("SELECT approx_count_distinct(x) FROM t;")) == [(0,)]
+    assert list(conn.execute("SELECT x FROM t;")) == []
+
+
+def test_concat_writes_reals_like_sqlite():
+    conn = connect()
+    conn.execute("CREATE TABLE r (x REAL);")
+    conn.execute("INSERT INTO r VALUES (1.0), (0.1), (-0.0), (100000000000000000000.0), (123456789.123456789);")
+    result = conn.execute("SELECT 'v' || x FROM r;")
+    assert [row[0] for row in result] == ["v1.0", "v0.1", "v0.0", "v1.0e+20", "v123456789.123457"]
+
+
+def test_real_aggregates_match_with_and_without_numpy(monkeypatch):
+    rand = random.Random(0)
+    values = [rand.choice((1e12, -1e12, 0.1, 3.7)) * rand.randrange(1, 1000) / 7 for _ in range(25000)]
+    results = []
+    for enabled in (True, False):
+        monkeypatch.setattr(vectorized, "ENABLED", enabled)
+        conn = connect()
+        conn.execute("CREATE TABLE r (x REAL);")
+        conn.execute("INSERT INTO r VALUES {};".format(", ".join("({!r})".format(v) for v in values)))
+        results.append(list(conn.execute("SELECT sum(x), approx_quantile(x, 0.5), approx_quantile(x, 0.9) FROM r;")))
+    assert results[0] == results[1]
+
+
+def test_union_in_a_string_is_not_a_union():
+    conn = connect()
+    conn.execute("CREATE TABLE s (x INTEGER, n TEXT);")
+    conn.execute("INSERT INTO s VALUES (3, 'UNION'), (1, 'a');")
+    assert list(conn.execute("SELECT x FROM s WHERE n = 'UNION';")) == [(3,)]
+    assert list(conn.execute("SELECT x FROM s WHERE x IN (SELECT x FROM s WHERE n = 'UNION');")) == [(3,)]
+
+
+def test_order_by_sorts_the_whole_union():
+    for rows in (_SMALL, _LARGE):
+        conn = connect()
+        load(conn, rows)
+        conn.execute("INSERT INTO u VALUES (-1), (5), (NULL);")
+        expected = sorted(set(range(rows)) - set(range(0, rows, 10)) | {-1, 5})
+        result = conn.execute("SELECT x FROM t UNION SELECT y FROM u ORDER BY x;")
+        assert list(result) == [(None,)] + [(v,) for v in expected]
+        result = conn.execute("SELECT y FROM u UNION ALL SELECT x FROM t WHERE id < 3 ORDER BY y DESC;")
+        assert list(result) == [(5,), (2,), (1,), (-1,), (None,), (None,)]
+
+
+def test_union_checks_the_columns_of_empty_selects():
+    conn = connect()
+    load(conn, _SMALL)
+    for query in ("SELECT y FROM u UNION SELECT id, x FROM t;", "SELECT id FROM t UNION SELECT y, y FROM u;",
+                  "SELECT x FROM t ORDER BY x UNION SELECT y FROM u;"):
+        with pytest.raises(QueryError):
+            conn.execute(query)
@@ -2,7 +2,11 @@
 This file represents the tokenizer for the SQL statements, which takes in a string and breaks it
 into parts
 """
+import re
 import string
+_VALUE_EXPECTED = ["(", ",", "=", "<", ">", "!=", "<=", ">=", "+", "-", "*", "/", "||", "IS", "IS NOT",
+                   "VALUES", "SELECT", "WHERE", "AND", "SET"]
+_STATEMENT_END = re.compile(r"'[^']*'|;")  # Strings are matched whole so their semicolons are skipped
 
 
 def collect_characters(query, allowed_characters):
@@ -21,7 +25,9 @@ def remove_leading_whitespace(query, tokens):
 
 def remove_word(query, tokens):
     word = collect_characters(query,
-                                   string.ascii_letters + "_.*" + string.digits)
+                                   string.ascii_letters + "_." + string.digits)
+    if word.endswith(".") and query[len(word):len(word) + 1] == "*":  # Every column of a table
+        word += "*"
     if word == "NULL":
         tokens.append(None)
     else:
@@ -82,17 +88,24 @@ def tokenize(query):
             query = remove_leading_whitespace(query, tokens)
             continue
 
-        if query[0:2] == "IS" or query[0:2] == "!=":
+        if query[0:2] in ("IS", "!=", "<=", ">=", "||"):
             tokens.append(query[0:2])
             query = query[2:]
             continue
 
-        if query[0] in "(),;=><":
+        # A minus sign where a value is expected is part of a negative number
+        if query[0] == "-" and query[1:2] in string.digits and query[1:2] != "" and \
+                (len(tokens) == 0 or tokens[-1] in _VALUE_EXPECTED):
+            query = remove_number(query[1:], tokens)
+            tokens.append(-tokens.pop())
+            continue
+
+        if query[0] in "(),;=><+-*/":
             tokens.append(query[0])
             query = query[1:]
             continue
 
-        if query[0] in (string.ascii_letters + "_.*"):
+        if query[0] in (string.ascii_letters + "_."):
             query = remove_word(query, tokens)
             continue
 
@@ -108,3 +121,47 @@ def tokenize(query):
             raise AssertionError("Query didn't get shorter ")
 
     return tokens
+
+
+def split_statements(script):
+    """
+    Splits a script into its statements in a single pass, leaving semicolons inside strings alone
+    :param script: The text of the script
+    :return: The list of statements, each ending in its ';' except a trailing one missing it
+    """
+    statements = []
+    start = 0
+    for match in _STATEMENT_END.finditer(script):
+        if match.group() == ";":
+            statement = script[start:match.end()].strip()
+            if statement != ";":
+                statements.append(statement)
+            start = match.end()
+    if script[start:].strip() != "":
+        statements.append(script[start:].strip())
+    return statements
+
+
+def keyword_positions(tokens, keyword):
+    """
+    Finds where a keyword is used at the top level of a statement, so the same word in a string or in a
+    parenthesized subquery doesn't count
+    :param tokens: The list of tokens from tokenize
+    :param keyword: The keyword to find
+    :return: The list of its indexes, in order
+    """
+    positions = []
+    depth = 0
+    i = 0
+    while i < len(tokens):
+        if tokens[i] == "'":  # A string is its quotes around its text, and the text could be anything
+            i += 3
+            continue
+        if tokens[i] == "(":
+            depth += 1
+        elif tokens[i] == ")":
+            depth -= 1
+        elif tokens[i] == keyword and depth == 0:
+            positions.append(i)
+        i += 1
+    return positions
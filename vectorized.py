@@ -0,0 +1,221 @@
+"""
+This file holds the optional NumPy execution mode, which keeps the INTEGER and REAL columns of a table as
+NumPy arrays with null masks so filters, aggregates and projections run vectorized.  Without NumPy every
+function here reports that it can't help, and the tables run their normal compiled pipelines
+"""
+import math
+import approximate
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ENABLED = np is not None
+_MIN_ROWS = 1024  # Smaller tables are faster to just loop over
+_DTYPES = {"INTEGER": "int64", "REAL": "float64"}
+_MASKS = {"<": "__lt__", ">": "__gt__", "=": "__eq__", "!=": "__ne__", "<=": "__le__", ">=": "__ge__"}
+
+
+def usable(table):
+    """
+    Checks if a table is worth running vectorized
+    :param table: The table
+    """
+    return ENABLED and len(table.table) >= _MIN_ROWS
+
+
+def column(table, name):
+    """
+    Gets the array and null mask of a numeric column, building them once per version of the table
+    :param table: The table
+    :param name: The qualified name of the column
+    :return: A tuple of the values and the null mask, or None if the column isn't numeric
+    """
+    if name not in table.types or table.types[name] not in _DTYPES:
+        return None
+    ind = table.headers[name]
+    cached = table.vectors.get(ind)
+    if cached is not None and cached[0] == table.version:
+        return cached[1], cached[2]
+
+    rows = table.table
+    nulls = np.fromiter((row[ind] is None for row in rows), dtype=bool, count=len(rows))
+    try:
+        values = np.fromiter((0 if row[ind] is None else row[ind] for row in rows),
+                             dtype=_DTYPES[table.types[name]], count=len(rows))
+    except (OverflowError, TypeError, ValueError):  # Doesn't fit in a fixed width column
+        table.vectors[ind] = (table.version, None, None)
+        return None
+    table.vectors[ind] = (table.version, values, nulls)
+    return values, nulls
+
+
+def _number(value):
+    return (isinstance(value, int) or isinstance(value, float)) and not isinstance(value, bool)
+
+
+def mask(table, where):
+    """
+    Evaluates the where conditions as one boolean mask over the whole table
+    :param table: The table
+    :param where: The list of conditions, each a list of the column, operator and value
+    :return: The mask, or None if a condition isn't on a numeric column and a number or NULL
+    """
+    result = None
+    for col, op, val in where:
+        if col is None:  # EXISTS
+            return None
+        name = table.append_table_name([col])[0]
+        arrays = column(table, name)
+        if arrays is None or arrays[0] is None:
+            return None
+        values, nulls = arrays
+
+        if op == "IS":
+            curr = nulls
+        elif op == "IS NOT":
+            curr = ~nulls
+        elif op == "IN" or op == "NOT IN":
+            if not isinstance(val, frozenset) or not all(_number(v) for v in val if v is not None):
+                return None
+            found = np.isin(values, [v for v in val if v is not None])
+            if op == "IN":
+                curr = found & ~nulls
+            elif len(val) == 0:  # NOT IN nothing is true even for NULL
+                curr = np.ones(len(nulls), dtype=bool)
+            elif None in val:  # NOT IN a set with NULL in it is never true
+                curr = np.zeros(len(nulls), dtype=bool)
+            else:
+                curr = ~found & ~nulls
+        elif val is None:  # Comparing to NULL is never true
+            curr = np.zeros(len(nulls), dtype=bool)
+        elif op in _MASKS and _number(val):
+            curr = getattr(values, _MASKS[op])(val) & ~nulls
+        else:
+            return None
+        result = curr if result is None else result & curr
+    return result
+
+
+def where(table, where, indexes=None):
+    """
+    Gets the indexes of the rows matching the where conditions
+    :param indexes: The array of the indexes of the sampled rows to filter, or None for every row
+    :return: The array of indexes, or None if the conditions can't be vectorized
+    """
+    if not usable(table) or len(where) == 0:
+        return None
+    matches = mask(table, where)
+    if matches is None:
+        return None
+    return np.flatnonzero(matches) if indexes is None else indexes[matches[indexes]]
+
+
+def sampled(runs):
+    """
+    Gets the indexes of the rows of a TABLESAMPLE
+    :param runs: The runs from approximate.sample
+    :return: The array of indexes
+    """
+    starts = np.array([run[0] for run in runs], dtype=np.int64)
+    lengths = np.array([run[1] - run[0] for run in runs], dtype=np.int64)
+    # Each index is its position in the output plus how far its run starts past where the run is output
+    return np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+
+
+def hashes(table, name, values):
+    """
+    Hashes the values of a numeric column the same way approximate.value_hash does
+    """
+    if table.types[name] == "REAL":
+        whole = (values == np.floor(values)) & (values >= -2.0 ** 63) & (values < 2.0 ** 63)
+        bits = values.view(np.uint64).copy()
+        bits[whole] = values[whole].astype(np.int64).view(np.uint64)
+    else:
+        bits = values.view(np.uint64)
+    bits = (bits ^ (bits >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    bits = (bits ^ (bits >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return bits ^ (bits >> np.uint64(31))
+
+
+def count_distinct(table, name, values):
+    """
+    Estimates how many distinct values there are, with the same sketch as approximate.count_distinct
+    """
+    bits = hashes(table, name, values)
+    registers = (bits >> np.uint64(64 - approximate.PRECISION)).astype(np.intp)
+    rest = bits & np.uint64((1 << (64 - approximate.PRECISION)) - 1)
+
+    # frexp gives the bit length of numbers exact as floats, so the 64 bits are split into two halves
+    high = np.frexp((rest >> np.uint64(32)).astype(np.float64))[1]
+    low = np.frexp((rest & np.uint64(0xffffffff)).astype(np.float64))[1]
+    ranks = 64 - approximate.PRECISION + 1 - np.where(high > 0, high + 32, low)
+    sketch = np.zeros(1 << approximate.PRECISION, dtype=np.int64)
+    np.maximum.at(sketch, registers, ranks)
+    return approximate.estimate(sketch.tolist())
+
+
+def quantile(values, q):
+    """
+    Estimates a quantile from the same sample of the values approximate.quantile keeps
+    """
+    if len(values) > approximate.RESERVOIR_SIZE:  # The same sample the rows would stream into
+        values = values[approximate.positions(len(values))]
+    return approximate.pick(np.sort(values).tolist(), q)
+
+
+def aggregate(table, func, name, indexes):
+    """
+    Computes an aggregate of a numeric column, skipping NULLs
+    :param table: The table
+    :param func: "min", "max", "sum", "approx_count_distinct" or ("approx_quantile", q)
+    :param name: The qualified name of the column
+    :param indexes: The array of the matching row indexes, or None for every row
+    :return: A tuple holding the value, or None if the column can't be vectorized
+    """
+    arrays = column(table, name)
+    if arrays is None or arrays[0] is None:
+        return None
+    values, nulls = arrays
+    if indexes is not None:
+        values, nulls = values[indexes], nulls[indexes]
+    values = values[~nulls]
+
+    if func == "approx_count_distinct":
+        return (count_distinct(table, name, values),)
+    elif isinstance(func, tuple):
+        return (quantile(values, func[1]),)
+    elif len(values) == 0:
+        return (None,)
+    elif func == "min":
+        return (values.min().item(),)
+    elif func == "max":
+        return (values.max().item(),)
+    elif table.types[name] == "INTEGER":  # Python ints don't overflow
+        return (sum(values.tolist()),)
+    return (math.fsum(values.tolist()),)  # Exactly rounded, so it doesn't matter what order the rows are in
+
+
+def project(table, names, indexes):
+    """
+    Projects the matching rows with fancy indexing, a column at a time
+    :param table: The table
+    :param names: The qualified names of the columns to select
+    :param indexes: The array of the matching row indexes
+    :return: The list of selected rows as tuples
+    """
+    rows = table.table
+    columns = []
+    positions = indexes.tolist()
+    for name in names:
+        arrays = column(table, name)
+        if arrays is None or arrays[0] is None:  # Not numeric, so gather it from the rows
+            ind = table.headers[name]
+            columns.append([rows[i][ind] for i in positions])
+            continue
+        values, nulls = arrays
+        selected = values[indexes].tolist()
+        for i in np.flatnonzero(nulls[indexes]).tolist():
+            selected[i] = None
+        columns.append(selected)
+    return list(zip(*columns))
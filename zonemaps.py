@@ -0,0 +1,117 @@
+"""
+This file holds the zone maps of a table, which split its rows into fixed size chunks and keep the min, max
+and NULL count of each chunk for a column.  A range filter only has to look at the chunks whose zone could
+hold a match, which on data appended in roughly sorted order is a small fraction of the table
+"""
+_ZONE_SIZE = 1024  # The rows in each chunk
+
+
+def zones(table, ind):
+    """
+    Gets the zone map of a column, building it the first time and extending it over rows appended since
+    :param table: The table
+    :param ind: The index of the column
+    :return: The list of zones, each a tuple of the min, max and NULL count of a chunk, or None if the
+    column holds values that can't be compared with each other
+    """
+    rows = table.table
+    covered, built = table.zones.get(ind, (0, []))
+    if covered > len(rows):  # Shouldn't happen, rows going away drop the zone maps
+        covered, built = 0, []
+    if built is None or covered == len(rows):
+        return built
+
+    # The last chunk might have been partial, so it's built again along with the new ones
+    start = len(built) * _ZONE_SIZE if covered % _ZONE_SIZE == 0 else (len(built) - 1) * _ZONE_SIZE
+    built = built[:start // _ZONE_SIZE]
+    for i in range(start, len(rows), _ZONE_SIZE):
+        values = [row[ind] for row in rows[i:i + _ZONE_SIZE]]
+        present = [v for v in values if v is not None]
+        try:
+            if len(present) == 0:
+                built.append((None, None, len(values)))
+            else:
+                built.append((min(present), max(present), len(values) - len(present)))
+        except TypeError:  # Mixed types, so no chunk can be ruled out
+            built = None
+            break
+    table.zones[ind] = (len(rows), built)
+    return built
+
+
+def may_match(zone, op, val):
+    """
+    Checks if any row of a chunk could match a condition
+    :param zone: The zone of the chunk
+    :param op: The operator of the condition
+    :param val: The value of the condition
+    """
+    low, high, nulls = zone
+    if op == "IS":
+        return nulls > 0
+    elif op == "IS NOT":
+        return low is not None
+    elif low is None or val is None:  # Comparing to NULL is never true
+        return False
+    try:
+        if op == "=":
+            return low <= val <= high
+        elif op == "!=":
+            return not (low == high == val)
+        elif op == "<":
+            return low < val
+        elif op == "<=":
+            return low <= val
+        elif op == ">":
+            return high > val
+        elif op == ">=":
+            return high >= val
+    except TypeError:  # Let the scan raise the error
+        return True
+    return True
+
+
+def candidates(table, where):
+    """
+    Gets the chunks of a table that could hold rows matching the where conditions
+    :param table: The table
+    :param where: The list of conditions, already checked
+    :return: The list of the (start, end) of each chunk to scan, or None if no chunk could be skipped
+    """
+    if len(table.table) <= _ZONE_SIZE or len(where) == 0:
+        return None
+    keep = None
+    for col, op, val in where:
+        if col is None or op == "IN" or op == "NOT IN":  # Sets and subqueries don't rule out chunks
+            continue
+        built = zones(table, table.resolve(col))
+        if built is None:
+            continue
+        matches = [may_match(zone, op, val) for zone in built]
+        keep = matches if keep is None else [a and b for a, b in zip(keep, matches)]
+    if keep is None or all(keep):
+        return None
+
+    size = len(table.table)
+    return [(k * _ZONE_SIZE, min((k + 1) * _ZONE_SIZE, size)) for k in range(len(keep)) if keep[k]]
+
+
+def indexes(table, where):
+    """
+    :return: The indexes of the rows in the chunks that could match, or None if no chunk could be skipped
+    """
+    chunks = candidates(table, where)
+    if chunks is None:
+        return None
+    return [i for start, end in chunks for i in range(start, end)]
+
+
+def rows(table, where):
+    """
+    :return: The rows in the chunks that could match, or None if no chunk could be skipped
+    """
+    chunks = candidates(table, where)
+    if chunks is None:
+        return None
+    rows = table.table
+    return [row for start, end in chunks for row in rows[start:end]]